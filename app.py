@@ -5,21 +5,52 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import os
 import pandas as pd
+import numpy as np
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 import io
 from googleapiclient.http import MediaIoBaseDownload
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 import json
-from sqlalchemy import inspect, text
+from sqlalchemy import inspect, text, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
 from flask import send_file # Add this to your existing imports
+from flask import Response, abort, has_request_context, g, stream_with_context
+from werkzeug.utils import safe_join, send_file as werkzeug_send_file
 from reportlab.lib.pagesizes import letter, A4
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib import colors
 from reportlab.lib.units import inch
 import tempfile # Add this to your existing imports
+from payslip_pdf import render_payslip_pdf
+import csv
+import html
+import re
+import mimetypes
+import hashlib
+import functools
+import hmac
+import bisect
+import base64
+import binascii
+import zipfile
+import multiprocessing
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+import threading
+import weakref
+import sqlite3
+import pickle
+import queue
+import time
+try:
+    import fcntl
+except ImportError:  # Windows: coalesce within a process only
+    fcntl = None
 import firebase_admin
 from firebase_admin import credentials, firestore
 
@@ -34,10 +65,17 @@ UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Optional offload of large downloads to the front-end server:
+# '' (serve from Python), 'x-sendfile' (Apache/Passenger) or 'x-accel-redirect' (nginx)
+UPLOAD_OFFLOAD = os.environ.get('UPLOAD_OFFLOAD', '').lower()
+UPLOAD_OFFLOAD_PREFIX = os.environ.get('UPLOAD_OFFLOAD_PREFIX', '/_protected_uploads/')  # nginx internal location
+UPLOAD_OFFLOAD_MIN_BYTES = int(os.environ.get('UPLOAD_OFFLOAD_MIN_BYTES', 256 * 1024))
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
 
 # === SQLite DB Setup ===
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'users.db')
+# DATABASE_URI points the app at another database (seeded benchmark copies, tests)
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URI') or 'sqlite:///' + os.path.join(basedir, 'users.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db = SQLAlchemy(app)
@@ -66,9 +104,53 @@ def safe_int_convert(value, default=None):
         return default
 
 # === File Serving Route ===
+BLOB_NAME_RE = re.compile(r'^([0-9a-f]{64})\.[a-z0-9]+$')
+VARIANT_NAME_RE = re.compile(r'^([0-9a-f]{64})-(thumbnail|medium)\.jpg$')
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    """Serve an upload with Range/conditional support.
+
+    Content-addressed blobs (<sha256>.<ext>) never change, so they get the
+    digest as a strong ETag and a year-long immutable Cache-Control. Legacy
+    filenames can be overwritten and are revalidated on every use.
+    """
+    path = safe_join(os.path.abspath(app.config['UPLOAD_FOLDER']), filename)
+    variant_match = VARIANT_NAME_RE.match(filename)
+    if path is not None and variant_match and not os.path.isfile(path):
+        # Variant not built yet (or Pillow missing): build it now, else fall back to the original
+        blob = UploadBlob.query.filter_by(digest=variant_match.group(1)).first()
+        if not blob:
+            abort(404)
+        try:
+            build_image_variants(blob.stored_name)
+        except Exception as e:
+            print(f"Image variant build failed for {blob.stored_name}: {e}")
+        if not os.path.isfile(path):
+            return redirect(url_for('uploaded_file', filename=blob.stored_name))
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    blob_match = BLOB_NAME_RE.match(filename) or variant_match
+    etag = filename.rsplit('.', 1)[0] if blob_match else True
+    cache_control = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable' if blob_match else 'no-cache'
+    offload = UPLOAD_OFFLOAD if os.path.getsize(path) >= UPLOAD_OFFLOAD_MIN_BYTES else ''
+
+    if offload == 'x-accel-redirect':
+        # nginx serves the bytes (and Range); only answer revalidation here
+        if blob_match and request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+            response.headers['X-Accel-Redirect'] = UPLOAD_OFFLOAD_PREFIX + filename
+        if blob_match:
+            response.set_etag(etag)
+    else:
+        response = werkzeug_send_file(path, request.environ, conditional=True, etag=etag,
+                                      max_age=IMMUTABLE_MAX_AGE if blob_match else None,
+                                      use_x_sendfile=offload == 'x-sendfile')
+    response.headers['Cache-Control'] = cache_control
+    return response
 
 # === Firebase Initialization ===
 try:
@@ -116,6 +198,9 @@ class LeaveRequest(db.Model):
     from_time = db.Column(db.String(20))
     to_date = db.Column(db.String(20))
     to_time = db.Column(db.String(20))
+    # Typed copies of from_date/to_date for range queries (see Typed Date Columns)
+    from_day = db.Column(db.Date, index=True)
+    to_day = db.Column(db.Date, index=True)
     reason = db.Column(db.Text)
     applicant_sign = db.Column(db.String(100))
     applicant_sign_date = db.Column(db.String(20))
@@ -133,10 +218,13 @@ class LeaveRequest(db.Model):
     user = db.relationship('User', foreign_keys=[user_id])
     team_lead = db.relationship('User', foreign_keys=[team_lead_id])
 
+    __table_args__ = (db.Index('ix_leave_request_user_from_day', 'user_id', 'from_day'),)
+
 class Holiday(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), nullable=False)
     date = db.Column(db.String(20), nullable=False)  # Format: YYYY-MM-DD
+    day = db.Column(db.Date, index=True)  # typed copy of date
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.now)
     
@@ -150,6 +238,7 @@ class PermissionRequest(db.Model):
     team_lead_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     spv_name = db.Column(db.String(100))
     date = db.Column(db.String(20))
+    day = db.Column(db.Date, index=True)  # typed copy of date
     applicant_name = db.Column(db.String(100))
     reason = db.Column(db.Text)
     time_out = db.Column(db.String(20))
@@ -165,6 +254,8 @@ class PermissionRequest(db.Model):
     user = db.relationship('User', foreign_keys=[user_id])
     team_lead = db.relationship('User', foreign_keys=[team_lead_id])
 
+    __table_args__ = (db.Index('ix_permission_request_user_day', 'user_id', 'day'),)
+
 class Attendance(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -204,6 +295,7 @@ class TravelRequest(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     company = db.Column(db.String(100))
     date = db.Column(db.String(20))
+    day = db.Column(db.Date, index=True)  # typed copy of date
     purpose = db.Column(db.Text)
     applicant_sign = db.Column(db.String(100))
     director_sign = db.Column(db.String(100))
@@ -335,6 +427,7 @@ class EmployeeInfo(db.Model):
     full_name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     dob = db.Column(db.String(20))
+    birth_date = db.Column(db.Date, index=True)  # typed copy of dob
     gender = db.Column(db.String(10))
     father_name = db.Column(db.String(100))
     father_contact = db.Column(db.String(20))
@@ -413,9 +506,42 @@ class ConveyanceRequest(db.Model):
     status_hr = db.Column(db.String(50), default='Pending') # Tracks HR view status
     status_accounts = db.Column(db.String(50), default='Pending') # Tracks Accounts view status
     request_date = db.Column(db.DateTime, default=lambda: datetime.now(indian_tz))
+    lines_backfilled = db.Column(db.Boolean, default=False)  # claim_details mirrored into ConveyanceClaimLine
 
     user = db.relationship('User', backref=db.backref('conveyance_requests', lazy=True))
 
+# === Conveyance Claim Lines (normalized from ConveyanceRequest.claim_details JSON) ===
+class ConveyanceClaimLine(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    conveyance_request_id = db.Column(db.Integer, db.ForeignKey('conveyance_request.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    position = db.Column(db.Integer, default=0)  # Row order in the claim form
+    claim_date = db.Column(db.Date)
+    month = db.Column(db.String(7), nullable=False)  # Format: YYYY-MM (claim date, else request date)
+    from_place = db.Column(db.String(200))
+    to_place = db.Column(db.String(200))
+    mode = db.Column(db.String(50))
+    distance_km = db.Column(db.Float, default=0.0)
+    amount = db.Column(db.Float, default=0.0)
+
+    conveyance_request = db.relationship('ConveyanceRequest', backref=db.backref('lines', lazy='dynamic', cascade='all, delete-orphan'))
+
+    __table_args__ = (db.Index('ix_conveyance_claim_line_month_user', 'month', 'user_id'),)
+
+class ConveyanceMonthlySummary(db.Model):
+    """Per employee/month conveyance totals, rewritten whenever a claim in that month changes"""
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.String(7), nullable=False)  # Format: YYYY-MM
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    office_branch = db.Column(db.String(50), index=True)  # Branch when the summary was computed
+    lines = db.Column(db.Integer, default=0, nullable=False)
+    distance_km = db.Column(db.Float, default=0.0, nullable=False)
+    amount = db.Column(db.Float, default=0.0, nullable=False)
+    pending_amount = db.Column(db.Float, default=0.0, nullable=False)  # Not yet seen by Accounts
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(indian_tz))
+
+    __table_args__ = (db.UniqueConstraint('month', 'user_id', name='unique_conveyance_summary_month_user'),)
+
 # === Helper Functions ===
 def is_managing_director(user_roles):
     """Check if user has Managing Director role (handles all variations)"""
@@ -511,8 +637,9 @@ class EvaluationResponse(db.Model):
     project_assignment = db.Column(db.String(200))
     area_assignment = db.Column(db.String(100))  # SSEV, SSEV NATURO FARMS, etc.
     
-    # Signature fields
-    signature = db.Column(db.Text)
+    # Signature fields (signature is a large base64 image; deferred so only
+    # get_evaluation_signature loads it)
+    signature = db.deferred(db.Column(db.Text))
     evaluator_name = db.Column(db.String(100))
     evaluation_date = db.Column(db.Date)
     
@@ -523,6 +650,19 @@ class EvaluationResponse(db.Model):
     evaluation_report = db.relationship('EvaluationReport', backref='evaluation_responses')
     evaluator = db.relationship('User', backref='evaluation_responses')
 
+class EvaluationScoreSummary(db.Model):
+    """Per-report score averages, rewritten whenever a response is submitted"""
+    id = db.Column(db.Integer, primary_key=True)
+    evaluation_report_id = db.Column(db.Integer, db.ForeignKey('evaluation_report.id'), nullable=False, unique=True)
+    self_avg = db.Column(db.Float)
+    team_lead_avg = db.Column(db.Float)
+    hr_avg = db.Column(db.Float)
+    director_avg = db.Column(db.Float)
+    md_avg = db.Column(db.Float)
+    overall_avg = db.Column(db.Float)  # mean of the stage averages present
+    stages_completed = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(indian_tz))
+
 # ADD THIS DATABASE MODEL TO YOUR app.py
 
 class AssetRequest(db.Model):
@@ -599,6 +739,86 @@ class AssetRequest(db.Model):
     # Workflow status
     status = db.Column(db.String(50), default='Pending TL Approval')
 
+    # Set once item_details/procurement_items are mirrored into the child tables
+    items_backfilled = db.Column(db.Boolean, default=False)
+
+# === Asset Request Line Items (normalized from AssetRequest.item_details JSON) ===
+class AssetRequestItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    asset_request_id = db.Column(db.Integer, db.ForeignKey('asset_request.id'), nullable=False, index=True)
+    position = db.Column(db.Integer, default=0)  # Row order in the indent form
+    name = db.Column(db.String(200), index=True)
+    brand = db.Column(db.String(100))
+    vendor = db.Column(db.String(100), index=True)
+    tentative_cost = db.Column(db.Float, default=0.0)
+    qty = db.Column(db.Integer, default=0)
+    tax = db.Column(db.Float, default=0.0)
+    tax_type = db.Column(db.String(20))
+    total = db.Column(db.Float, default=0.0)
+    required_by = db.Column(db.String(20))
+    warranty = db.Column(db.String(100))
+    remarks = db.Column(db.Text)
+
+    asset_request = db.relationship('AssetRequest', backref=db.backref('items', lazy='dynamic', cascade='all, delete-orphan'))
+
+# === Procurement Quotes (normalized from AssetRequest.procurement_items JSON) ===
+class ProcurementQuote(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    asset_request_id = db.Column(db.Integer, db.ForeignKey('asset_request.id'), nullable=False, index=True)
+    position = db.Column(db.Integer, default=0)
+    item_name = db.Column(db.String(200), index=True)
+    vendor_name = db.Column(db.String(100), index=True)
+    vendor_address = db.Column(db.Text)
+    cost = db.Column(db.Float, default=0.0)
+    contact_no = db.Column(db.String(20))
+    mail_id = db.Column(db.String(100))
+    edd = db.Column(db.String(20))  # Expected date of delivery
+    vendor_gst = db.Column(db.String(50))
+
+    asset_request = db.relationship('AssetRequest', backref=db.backref('procurement_quotes', lazy='dynamic', cascade='all, delete-orphan'))
+
+# === Budget Ledger Models ===
+class BudgetLedger(db.Model):
+    """Running balance per budget head and project (project_id NULL = office budget)"""
+    id = db.Column(db.Integer, primary_key=True)
+    budget_head = db.Column(db.String(50), nullable=False)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=True)
+    allocated = db.Column(db.Float, default=0.0, nullable=False)
+    utilized = db.Column(db.Float, default=0.0, nullable=False)
+    balance = db.Column(db.Float, default=0.0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(indian_tz), onupdate=lambda: datetime.now(indian_tz))
+
+    __table_args__ = (
+        db.UniqueConstraint('budget_head', 'project_id', name='unique_budget_head_project'),
+        # NULLs are distinct in the constraint above, so office budgets need their own index
+        db.Index('ux_budget_ledger_office_head', 'budget_head', unique=True,
+                 sqlite_where=db.text('project_id IS NULL'), postgresql_where=db.text('project_id IS NULL')),
+    )
+
+class BudgetLedgerEntry(db.Model):
+    """One posting per Accounts-approved indent"""
+    id = db.Column(db.Integer, primary_key=True)
+    ledger_id = db.Column(db.Integer, db.ForeignKey('budget_ledger.id'), nullable=False, index=True)
+    asset_request_id = db.Column(db.Integer, db.ForeignKey('asset_request.id'), nullable=False, unique=True)
+    amount = db.Column(db.Float, default=0.0, nullable=False)
+    month = db.Column(db.String(7), nullable=False, index=True)  # Format: YYYY-MM
+    posted_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(indian_tz))
+
+    ledger = db.relationship('BudgetLedger', backref=db.backref('entries', lazy='dynamic'))
+
+class BudgetMonthlyUtilization(db.Model):
+    """Per head/project/month rollup, updated with each ledger posting"""
+    id = db.Column(db.Integer, primary_key=True)
+    ledger_id = db.Column(db.Integer, db.ForeignKey('budget_ledger.id'), nullable=False)
+    month = db.Column(db.String(7), nullable=False)  # Format: YYYY-MM
+    utilized = db.Column(db.Float, default=0.0, nullable=False)
+    entry_count = db.Column(db.Integer, default=0, nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('ledger_id', 'month', name='unique_budget_ledger_month'),)
+
+    ledger = db.relationship('BudgetLedger', backref=db.backref('monthly', lazy='dynamic'))
+
 # === Vendor Model ===
 class Vendor(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -612,6 +832,859 @@ class Vendor(db.Model):
     
     # Relationships
     creator = db.relationship('User', backref='created_vendors')
+
+# === Upload Blob Store Models ===
+class UploadBlob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(64), nullable=False, index=True)  # SHA-256 of the content
+    stored_name = db.Column(db.String(80), unique=True, nullable=False)  # <digest>.<ext> under UPLOAD_FOLDER
+    size = db.Column(db.Integer)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(indian_tz))
+
+class DocumentRef(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    employee_info_id = db.Column(db.Integer, db.ForeignKey('employee_info.id'), nullable=False, index=True)
+    field = db.Column(db.String(50), nullable=False)  # EmployeeInfo document column
+    blob_id = db.Column(db.Integer, db.ForeignKey('upload_blob.id'), nullable=False, index=True)
+    original_filename = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(indian_tz))
+
+    blob = db.relationship('UploadBlob')
+
+    __table_args__ = (db.UniqueConstraint('employee_info_id', 'field', name='uq_document_ref_field'),)
+
+# === Payroll Run Models ===
+class PayrollRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.String(7), nullable=False, index=True)  # YYYY-MM
+    version = db.Column(db.Integer, nullable=False, default=1)
+    employee_count = db.Column(db.Integer, default=0)
+    total_earnings = db.Column(db.Float, default=0.0)
+    total_deductions = db.Column(db.Float, default=0.0)
+    total_net_pay = db.Column(db.Float, default=0.0)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(indian_tz))
+
+    __table_args__ = (db.UniqueConstraint('month', 'version', name='uq_payroll_run_month_version'),)
+
+class PayrollLine(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('payroll_run.id'), nullable=False, index=True)
+    employee_info_id = db.Column(db.Integer, db.ForeignKey('employee_info.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    full_name = db.Column(db.String(100))
+    employee_id = db.Column(db.String(50))
+    designation = db.Column(db.String(100))
+    office_branch = db.Column(db.String(50))
+    account_number = db.Column(db.String(50))
+    basic = db.Column(db.Float, default=0.0)
+    hra = db.Column(db.Float, default=0.0)
+    conveyance = db.Column(db.Float, default=0.0)
+    vehicle_maintenance = db.Column(db.Float, default=0.0)
+    special_allowance = db.Column(db.Float, default=0.0)
+    add_others = db.Column(db.Float, default=0.0)
+    total_earnings = db.Column(db.Float, default=0.0)
+    total_days = db.Column(db.Integer)
+    ndp = db.Column(db.Integer)
+    lop_days = db.Column(db.Float, default=0.0)
+    loss_of_pay = db.Column(db.Float, default=0.0)
+    provident_fund = db.Column(db.Float, default=0.0)
+    esi = db.Column(db.Float, default=0.0)
+    professional_tax = db.Column(db.Float, default=0.0)
+    income_tax = db.Column(db.Float, default=0.0)
+    advance = db.Column(db.Float, default=0.0)
+    other_deductions = db.Column(db.Float, default=0.0)
+    total_deductions = db.Column(db.Float, default=0.0)
+    net_pay = db.Column(db.Float, default=0.0)
+
+    run = db.relationship('PayrollRun', backref=db.backref('lines', lazy='dynamic', cascade='all, delete-orphan'))
+
+# === Event Log Model (cross-worker fan-out for the SSE stream) ===
+class EventLog(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # JSON delta sent to clients
+    audience = db.Column(db.Text, nullable=False)  # JSON {"users": [...], "emails": [...], "roles": [...], "all": bool}
+    origin_pid = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(indian_tz))
+
+# === Asset Request Item Helpers ===
+def _to_float(value, default=0.0):
+    """Convert JSON numbers or numeric strings to float"""
+    try:
+        return float(value) if value not in (None, '') else default
+    except (ValueError, TypeError):
+        return default
+
+def _to_int(value, default=0):
+    """Convert JSON numbers or numeric strings to int"""
+    try:
+        return int(float(value)) if value not in (None, '') else default
+    except (ValueError, TypeError):
+        return default
+
+def _load_json_list(raw):
+    """Parse a JSON list column, returning [] for empty or malformed values"""
+    if not raw:
+        return []
+    try:
+        parsed = json.loads(raw) if isinstance(raw, str) else raw
+    except (ValueError, TypeError):
+        return []
+    return parsed if isinstance(parsed, list) else []
+
+def _asset_item_rows(asset_request_id, items):
+    """Build AssetRequestItem insert rows from the indent form's itemDetails"""
+    rows = []
+    for position, item in enumerate(items or []):
+        if not isinstance(item, dict):
+            continue
+        rows.append({
+            'asset_request_id': asset_request_id,
+            'position': position,
+            'name': item.get('name'),
+            'brand': item.get('brand'),
+            'vendor': item.get('vendor'),
+            'tentative_cost': _to_float(item.get('tentativeCost', item.get('cost'))),
+            'qty': _to_int(item.get('qty')),
+            'tax': _to_float(item.get('tax')),
+            'tax_type': item.get('taxType'),
+            'total': _to_float(item.get('total')),
+            'required_by': item.get('requiredBy'),
+            'warranty': item.get('warranty'),
+            'remarks': item.get('remarks')
+        })
+    return rows
+
+def _procurement_quote_rows(asset_request_id, quotes):
+    """Build ProcurementQuote insert rows from the procurement table"""
+    rows = []
+    for position, quote in enumerate(quotes or []):
+        if not isinstance(quote, dict):
+            continue
+        rows.append({
+            'asset_request_id': asset_request_id,
+            'position': position,
+            'item_name': quote.get('itemName'),
+            'vendor_name': quote.get('vendorName'),
+            'vendor_address': quote.get('vendorAddress'),
+            'cost': _to_float(quote.get('cost')),
+            'contact_no': quote.get('contactNo'),
+            'mail_id': quote.get('mailId'),
+            'edd': quote.get('edd'),
+            'vendor_gst': quote.get('vendorGst')
+        })
+    return rows
+
+def asset_item_to_dict(item):
+    """Serialize an AssetRequestItem with the same keys the indent form submits"""
+    return {
+        'name': item.name,
+        'brand': item.brand,
+        'vendor': item.vendor,
+        'tentativeCost': item.tentative_cost,
+        'qty': item.qty,
+        'tax': item.tax,
+        'taxType': item.tax_type,
+        'total': item.total,
+        'requiredBy': item.required_by,
+        'warranty': item.warranty,
+        'remarks': item.remarks
+    }
+
+def sync_asset_request_items(req, items):
+    """Replace the normalized item rows for an asset request (same transaction as the caller)"""
+    req.items_backfilled = True
+    AssetRequestItem.query.filter_by(asset_request_id=req.id).delete(synchronize_session=False)
+    rows = _asset_item_rows(req.id, items)
+    if rows:
+        db.session.execute(AssetRequestItem.__table__.insert(), rows)
+
+def sync_procurement_quotes(req, quotes):
+    """Replace the normalized procurement quote rows for an asset request"""
+    req.items_backfilled = True
+    ProcurementQuote.query.filter_by(asset_request_id=req.id).delete(synchronize_session=False)
+    rows = _procurement_quote_rows(req.id, quotes)
+    if rows:
+        db.session.execute(ProcurementQuote.__table__.insert(), rows)
+
+# (model, flag column) pairs recording that a request's JSON was mirrored into
+# its child rows; requests with an empty list get flagged too, so each one is
+# parsed at most once.
+BACKFILL_FLAG_COLUMNS = [(AssetRequest, 'items_backfilled'), (ConveyanceRequest, 'lines_backfilled')]
+
+def migrate_backfill_flag_columns():
+    """Add the backfill flag columns to existing tables"""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    for model, column in BACKFILL_FLAG_COLUMNS:
+        if model.__tablename__ not in tables:
+            continue  # create_all builds it with the column
+        if column not in {c['name'] for c in inspector.get_columns(model.__tablename__)}:
+            db.session.execute(text(f'ALTER TABLE "{model.__tablename__}" ADD COLUMN {column} BOOLEAN DEFAULT 0'))
+            print(f"✅ Added {model.__tablename__}.{column}")
+    db.session.commit()
+
+def backfill_asset_request_items():
+    """Backfill AssetRequestItem/ProcurementQuote from the legacy JSON columns, once per request"""
+    pending = AssetRequest.query.filter(AssetRequest.items_backfilled.isnot(True)).with_entities(
+        AssetRequest.id, AssetRequest.item_details, AssetRequest.procurement_items,
+        db.exists().where(AssetRequestItem.asset_request_id == AssetRequest.id),
+        db.exists().where(ProcurementQuote.asset_request_id == AssetRequest.id)
+    ).all()
+    if not pending:
+        return 0, 0
+
+    item_rows, quote_rows = [], []
+    for request_id, items_raw, quotes_raw, has_items, has_quotes in pending:
+        if not has_items:
+            item_rows.extend(_asset_item_rows(request_id, _load_json_list(items_raw)))
+        if not has_quotes:
+            quote_rows.extend(_procurement_quote_rows(request_id, _load_json_list(quotes_raw)))
+
+    if item_rows:
+        db.session.execute(AssetRequestItem.__table__.insert(), item_rows)
+    if quote_rows:
+        db.session.execute(ProcurementQuote.__table__.insert(), quote_rows)
+    db.session.execute(
+        db.update(AssetRequest).where(AssetRequest.items_backfilled.isnot(True),
+                                      AssetRequest.id <= max(row[0] for row in pending))
+        .values(items_backfilled=True).execution_options(synchronize_session=False))
+    db.session.commit()
+    return len(item_rows), len(quote_rows)
+
+def asset_request_totals(request_ids):
+    """Return {asset_request_id: sum(item total)} with a single grouped query"""
+    if not request_ids:
+        return {}
+    rows = db.session.query(
+        AssetRequestItem.asset_request_id,
+        db.func.coalesce(db.func.sum(AssetRequestItem.total), 0.0)
+    ).filter(AssetRequestItem.asset_request_id.in_(request_ids)).group_by(AssetRequestItem.asset_request_id).all()
+    return {request_id: float(total) for request_id, total in rows}
+
+# === Conveyance Claim Line Helpers ===
+def _conveyance_line_rows(conveyance_request_id, user_id, claims, request_date=None):
+    """Build ConveyanceClaimLine insert rows from the claim form's claim_details"""
+    fallback = parse_date_value(request_date) or datetime.now(indian_tz).date()
+    rows = []
+    for position, claim in enumerate(claims or []):
+        if not isinstance(claim, dict):
+            continue
+        claim_date = parse_date_value(claim.get('date'))
+        rows.append({
+            'conveyance_request_id': conveyance_request_id,
+            'user_id': user_id,
+            'position': position,
+            'claim_date': claim_date,
+            'month': (claim_date or fallback).strftime('%Y-%m'),
+            'from_place': claim.get('from'),
+            'to_place': claim.get('to'),
+            'mode': claim.get('mode'),
+            'distance_km': _to_float(claim.get('kms')),
+            'amount': _to_float(claim.get('amount'))
+        })
+    return rows
+
+def conveyance_request_months(request_ids):
+    """Months touched by the claim lines of the given conveyance requests"""
+    if not request_ids:
+        return set()
+    rows = db.session.query(ConveyanceClaimLine.month).filter(
+        ConveyanceClaimLine.conveyance_request_id.in_(list(request_ids))).distinct().all()
+    return {month for month, in rows}
+
+def sync_conveyance_claim_lines(req, claims):
+    """Replace the normalized lines of a conveyance claim; returns the months before and after"""
+    req.lines_backfilled = True
+    months = conveyance_request_months([req.id])
+    ConveyanceClaimLine.query.filter_by(conveyance_request_id=req.id).delete(synchronize_session=False)
+    rows = _conveyance_line_rows(req.id, req.user_id, claims, req.request_date)
+    if rows:
+        db.session.execute(ConveyanceClaimLine.__table__.insert(), rows)
+    return months | {row['month'] for row in rows}
+
+def refresh_conveyance_summary(months=None):
+    """Recompute ConveyanceMonthlySummary for the given months (all when None).
+
+    One INSERT ... SELECT grouped by month and employee; runs in the caller's
+    transaction so the summary commits together with the claim.
+    """
+    line = ConveyanceClaimLine
+    summaries = ConveyanceMonthlySummary.__table__.delete()
+    select = db.select(
+        line.month, line.user_id, EmployeeInfo.office_branch,
+        db.func.count(line.id),
+        db.func.coalesce(db.func.sum(line.distance_km), 0.0),
+        db.func.coalesce(db.func.sum(line.amount), 0.0),
+        db.func.coalesce(db.func.sum(db.case((ConveyanceRequest.status_accounts == 'Seen', 0.0), else_=line.amount)), 0.0),
+        db.literal(datetime.now(indian_tz), db.DateTime)
+    ).join(ConveyanceRequest, ConveyanceRequest.id == line.conveyance_request_id) \
+     .outerjoin(EmployeeInfo, EmployeeInfo.user_id == line.user_id) \
+     .group_by(line.month, line.user_id, EmployeeInfo.office_branch)
+    if months is not None:
+        months = sorted(months)
+        if not months:
+            return 0
+        select = select.where(line.month.in_(months))
+        summaries = summaries.where(ConveyanceMonthlySummary.month.in_(months))
+    db.session.execute(summaries)
+    result = db.session.execute(ConveyanceMonthlySummary.__table__.insert().from_select(
+        ['month', 'user_id', 'office_branch', 'lines', 'distance_km', 'amount', 'pending_amount', 'updated_at'],
+        select))
+    return result.rowcount
+
+def drop_conveyance_summary_claims():
+    """Drop the old per-month claims column; distinct claim counts now come from ConveyanceClaimLine"""
+    table = ConveyanceMonthlySummary.__tablename__
+    if 'claims' in {c['name'] for c in inspect(db.engine).get_columns(table)}:
+        db.session.execute(text(f'ALTER TABLE "{table}" DROP COLUMN claims'))
+        db.session.commit()
+        print(f"✅ Dropped {table}.claims")
+
+def backfill_conveyance_claim_lines():
+    """Backfill ConveyanceClaimLine (and the monthly summary) from claim_details, once per request"""
+    pending = ConveyanceRequest.query.filter(ConveyanceRequest.lines_backfilled.isnot(True)).with_entities(
+        ConveyanceRequest.id, ConveyanceRequest.user_id, ConveyanceRequest.claim_details,
+        ConveyanceRequest.request_date,
+        db.exists().where(ConveyanceClaimLine.conveyance_request_id == ConveyanceRequest.id)
+    ).all()
+    if not pending:
+        return 0
+
+    rows = []
+    for request_id, user_id, raw, request_date, has_lines in pending:
+        if not has_lines:
+            rows.extend(_conveyance_line_rows(request_id, user_id, _load_json_list(raw), request_date))
+
+    if rows:
+        db.session.execute(ConveyanceClaimLine.__table__.insert(), rows)
+        refresh_conveyance_summary({row['month'] for row in rows})
+    db.session.execute(
+        db.update(ConveyanceRequest).where(ConveyanceRequest.lines_backfilled.isnot(True),
+                                           ConveyanceRequest.id <= max(row[0] for row in pending))
+        .values(lines_backfilled=True).execution_options(synchronize_session=False))
+    db.session.commit()
+    return len(rows)
+
+def conveyance_claim_query(status_column, status):
+    """Claims with the given HR/Accounts status plus applicant name and line totals, in one query"""
+    line = ConveyanceClaimLine
+    totals = db.session.query(
+        line.conveyance_request_id.label('request_id'),
+        db.func.count(line.id).label('lines'),
+        db.func.sum(line.distance_km).label('distance_km'),
+        db.func.sum(line.amount).label('amount')
+    ).group_by(line.conveyance_request_id).subquery()
+    return db.session.query(ConveyanceRequest, User.name, totals.c.lines, totals.c.distance_km, totals.c.amount) \
+        .join(User, User.id == ConveyanceRequest.user_id) \
+        .outerjoin(totals, totals.c.request_id == ConveyanceRequest.id) \
+        .filter(status_column == status)
+
+def conveyance_claim_to_dict(req, applicant_name, lines, distance_km, amount, status):
+    return {
+        'id': req.id,
+        'request_type': 'Conveyance',
+        'applicant_name': applicant_name,
+        'from_date': req.request_date.strftime('%Y-%m-%d'),
+        'to_date': req.request_date.strftime('%Y-%m-%d'),
+        'reason': 'Local Conveyance Claim',
+        'status': status,
+        'lines': lines or 0,
+        'total_km': round(distance_km or 0.0, 2),
+        'total_amount': round(amount or 0.0, 2)
+    }
+
+# === Budget Ledger Helpers ===
+def begin_immediate():
+    """Take SQLite's write lock now, so a check-then-write in this transaction
+    cannot interleave with another worker's (no-op on other databases)"""
+    if db.engine.dialect.name != 'sqlite':
+        return
+    connection = db.session.connection()
+    if not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+def get_budget_ledger(budget_head, project_id=None, create=True):
+    """Look up (or create) the ledger row for a budget head/project pair"""
+    budget_head = (budget_head or 'Unassigned').strip() or 'Unassigned'
+    ledger = BudgetLedger.query.filter_by(budget_head=budget_head, project_id=project_id).first()
+    if not ledger and create:
+        begin_immediate()
+        ledger = BudgetLedger.query.filter_by(budget_head=budget_head, project_id=project_id).first()
+        if ledger:
+            return ledger
+        try:
+            with db.session.begin_nested():
+                ledger = BudgetLedger(budget_head=budget_head, project_id=project_id, allocated=0.0, utilized=0.0, balance=0.0)
+                db.session.add(ledger)
+        except IntegrityError:
+            # Another worker created it first
+            ledger = BudgetLedger.query.filter_by(budget_head=budget_head, project_id=project_id).first()
+    return ledger
+
+def post_budget_utilization(req, user_id=None, allocation=None):
+    """Post an Accounts-approved indent to the budget ledger.
+
+    Runs inside the caller's transaction; the caller commits. Returns the
+    ledger row, or None if the indent was already posted.
+    """
+    begin_immediate()  # utilized/balance below are read-modify-write
+    if BudgetLedgerEntry.query.filter_by(asset_request_id=req.id).first():
+        return None
+
+    ledger = get_budget_ledger(req.budget_head, req.project_id)
+    if allocation is not None and not ledger.allocated:
+        # The approval form only seeds an unallocated head; changing an existing
+        # allocation goes through /api/budget/allocate
+        ledger.allocated = allocation
+    elif allocation is not None and allocation != ledger.allocated:
+        print(f"Ignoring budgetAllocation {allocation} for {ledger.budget_head} (allocated {ledger.allocated})")
+
+    amount = asset_request_totals([req.id]).get(req.id, 0.0) - float(req.discount_amount or 0)
+    month = datetime.now(indian_tz).strftime('%Y-%m')
+
+    db.session.add(BudgetLedgerEntry(ledger_id=ledger.id, asset_request_id=req.id, amount=amount, month=month, posted_by=user_id))
+    ledger.utilized = (ledger.utilized or 0.0) + amount
+    ledger.balance = (ledger.allocated or 0.0) - ledger.utilized
+
+    monthly = BudgetMonthlyUtilization.query.filter_by(ledger_id=ledger.id, month=month).first()
+    if not monthly:
+        monthly = BudgetMonthlyUtilization(ledger_id=ledger.id, month=month, utilized=0.0, entry_count=0)
+        db.session.add(monthly)
+    monthly.utilized += amount
+    monthly.entry_count += 1
+    return ledger
+
+def budget_ledger_to_dict(ledger):
+    return {
+        'budget_head': ledger.budget_head,
+        'project_id': ledger.project_id,
+        'allocated': ledger.allocated,
+        'utilized': ledger.utilized,
+        'balance': ledger.balance,
+        'utilization_pct': round(ledger.utilized / ledger.allocated * 100, 2) if ledger.allocated else None,
+        'updated_at': ledger.updated_at.strftime('%Y-%m-%d %H:%M') if ledger.updated_at else None
+    }
+
+# === Upload Blob Store ===
+# Employee documents are stored once under their SHA-256 digest. DocumentRef
+# maps (employee, field) to a blob and UploadBlob.ref_count tracks how many
+# refs point at it; unreferenced blobs are removed by gc_upload_blobs().
+# Uploads and GC both run under the database write lock (begin_immediate), so
+# a blob cannot be collected between an upload finding its row and the ref
+# being committed; ref_count only changes through atomic UPDATEs.
+EMPLOYEE_DOCUMENT_FIELDS = ['pdc', 'aadhaar_card', 'pan_card', 'resume', 'passport_photo',
+                            'tenth_certificate', 'twelfth_certificate', 'post_graduation_certificate']
+BLOB_CHUNK_SIZE = 64 * 1024
+BLOB_GC_SUFFIX = '.gc'  # collected files are renamed to this before the commit, unlinked after
+UPLOAD_ORPHAN_SWEEP_SECONDS = int(os.environ.get('UPLOAD_ORPHAN_SWEEP_SECONDS', 3600))
+_upload_sweep_state = {'at': 0.0}
+
+def _copy_stream(stream, path, digest=None):
+    """Copy a stream to path via a temp file, optionally hashing as it goes; returns the size"""
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter(lambda: stream.read(BLOB_CHUNK_SIZE), b''):
+                if digest:
+                    digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        if path is None:
+            return size, tmp_path
+        os.replace(tmp_path, path)
+        return size, None
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+def store_upload(file):
+    """Store an uploaded file under its content digest and return its UploadBlob row.
+
+    Seekable uploads (Werkzeug spools them) are hashed first and only written
+    if the file is missing; other streams are hashed while being copied to a
+    temp file. The row lookup and the write happen under the write lock, which
+    the caller's transaction holds until it commits the ref.
+    """
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    ext = file.filename.rsplit('.', 1)[1].lower()
+    stream = file.stream
+    digest = hashlib.sha256()
+    try:
+        start = stream.tell()
+        seekable = stream.seekable() if hasattr(stream, 'seekable') else True
+    except (AttributeError, OSError):
+        seekable = False
+
+    tmp_path = None
+    if seekable:
+        size = 0
+        for chunk in iter(lambda: stream.read(BLOB_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    else:
+        size, tmp_path = _copy_stream(stream, None, digest)
+    stored_name = f'{digest.hexdigest()}.{ext}'
+    path = os.path.join(app.config['UPLOAD_FOLDER'], stored_name)
+
+    try:
+        begin_immediate()
+        blob = UploadBlob.query.filter_by(stored_name=stored_name).first()
+        if not blob:
+            try:
+                with db.session.begin_nested():
+                    blob = UploadBlob(digest=digest.hexdigest(), stored_name=stored_name, size=size, ref_count=0)
+                    db.session.add(blob)
+            except IntegrityError:
+                # The same content was stored concurrently; use that row
+                blob = UploadBlob.query.filter_by(stored_name=stored_name).first()
+        # Missing if new, or if GC collected it just before we took the lock.
+        # A file written here whose row then rolls back is removed by
+        # sweep_orphan_uploads().
+        if not os.path.exists(path):
+            if tmp_path:
+                os.replace(tmp_path, path)
+                tmp_path = None
+            else:
+                stream.seek(start)
+                _copy_stream(stream, path)
+    finally:
+        if tmp_path:
+            os.remove(tmp_path)
+    return blob
+
+def _adjust_blob_refs(blob_id, delta):
+    db.session.execute(
+        db.update(UploadBlob).where(UploadBlob.id == blob_id)
+        .values(ref_count=UploadBlob.ref_count + delta).execution_options(synchronize_session=False))
+
+def attach_employee_document(employee, field, file):
+    """Point an EmployeeInfo document field at the uploaded file's blob; the caller commits"""
+    if not file or not file.filename or not allowed_file(file.filename):
+        return None
+    blob = store_upload(file)
+    ref = DocumentRef.query.filter_by(employee_info_id=employee.id, field=field).first()
+    if ref and ref.blob_id == blob.id:
+        return blob
+    if ref:
+        _adjust_blob_refs(ref.blob_id, -1)
+        ref.blob_id = blob.id
+        ref.original_filename = file.filename
+    else:
+        db.session.add(DocumentRef(employee_info_id=employee.id, field=field, blob_id=blob.id, original_filename=file.filename))
+    _adjust_blob_refs(blob.id, 1)
+    setattr(employee, field, blob.stored_name)
+    if field in IMAGE_VARIANT_FIELDS:
+        enqueue_image_variants(blob.stored_name)
+    return blob
+
+def attach_employee_documents(employee, files):
+    for field in EMPLOYEE_DOCUMENT_FIELDS:
+        if field in files and files[field].filename:
+            attach_employee_document(employee, field, files[field])
+
+def release_employee_documents(employee):
+    """Drop an employee's document refs before the record is deleted; the caller commits"""
+    for ref in DocumentRef.query.filter_by(employee_info_id=employee.id).all():
+        _adjust_blob_refs(ref.blob_id, -1)
+        db.session.delete(ref)
+
+def _blob_file_names(stored_name):
+    return [stored_name] + [image_variant_name(stored_name, v) for v in IMAGE_VARIANTS]
+
+def gc_upload_blobs():
+    """Delete unreferenced blobs and their files; returns the number removed.
+
+    The rows go in one conditional DELETE under the write lock. Their files are
+    renamed aside before the commit and unlinked after it, so a failed commit
+    can put them back and an upload reviving the blob writes a fresh file.
+    """
+    begin_immediate()
+    candidates = [name for name, in db.session.execute(
+        db.select(UploadBlob.stored_name).where(UploadBlob.ref_count <= 0))]
+    collected = []
+    try:
+        if candidates:
+            db.session.execute(
+                db.delete(UploadBlob).where(UploadBlob.stored_name.in_(candidates), UploadBlob.ref_count <= 0)
+                .execution_options(synchronize_session=False))
+            for stored_name in candidates:
+                for name in _blob_file_names(stored_name):
+                    path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+                    try:
+                        os.replace(path, path + BLOB_GC_SUFFIX)
+                        collected.append(path)
+                    except FileNotFoundError:
+                        pass
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        for path in collected:
+            os.replace(path + BLOB_GC_SUFFIX, path)
+        raise
+    for path in collected:
+        try:
+            os.remove(path + BLOB_GC_SUFFIX)
+        except FileNotFoundError:
+            pass
+
+    if time.time() - _upload_sweep_state['at'] > UPLOAD_ORPHAN_SWEEP_SECONDS:
+        _upload_sweep_state['at'] = time.time()
+        sweep_orphan_uploads()
+    return len(candidates)
+
+def sweep_orphan_uploads():
+    """Remove blob and variant files that have no UploadBlob row; returns the number removed.
+
+    Such files are left by uploads whose transaction rolled back. In-flight
+    uploads hold the write lock until they commit, so taking it here means
+    every file listed either has its row by now or never will.
+    """
+    folder = app.config['UPLOAD_FOLDER']
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return 0
+    begin_immediate()
+    try:
+        stored = {name for name, in db.session.execute(db.select(UploadBlob.stored_name))}
+        digests = {name.split('.')[0] for name in stored}
+        removed = 0
+        for name in names:
+            blob_match, variant_match = BLOB_NAME_RE.match(name), VARIANT_NAME_RE.match(name)
+            if (blob_match and name not in stored) or (variant_match and variant_match.group(1) not in digests) \
+                    or name.endswith(BLOB_GC_SUFFIX):
+                try:
+                    os.remove(os.path.join(folder, name))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+    finally:
+        db.session.commit()
+    if removed:
+        print(f"🧹 Removed {removed} orphaned upload files")
+    return removed
+
+# === Image Variants ===
+# Photo/ID uploads get resized JPEG derivatives next to the original blob
+# (<digest>-thumbnail.jpg, <digest>-medium.jpg), built by a background thread.
+IMAGE_VARIANT_FIELDS = ['passport_photo', 'aadhaar_card', 'pan_card']
+IMAGE_VARIANTS = {'thumbnail': (160, 75), 'medium': (800, 82)}  # longest side in px, JPEG quality
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+_variant_queue = queue.Queue()
+_variant_lock = threading.Lock()
+_variant_worker_state = {'pid': None}
+
+def _is_image_blob(stored_name):
+    return bool(stored_name) and bool(BLOB_NAME_RE.match(stored_name)) and \
+        stored_name.rsplit('.', 1)[1] in IMAGE_EXTENSIONS
+
+def image_variant_name(stored_name, variant):
+    return f"{stored_name.split('.')[0]}-{variant}.jpg"
+
+def build_image_variants(stored_name):
+    """Write any missing variants for an image blob; returns False if Pillow is unavailable"""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return False
+    folder = app.config['UPLOAD_FOLDER']
+    missing = [v for v in IMAGE_VARIANTS if not os.path.exists(os.path.join(folder, image_variant_name(stored_name, v)))]
+    if not missing:
+        return True
+    with Image.open(os.path.join(folder, stored_name)) as source:
+        image = ImageOps.exif_transpose(source)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        for variant in missing:
+            size, quality = IMAGE_VARIANTS[variant]
+            resized = image.copy()
+            resized.thumbnail((size, size), Image.LANCZOS)
+            fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.part')
+            with os.fdopen(fd, 'wb') as out:
+                resized.save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+            os.replace(tmp_path, os.path.join(folder, image_variant_name(stored_name, variant)))
+    return True
+
+def _variant_worker():
+    while True:
+        stored_name = _variant_queue.get()
+        try:
+            build_image_variants(stored_name)
+        except Exception as e:
+            print(f"Image variant build failed for {stored_name}: {e}")
+
+def enqueue_image_variants(stored_name):
+    """Queue variant generation for an image blob on this process's worker thread"""
+    if not _is_image_blob(stored_name):
+        return
+    with _variant_lock:
+        if _variant_worker_state['pid'] != os.getpid():
+            _variant_worker_state['pid'] = os.getpid()
+            threading.Thread(target=_variant_worker, name='image-variants', daemon=True).start()
+    _variant_queue.put(stored_name)
+
+def document_variant_urls(stored_name):
+    """URLs for each variant of a document; non-images map every variant to the original"""
+    original = url_for('uploaded_file', filename=stored_name)
+    urls = {'original': original}
+    for variant in IMAGE_VARIANTS:
+        urls[variant] = url_for('uploaded_file', filename=image_variant_name(stored_name, variant)) \
+            if _is_image_blob(stored_name) else original
+    return urls
+
+def employee_document_variants(employee):
+    return {field: document_variant_urls(getattr(employee, field))
+            for field in EMPLOYEE_DOCUMENT_FIELDS if getattr(employee, field)}
+
+# === Model Change Hooks ===
+# Subsystems that mirror table data (search index, event stream, caches)
+# register a (collect, dispatch) pair here. collect(op, obj) runs at flush
+# time while the object is still loaded and returns a plain payload (or
+# None); dispatch(payloads) runs once the transaction has committed.
+# include_collections=True also reports objects whose only change is a
+# relationship collection, such as roles added to a User.
+_commit_hooks = []
+
+def register_commit_hook(collect, dispatch, include_collections=False):
+    _commit_hooks.append((collect, dispatch, include_collections))
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_model_changes(session, flush_context):
+    if not _commit_hooks:
+        return
+    pending = session.info.setdefault('commit_hook_payloads', {})
+    inserted = [('insert', obj) for obj in session.new]
+    deleted = [('delete', obj) for obj in session.deleted]
+    updated = {flag: [('update', obj) for obj in session.dirty if session.is_modified(obj, include_collections=flag)]
+               for flag in {hook[2] for hook in _commit_hooks}}
+    for index, (collect, _, include_collections) in enumerate(_commit_hooks):
+        for op, obj in inserted + updated[include_collections] + deleted:
+            try:
+                payload = collect(op, obj)
+            except Exception as e:
+                print(f"Commit hook collect failed: {e}")
+                continue
+            if payload is not None:
+                pending.setdefault(index, []).append(payload)
+
+@event.listens_for(db.session, 'after_commit')
+def _dispatch_model_changes(session):
+    pending = session.info.pop('commit_hook_payloads', None)
+    if not pending:
+        return
+    for index, payloads in pending.items():
+        try:
+            _commit_hooks[index][1](payloads)
+        except Exception as e:
+            print(f"Commit hook dispatch failed: {e}")
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_model_changes(session):
+    session.info.pop('commit_hook_payloads', None)
+
+# === Typed Date Columns ===
+# Request, holiday and employee dates are stored as strings in whatever format
+# the forms sent. Each one has an indexed Date copy (LeaveRequest.from_day and
+# to_day, PermissionRequest/TravelRequest/Holiday.day, EmployeeInfo.birth_date)
+# that range and year filters use. The copies are set whenever the string
+# attribute is assigned through the ORM; raw SQL and Core writers call
+# backfill_typed_dates() afterwards.
+TYPED_DATE_COLUMNS = [
+    (LeaveRequest, 'from_date', 'from_day'),
+    (LeaveRequest, 'to_date', 'to_day'),
+    (PermissionRequest, 'date', 'day'),
+    (TravelRequest, 'date', 'day'),
+    (Holiday, 'date', 'day'),
+    (EmployeeInfo, 'dob', 'birth_date'),
+]
+DATE_INPUT_FORMATS = ['%Y-%m-%d', '%d-%m-%Y', '%Y/%m/%d', '%d/%m/%Y', '%d.%m.%Y', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S']
+
+def parse_date_value(value):
+    """date for a date/datetime or a string in one of DATE_INPUT_FORMATS, else None"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if hasattr(value, 'toordinal'):
+        return value  # already a date
+    text_value = str(value).strip()
+    for fmt in DATE_INPUT_FORMATS:
+        try:
+            return datetime.strptime(text_value, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+def _sync_typed_date(typed_attr):
+    def listener(target, value, oldvalue, initiator):
+        setattr(target, typed_attr, parse_date_value(value))
+    return listener
+
+for _model, _source, _typed in TYPED_DATE_COLUMNS:
+    event.listen(getattr(_model, _source), 'set', _sync_typed_date(_typed))
+
+def migrate_typed_date_columns():
+    """Add the typed date columns and their indexes to existing tables"""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    for model in {model for model, _, _ in TYPED_DATE_COLUMNS}:
+        table = model.__table__
+        if table.name not in tables:
+            continue  # create_all builds it with the columns and indexes
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for _, _, typed in [entry for entry in TYPED_DATE_COLUMNS if entry[0] is model]:
+            if typed not in existing:
+                db.session.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN {typed} DATE'))
+                print(f"✅ Added {table.name}.{typed}")
+        db.session.commit()
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
+def backfill_typed_dates():
+    """Fill typed date columns that are NULL while their string column is set; returns rows updated"""
+    updated = 0
+    for model, source, typed in TYPED_DATE_COLUMNS:
+        source_col, typed_col = getattr(model, source), getattr(model, typed)
+        # Values already in ISO form convert in SQL; the rest are parsed in Python
+        updated += db.session.execute(
+            db.update(model).where(typed_col.is_(None), db.func.date(source_col) == source_col)
+            .values({typed: db.func.date(source_col)}).execution_options(synchronize_session=False)
+        ).rowcount
+        pending = db.session.execute(
+            db.select(model.id, source_col).where(typed_col.is_(None), source_col.isnot(None), source_col != '')
+        ).all()
+        parsed = [{'_id': row_id, '_day': parse_date_value(value)} for row_id, value in pending]
+        parsed = [row for row in parsed if row['_day'] is not None]
+        if parsed:
+            db.session.execute(
+                db.update(model.__table__).where(model.__table__.c.id == db.bindparam('_id'))
+                .values({typed: db.bindparam('_day')}), parsed
+            )
+            updated += len(parsed)
+    db.session.commit()
+    return updated
+
+with app.app_context():
+    try:
+        migrate_typed_date_columns()
+        db.create_all()
+        filled = backfill_typed_dates()
+        if filled:
+            print(f"✅ Backfilled {filled} typed date values")
+    except Exception as e:
+        db.session.rollback()
+        print(f"Typed date migration failed: {e}")
+
 # At the end of the file, inside `if __name__ == '__main__':`
 # you might want to create the new table.
 with app.app_context():
@@ -625,6 +1698,29 @@ with app.app_context():
             db.session.add(Role(name=role_name))
     db.session.commit()
 
+    # Indexes added to existing tables after they were created
+    try:
+        for index in BudgetLedger.__table__.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+    except Exception as e:
+        print(f"Budget ledger index creation failed (duplicate office budget heads?): {e}")
+
+    # Move legacy indent item JSON into the normalized child tables
+    try:
+        migrate_backfill_flag_columns()
+        backfill_asset_request_items()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Asset request item backfill failed: {e}")
+
+    # Same for conveyance claim lines
+    try:
+        drop_conveyance_summary_claims()
+        backfill_conveyance_claim_lines()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Conveyance claim line backfill failed: {e}")
+
 # === Routes ===
 
 @app.route('/')
@@ -1028,6 +2124,9 @@ def get_hr_finalized_requests():
     if not hr_user or 'HR' not in [r.name for r in hr_user.roles]:
         return jsonify({'status': 'error', 'message': 'Unauthorized access'}), 403
 
+    if requested_export_format():
+        return export_finalized_requests(requested_export_format())
+
     # Fetch all finalized leave requests (Approved or Rejected)
     leave_requests = LeaveRequest.query.filter(
         LeaveRequest.status.in_(['Approved', 'Rejected'])
@@ -1205,6 +2304,21 @@ def submit_leave_request():
         if missing_fields:
             return jsonify({'status': 'error', 'message': f'Missing required form data: {", ".join(missing_fields)}'}), 400
 
+        check, error = check_leave_request(user.id, data.get('from_date'), data.get('to_date'))
+        if error:
+            return jsonify({'status': 'error', 'message': error}), 400
+        if not check['ok']:
+            return jsonify({'status': 'error', 'message': leave_check_message(check), 'conflicts': check}), 409
+
+        # Re-check own overlaps under the write lock so two concurrent submits cannot both pass
+        begin_immediate()
+        check['overlaps'] = leave_overlaps(user.id, parse_date_value(data.get('from_date')),
+                                           parse_date_value(data.get('to_date')))
+        if check['overlaps']:
+            db.session.rollback()
+            check['ok'] = False
+            return jsonify({'status': 'error', 'message': leave_check_message(check), 'conflicts': check}), 409
+
         employee_info = EmployeeInfo.query.filter_by(user_id=user.id).first()
         
         new_leave_request = LeaveRequest(
@@ -1231,7 +2345,8 @@ def submit_leave_request():
         db.session.add(new_leave_request)
         db.session.commit()
 
-        return jsonify({'status': 'success', 'message': 'Leave request submitted successfully!', 'request_id': new_leave_request.id}), 201
+        return jsonify({'status': 'success', 'message': 'Leave request submitted successfully!', 'request_id': new_leave_request.id,
+                        'warnings': [leave_check_message(check)] if check['capacity'] else []}), 201
 
     except Exception as e:
         db.session.rollback()
@@ -1324,7 +2439,8 @@ def api_user_permissions_count():
         approved_permissions = PermissionRequest.query.filter(
             PermissionRequest.user_id == user.id,
             PermissionRequest.status == 'Approved',
-            db.extract('year', PermissionRequest.date) == current_year
+            PermissionRequest.day >= datetime(current_year, 1, 1).date(),
+            PermissionRequest.day < datetime(current_year + 1, 1, 1).date()
         ).count()
 
         return jsonify({
@@ -1930,6 +3046,9 @@ def submit_conveyance_claim():
         )
 
         db.session.add(new_conveyance_request)
+        db.session.flush()
+        months = sync_conveyance_claim_lines(new_conveyance_request, data.get('claim_details'))
+        refresh_conveyance_summary(months)
         db.session.commit()
         return jsonify({'status': 'success', 'message': 'Conveyance claim submitted successfully!'}), 201
     except Exception as e:
@@ -1983,6 +3102,8 @@ def mark_conveyance_claim_seen(request_id):
         return jsonify({'status': 'success', 'message': 'Claim marked as seen by HR.'})
     elif 'Accounts' in roles:
         conveyance_request.status_accounts = 'Seen'
+        db.session.flush()
+        refresh_conveyance_summary(conveyance_request_months([conveyance_request.id]))
         db.session.commit()
         return jsonify({'status': 'success', 'message': 'Claim marked as seen by Accounts.'})
     else:
@@ -1996,18 +3117,14 @@ def get_hr_conveyance_requests():
     if not hr_user or 'HR' not in [r.name for r in hr_user.roles]:
         return jsonify({'status': 'error', 'message': 'Unauthorized access'}), 403
 
-    requests = ConveyanceRequest.query.filter_by(status_hr='Pending').all()
-    requests_list = []
-    for req in requests:
-        requests_list.append({
-            'id': req.id,
-            'request_type': 'Conveyance',
-            'applicant_name': req.user.name,
-            'from_date': req.request_date.strftime('%Y-%m-%d'),
-            'to_date': req.request_date.strftime('%Y-%m-%d'),
-            'reason': 'Local Conveyance Claim',
-            'status': req.status_hr
-        })
+    if requested_export_format():
+        return export_query(CONVEYANCE_EXPORT_COLUMNS, ConveyanceRequest.query.join(User, User.id == ConveyanceRequest.user_id)
+                            .filter(ConveyanceRequest.status_hr == 'Pending').order_by(ConveyanceRequest.request_date.desc()),
+                            'conveyance_claims_hr', requested_export_format())
+
+    rows = conveyance_claim_query(ConveyanceRequest.status_hr, 'Pending').all()
+    requests_list = [conveyance_claim_to_dict(req, name, lines, km, amount, req.status_hr)
+                     for req, name, lines, km, amount in rows]
     return jsonify({'status': 'success', 'requests': requests_list})
 
 # New endpoint for HR to view seen conveyance claims
@@ -2018,18 +3135,9 @@ def get_hr_seen_conveyance_requests():
     if not hr_user or 'HR' not in [r.name for r in hr_user.roles]:
         return jsonify({'status': 'error', 'message': 'Unauthorized access'}), 403
 
-    requests = ConveyanceRequest.query.filter_by(status_hr='Seen').all()
-    requests_list = []
-    for req in requests:
-        requests_list.append({
-            'id': req.id,
-            'request_type': 'Conveyance',
-            'applicant_name': req.user.name,
-            'from_date': req.request_date.strftime('%Y-%m-%d'),
-            'to_date': req.request_date.strftime('%Y-%m-%d'),
-            'reason': 'Local Conveyance Claim',
-            'status': req.status_hr
-        })
+    rows = conveyance_claim_query(ConveyanceRequest.status_hr, 'Seen').all()
+    requests_list = [conveyance_claim_to_dict(req, name, lines, km, amount, req.status_hr)
+                     for req, name, lines, km, amount in rows]
     return jsonify({'status': 'success', 'requests': requests_list})
 
 # New endpoint for Accounts to view conveyance claims
@@ -2040,18 +3148,14 @@ def get_accounts_conveyance_requests():
     if not accounts_user or 'Accounts' not in [r.name for r in accounts_user.roles]:
         return jsonify({'status': 'error', 'message': 'Unauthorized access'}), 403
 
-    requests = ConveyanceRequest.query.filter_by(status_accounts='Pending').all()
-    requests_list = []
-    for req in requests:
-        requests_list.append({
-            'id': req.id,
-            'request_type': 'Conveyance',
-            'applicant_name': req.user.name,
-            'from_date': req.request_date.strftime('%Y-%m-%d'),
-            'to_date': req.request_date.strftime('%Y-%m-%d'),
-            'reason': 'Local Conveyance Claim',
-            'status': req.status_accounts
-        })
+    if requested_export_format():
+        return export_query(CONVEYANCE_EXPORT_COLUMNS, ConveyanceRequest.query.join(User, User.id == ConveyanceRequest.user_id)
+                            .filter(ConveyanceRequest.status_accounts == 'Pending').order_by(ConveyanceRequest.request_date.desc()),
+                            'conveyance_claims_accounts', requested_export_format())
+
+    rows = conveyance_claim_query(ConveyanceRequest.status_accounts, 'Pending').all()
+    requests_list = [conveyance_claim_to_dict(req, name, lines, km, amount, req.status_accounts)
+                     for req, name, lines, km, amount in rows]
     return jsonify({'status': 'success', 'requests': requests_list})
 @app.route('/api/teamlead/all_requests')
 def get_teamlead_all_requests():
@@ -2115,18 +3219,9 @@ def get_accounts_seen_conveyance_requests():
     if not accounts_user or 'Accounts' not in [r.name for r in accounts_user.roles]:
         return jsonify({'status': 'error', 'message': 'Unauthorized access'}), 403
 
-    requests = ConveyanceRequest.query.filter_by(status_accounts='Seen').all()
-    requests_list = []
-    for req in requests:
-        requests_list.append({
-            'id': req.id,
-            'request_type': 'Conveyance',
-            'applicant_name': req.user.name,
-            'from_date': req.request_date.strftime('%Y-%m-%d'),
-            'to_date': req.request_date.strftime('%Y-%m-%d'),
-            'reason': 'Local Conveyance Claim',
-            'status': req.status_accounts
-        })
+    rows = conveyance_claim_query(ConveyanceRequest.status_accounts, 'Seen').all()
+    requests_list = [conveyance_claim_to_dict(req, name, lines, km, amount, req.status_accounts)
+                     for req, name, lines, km, amount in rows]
     return jsonify({'status': 'success', 'requests': requests_list})
 
 # ... (rest of your app.py code) ...
@@ -2320,12 +3415,15 @@ def api_update_user():
 @app.route('/api/team_leads')
 def get_team_leads():
     try:
-        team_lead_role = Role.query.filter_by(name='Team Lead').first()
-        if not team_lead_role:
+        def build():
+            team_lead_role = Role.query.filter_by(name='Team Lead').first()
+            if not team_lead_role:
+                return None
+            return [{'id': user.id, 'name': user.name} for user in team_lead_role.users if not user.is_deleted]
+
+        team_leads_list = cache_get_or_set('team_leads:active', build, tags=('table:user', 'table:role'))
+        if team_leads_list is None:
             return jsonify({'status': 'error', 'message': 'Team Lead role not found'}), 404
-            
-        team_leads = team_lead_role.users
-        team_leads_list = [{'id': user.id, 'name': user.name} for user in team_leads if not user.is_deleted]
 
         return jsonify({'status': 'success', 'team_leads': team_leads_list})
     except Exception as e:
@@ -2405,6 +3503,7 @@ def permanent_delete_user():
         # Delete associated employee info if exists
         employee_info = EmployeeInfo.query.filter_by(user_id=user.id).first()
         if employee_info:
+            release_employee_documents(employee_info)
             db.session.delete(employee_info)
         
         # Delete user roles associations
@@ -2414,6 +3513,13 @@ def permanent_delete_user():
         db.session.delete(user)
         
         db.session.commit()
+
+        # Remove document blobs no other employee references
+        try:
+            gc_upload_blobs()
+        except Exception as gc_error:
+            db.session.rollback()
+            print(f"Upload GC failed: {gc_error}")
         
         return jsonify({
             'status': 'success', 
@@ -2801,47 +3907,295 @@ def update_group(group_id):
         db.session.rollback()
         return jsonify({'status': 'error', 'message': str(e)})
         
+# === Dependency Circuit Breakers ===
+# Calls to Google Drive and Firestore run on a small per-dependency thread pool
+# with a deadline, so a hung client library cannot hold a worker past it. After
+# `failure_threshold` consecutive failures the breaker opens and calls fail fast
+# for `reset_timeout` seconds; then a single probe call is let through
+# (half-open) and its outcome closes or re-opens the breaker. Breaker state is
+# per worker process. Settings come from <NAME>_BREAKER_TIMEOUT,
+# <NAME>_BREAKER_FAILURES, <NAME>_BREAKER_RESET and <NAME>_SERVE_STALE.
+STALE_DATA_TTL = int(os.environ.get('STALE_DATA_TTL', 7 * 24 * 3600))
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, name, timeout=10.0, failure_threshold=3, reset_timeout=30.0, serve_stale=True, max_workers=4):
+        prefix = name.upper().replace('-', '_') + '_'
+        self.name = name
+        self.timeout = float(os.environ.get(prefix + 'BREAKER_TIMEOUT', timeout))
+        self.failure_threshold = int(os.environ.get(prefix + 'BREAKER_FAILURES', failure_threshold))
+        self.reset_timeout = float(os.environ.get(prefix + 'BREAKER_RESET', reset_timeout))
+        self.serve_stale = os.environ.get(prefix + 'SERVE_STALE', '1' if serve_stale else '0') in ('1', 'true', 'yes')
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.last_error = None
+        self.last_failure_at = None
+        self.last_success_at = None
+        self.counts = {'calls': 0, 'successes': 0, 'failures': 0, 'timeouts': 0, 'rejected': 0, 'stale_served': 0}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'breaker-{name}')
+
+    def _admit(self):
+        with self._lock:
+            self.counts['calls'] += 1
+            if self.state == 'open':
+                if time.time() - self.opened_at < self.reset_timeout:
+                    self.counts['rejected'] += 1
+                    raise CircuitOpenError(f'{self.name} circuit is open')
+                self.state = 'half_open'
+            if self.state == 'half_open':
+                if self.probe_in_flight:
+                    self.counts['rejected'] += 1
+                    raise CircuitOpenError(f'{self.name} circuit is half-open; probe in flight')
+                self.probe_in_flight = True
+
+    def _record(self, error=None, timed_out=False):
+        with self._lock:
+            self.probe_in_flight = False
+            if error is None:
+                self.counts['successes'] += 1
+                self.state = 'closed'
+                self.consecutive_failures = 0
+                self.opened_at = None
+                self.last_success_at = time.time()
+                return
+            self.counts['timeouts' if timed_out else 'failures'] += 1
+            self.consecutive_failures += 1
+            self.last_error = str(error) or type(error).__name__
+            self.last_failure_at = time.time()
+            if self.state == 'half_open' or self.consecutive_failures >= self.failure_threshold:
+                if self.state != 'open':
+                    print(f"⚠️ {self.name} circuit opened after {self.consecutive_failures} failures: {self.last_error}")
+                self.state = 'open'
+                self.opened_at = time.time()
+
+    def call(self, func, *args, **kwargs):
+        """Run func under the breaker; raises CircuitOpenError, TimeoutError or func's own error"""
+        self._admit()
+        future = self._executor.submit(func, *args, **kwargs)
+        try:
+            result = future.result(timeout=self.timeout)
+        except FuturesTimeoutError:
+            future.cancel()
+            error = TimeoutError(f'{self.name} call exceeded {self.timeout:g}s')
+            self._record(error, timed_out=True)
+            raise error
+        except Exception as e:
+            self._record(e)
+            raise
+        self._record()
+        return result
+
+    def status(self):
+        with self._lock:
+            state = self.state
+            if state == 'open' and time.time() - self.opened_at >= self.reset_timeout:
+                state = 'half_open'  # the next call will probe
+            return {
+                'name': self.name,
+                'state': state,
+                'consecutive_failures': self.consecutive_failures,
+                'opened_at': datetime.fromtimestamp(self.opened_at).isoformat() if self.opened_at else None,
+                'last_error': self.last_error,
+                'last_failure_at': datetime.fromtimestamp(self.last_failure_at).isoformat() if self.last_failure_at else None,
+                'last_success_at': datetime.fromtimestamp(self.last_success_at).isoformat() if self.last_success_at else None,
+                'timeout_seconds': self.timeout,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout_seconds': self.reset_timeout,
+                'serve_stale': self.serve_stale,
+                **self.counts,
+            }
+
+CIRCUIT_BREAKERS = {
+    'drive': CircuitBreaker('drive', timeout=15.0),
+    'firestore': CircuitBreaker('firestore', timeout=30.0),
+}
+
+def guarded_fetch(breaker_name, key, fetch, *args):
+    """Call fetch(*args); on failure serve the last good result for key (flagged stale) or None"""
+    breaker = CIRCUIT_BREAKERS[breaker_name]
+    try:
+        result = fetch(*args)
+    except Exception as e:
+        print(f"⚠️ {breaker_name} fetch {key} failed: {e}")
+        if breaker.serve_stale:
+            last_good = cache_get(f'last-good:{key}')
+            if last_good is not _CACHE_MISS:
+                fetched_at, result = last_good
+                with breaker._lock:
+                    breaker.counts['stale_served'] += 1
+                if has_request_context():
+                    g.stale_data = dict(getattr(g, 'stale_data', {}), **{key: fetched_at})
+                return result
+        return None
+    if result is not None and breaker.serve_stale:
+        cache_set(f'last-good:{key}', (datetime.now().isoformat(), result), ttl=STALE_DATA_TTL)
+    return result
+
+def stale_data_sources():
+    """{key: fetched_at} for every fallback served during the current request"""
+    return getattr(g, 'stale_data', {}) if has_request_context() else {}
+
+@app.after_request
+def _flag_stale_response(response):
+    if stale_data_sources():
+        response.headers['Warning'] = '110 - "Response is Stale"'
+    return response
+
+@app.route('/api/_dependencies', methods=['GET'])
+def dependency_status():
+    """Circuit breaker state of the external dependencies in this worker (Admin or METRICS_TOKEN bearer)"""
+    denied = _metrics_auth_error()
+    if denied:
+        return denied
+
+    return jsonify({'status': 'success', 'pid': os.getpid(),
+                    'dependencies': [breaker.status() for breaker in CIRCUIT_BREAKERS.values()]})
+
+# === Single-Flight Fetches ===
+# Identical concurrent calls to a remote fetch share one in-flight call. Within a
+# process, followers wait on the leader's event. Across worker processes, the
+# leader holds an flock() on a per-key lock file and hands its result over
+# through the shared cache; a process that finds the lock taken polls for it
+# and reuses that result instead of fetching again. The poll gives up after the
+# fetch's own timeout (a leader stuck longer than that has failed anyway) and
+# the waiter fetches directly, so a wedged leader cannot pin every worker.
+# Results are shared, so callers must treat them as read-only.
+SINGLE_FLIGHT_RESULT_TTL = 30  # seconds a handed-over result stays readable by waiting workers
+SINGLE_FLIGHT_POLL_MAX = 0.2   # seconds between lock polls, at most
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+def _single_flight_lock_path(key):
+    directory = os.environ.get('SINGLE_FLIGHT_DIR') or SHARED_CACHE_PATH + '-locks'
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, hashlib.sha1(key.encode()).hexdigest() + '.lock')
+
+def _wait_for_lock(lock_file, deadline):
+    """Poll a non-blocking flock() until it is taken or `deadline` passes; True if taken"""
+    delay = 0.01
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, SINGLE_FLIGHT_POLL_MAX)
+
+def _fetch_across_processes(key, func, args, kwargs, wait_seconds):
+    if fcntl is None:
+        return func(*args, **kwargs)
+    arrived = time.time()
+    try:
+        lock_file = open(_single_flight_lock_path(key), 'a+')
+    except OSError as e:
+        print(f"Single-flight lock unavailable for {key}: {e}")
+        return func(*args, **kwargs)
+    with lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another worker is fetching the same thing; wait for it and reuse its result
+            locked = _wait_for_lock(lock_file, arrived + wait_seconds)
+            handed_over = cache_get(f'single-flight:{key}')
+            if handed_over is not _CACHE_MISS and handed_over[0] >= arrived:
+                return handed_over[1]
+            if not locked:
+                print(f"Single-flight leader for {key} still busy after {wait_seconds:g}s; fetching directly")
+                return func(*args, **kwargs)
+        result = func(*args, **kwargs)
+        cache_set(f'single-flight:{key}', (time.time(), result), ttl=SINGLE_FLIGHT_RESULT_TTL)
+        return result
+
+def single_flight(namespace, wait_seconds):
+    """Coalesce concurrent calls with equal arguments into one call of the wrapped fetch.
+
+    wait_seconds bounds how long another worker's in-flight call is waited for;
+    pass the fetch's own timeout.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = f"{namespace}:{json.dumps([args, kwargs], sort_keys=True, default=str)}"
+            with _flights_lock:
+                flight = _flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = _flights[key] = _Flight()
+            if not leader:
+                flight.done.wait()
+                if flight.error is not None:
+                    raise flight.error
+                return flight.result
+            try:
+                flight.result = _fetch_across_processes(key, func, args, kwargs, wait_seconds)
+                return flight.result
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with _flights_lock:
+                    _flights.pop(key, None)
+                flight.done.set()
+        return wrapper
+    return decorator
+
 # === Attendance API Endpoints ===
 
 # Helper function to fetch attendance from Google Drive
-def fetch_from_drive(prefix, date_str=None):
-    try:
-        # NOTE: Make sure to place your 'credentials.json' file in the root directory
-        creds = service_account.Credentials.from_service_account_file(
-            'credentials.json',
-            scopes=['https://www.googleapis.com/auth/drive']
-        )
-        service = build('drive', 'v3', credentials=creds)
+def _download_drive_csv(prefix, date_str):
+    # NOTE: Make sure to place your 'credentials.json' file in the root directory
+    creds = service_account.Credentials.from_service_account_file(
+        'credentials.json',
+        scopes=['https://www.googleapis.com/auth/drive']
+    )
+    service = build('drive', 'v3', credentials=creds)
 
-        if not date_str:
-            date_str = datetime.now(indian_tz).strftime("%Y-%m-%d")
+    filename = f"{prefix}_attendance_{date_str}.csv"
+    folder_id = "1IK_7O_k5zAdgLEYyRZLDrQSzniAUuava"
+    query = f"name='{filename}' and '{folder_id}' in parents and mimeType='text/csv'"
+    results = service.files().list(q=query, pageSize=1, fields="files(id, name)").execute()
+    items = results.get('files', [])
+    if not items:
+        return None
 
-        filename = f"{prefix}_attendance_{date_str}.csv"
-        folder_id = "1IK_7O_k5zAdgLEYyRZLDrQSzniAUuava"
-        query = f"name='{filename}' and '{folder_id}' in parents and mimeType='text/csv'"
-        results = service.files().list(q=query, pageSize=1, fields="files(id, name)").execute()
-        items = results.get('files', [])
-        if not items:
-            return None
+    file_id = items[0]['id']
+    file_request = service.files().get_media(fileId=file_id)
+    fh = io.BytesIO()
+    downloader = MediaIoBaseDownload(fh, file_request)
+    done = False
+    while not done:
+        _, done = downloader.next_chunk()
 
-        file_id = items[0]['id']
-        file_request = service.files().get_media(fileId=file_id)
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, file_request)
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
+    fh.seek(0)
+    df = pd.read_csv(fh)
+    df = df.fillna('')
+    df['Date'] = date_str.strip()
 
-        fh.seek(0)
-        df = pd.read_csv(fh)
-        df = df.fillna('')
-        df['Date'] = date_str.strip()
+    return df
 
-        return df
+@single_flight('drive', CIRCUIT_BREAKERS['drive'].timeout)
+def _fetch_drive_csv(prefix, date_str):
+    return CIRCUIT_BREAKERS['drive'].call(_download_drive_csv, prefix, date_str)
 
-    except Exception as e:
-        print(f"⚠️ fetch_from_drive({prefix}) error: {e}")
-        return None
+def fetch_from_drive(prefix, date_str=None):
+    if not date_str:
+        date_str = datetime.now(indian_tz).strftime("%Y-%m-%d")
+    return guarded_fetch('drive', f'drive:{prefix}:{date_str}', _fetch_drive_csv, prefix, date_str)
 
 @app.route('/api/attendance/today')
 def api_attendance_today():
@@ -2865,7 +4219,11 @@ def api_attendance_today():
                         "status": row.get("Status", "—")
                     })
 
-        return jsonify({"status": "success", "employees": employees})
+        if requested_export_format():
+            return export_response(ATTENDANCE_EXPORT_COLUMNS, ([row[key] for _, key in ATTENDANCE_EXPORT_COLUMNS] for row in employees),
+                                   f'attendance_{today}', requested_export_format())
+
+        return jsonify({"status": "success", "employees": employees, "stale": stale_data_sources()})
 
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)})
@@ -2956,8 +4314,8 @@ def add_role():
 @app.route('/api/roles', methods=['GET'])
 def get_roles():
     try:
-        roles = Role.query.all()
-        role_list = [role.name for role in roles]
+        role_list = cache_get_or_set('roles:names', lambda: [role.name for role in Role.query.all()],
+                                     tags=('table:role',))
         return jsonify({'status': 'success', 'roles': role_list})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)})
@@ -3113,66 +4471,6 @@ def add_employee_info():
         if EmployeeInfo.query.filter_by(user_id=user.id).first():
             return jsonify({'status': 'error', 'message': 'Employee info for this user already exists.'})
 
-        # Handle file uploads
-        pdc_filename = None
-        aadhaar_filename = None
-        pan_filename = None
-        resume_filename = None
-
-        if 'pdc' in request.files and request.files['pdc'].filename:
-            file = request.files['pdc']
-            if file and allowed_file(file.filename):
-                pdc_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], pdc_filename))
-
-        if 'aadhaar_card' in request.files and request.files['aadhaar_card'].filename:
-            file = request.files['aadhaar_card']
-            if file and allowed_file(file.filename):
-                aadhaar_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], aadhaar_filename))
-
-        if 'pan_card' in request.files and request.files['pan_card'].filename:
-            file = request.files['pan_card']
-            if file and allowed_file(file.filename):
-                pan_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], pan_filename))
-
-        if 'resume' in request.files and request.files['resume'].filename:
-            file = request.files['resume']
-            if file and allowed_file(file.filename):
-                resume_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], resume_filename))
-
-        passport_photo_filename = None
-        if 'passport_photo' in request.files and request.files['passport_photo'].filename:
-            file = request.files['passport_photo']
-            if file and allowed_file(file.filename):
-                passport_photo_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], passport_photo_filename))
-
-        tenth_certificate_filename = None
-        twelfth_certificate_filename = None
-
-        if 'tenth_certificate' in request.files and request.files['tenth_certificate'].filename:
-            file = request.files['tenth_certificate']
-            if file and allowed_file(file.filename):
-                tenth_certificate_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], tenth_certificate_filename))
-
-        if 'twelfth_certificate' in request.files and request.files['twelfth_certificate'].filename:
-            file = request.files['twelfth_certificate']
-            if file and allowed_file(file.filename):
-                twelfth_certificate_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], twelfth_certificate_filename))
-
-        post_graduation_certificate_filename = None
-
-        if 'post_graduation_certificate' in request.files and request.files['post_graduation_certificate'].filename:
-            file = request.files['post_graduation_certificate']
-            if file and allowed_file(file.filename):
-                post_graduation_certificate_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], post_graduation_certificate_filename))
-
         print(f"Creating EmployeeInfo with user_id: {user.id}")
         new_employee_info = EmployeeInfo(
             user_id=user.id,
@@ -3192,13 +4490,6 @@ def add_employee_info():
             address=request.form.get('address'),
             office_branch=request.form.get('office_branch'),
             employee_id=request.form.get('employee_id'),
-            pdc=pdc_filename,
-            aadhaar_card=aadhaar_filename,
-            pan_card=pan_filename,
-            resume=resume_filename,
-            passport_photo=passport_photo_filename,
-            tenth_certificate=tenth_certificate_filename,
-            twelfth_certificate=twelfth_certificate_filename,
             marital_status=request.form.get('marital_status'),
             designation=request.form.get('designation'),
             probation_from=safe_date_convert(request.form.get('probation_from')),
@@ -3209,7 +4500,6 @@ def add_employee_info():
             probation_salary=request.form.get('probation_salary'),
             confirmation_salary=request.form.get('confirmation_salary'),
             post_graduation_marks=request.form.get('post_graduation_marks'),
-            post_graduation_certificate=post_graduation_certificate_filename,
             account_number=request.form.get('account_number'),
             actual_gross_salary=safe_float_convert(request.form.get('actual_gross_salary')),
             basic=safe_float_convert(request.form.get('basic')),
@@ -3227,6 +4517,9 @@ def add_employee_info():
             db.session.add(new_employee_info)
             db.session.flush()  # Flush to get the ID before commit
             print(f"Employee created with ID: {new_employee_info.id}")
+
+            # Store uploaded documents in the blob store
+            attach_employee_documents(new_employee_info, request.files)
             
             # Update PF No in User model
             user.pf_no = request.form.get('pf_no')
@@ -3246,6 +4539,14 @@ def add_employee_info():
 @app.route('/api/get_all_employee_info')
 def get_all_employee_info():
     try:
+        fmt = requested_export_format()
+        if fmt:
+            denied = _export_denied(User.query.filter_by(email=session.get('user')).first())
+            if denied:
+                return denied
+            return export_query(EMPLOYEE_EXPORT_COLUMNS, EmployeeInfo.query.filter_by(is_deleted=False)
+                                .order_by(EmployeeInfo.full_name), 'employees', fmt)
+
         # Only get employees that are NOT deleted
         employees = EmployeeInfo.query.filter_by(is_deleted=False).all()
         print(f"Found {len(employees)} employees")
@@ -3289,7 +4590,8 @@ def get_all_employee_info():
                 'earnings_conveyance': emp.earnings_conveyance,
                 'earnings_vehicle_maintenance': emp.earnings_vehicle_maintenance,
                 'earnings_special_allowance': emp.earnings_special_allowance,
-                'earnings_add_others': emp.earnings_add_others
+                'earnings_add_others': emp.earnings_add_others,
+                'document_variants': employee_document_variants(emp)
             })
         print(f"Returning {len(employee_list)} employees")
         return jsonify({'status': 'success', 'employees': employee_list})
@@ -3369,7 +4671,8 @@ def get_employee_info(employee_id):
             'total_leaves': employee.total_leaves,
             'designation': employee.designation,
             'pf_no': employee.user.pf_no if employee.user else None,
-            'roles': user_roles
+            'roles': user_roles,
+            'document_variants': employee_document_variants(employee)
         }
         return jsonify({'status': 'success', 'employee': info})
     except Exception as e:
@@ -3411,16 +4714,16 @@ def get_employee_report_data():
             LeaveRequest.user_id == employee.user_id,
             LeaveRequest.status == 'Approved',
             # Check if the leave period overlaps with the selected date range
-            LeaveRequest.from_date <= to_date,
-            LeaveRequest.to_date >= from_date
+            LeaveRequest.from_day <= end_date,
+            LeaveRequest.to_day >= start_date
         ).count()
         
         # Count permissions from permission_request table - count approved permissions within the date range
         permission_count = db.session.query(PermissionRequest).filter(
             PermissionRequest.user_id == employee.user_id,
             PermissionRequest.status == 'Approved',
-            PermissionRequest.date >= from_date,
-            PermissionRequest.date <= to_date
+            PermissionRequest.day >= start_date,
+            PermissionRequest.day <= end_date
         ).count()
         
         # Get salary from employee info
@@ -3569,63 +4872,16 @@ def update_employee_info():
             employee.user.pf_no = request.form.get('pf_no', employee.user.pf_no)
 
         # Handle file uploads - only update if new files are provided
-        if 'pdc' in request.files and request.files['pdc'].filename:
-            file = request.files['pdc']
-            if file and allowed_file(file.filename):
-                pdc_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], pdc_filename))
-                employee.pdc = pdc_filename
-
-        if 'aadhaar_card' in request.files and request.files['aadhaar_card'].filename:
-            file = request.files['aadhaar_card']
-            if file and allowed_file(file.filename):
-                aadhaar_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], aadhaar_filename))
-                employee.aadhaar_card = aadhaar_filename
-
-        if 'pan_card' in request.files and request.files['pan_card'].filename:
-            file = request.files['pan_card']
-            if file and allowed_file(file.filename):
-                pan_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], pan_filename))
-                employee.pan_card = pan_filename
-
-        if 'resume' in request.files and request.files['resume'].filename:
-            file = request.files['resume']
-            if file and allowed_file(file.filename):
-                resume_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], resume_filename))
-                employee.resume = resume_filename
-
-        if 'passport_photo' in request.files and request.files['passport_photo'].filename:
-            file = request.files['passport_photo']
-            if file and allowed_file(file.filename):
-                passport_photo_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], passport_photo_filename))
-                employee.passport_photo = passport_photo_filename
-
-        if 'tenth_certificate' in request.files and request.files['tenth_certificate'].filename:
-            file = request.files['tenth_certificate']
-            if file and allowed_file(file.filename):
-                tenth_certificate_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], tenth_certificate_filename))
-                employee.tenth_certificate = tenth_certificate_filename
-
-        if 'twelfth_certificate' in request.files and request.files['twelfth_certificate'].filename:
-            file = request.files['twelfth_certificate']
-            if file and allowed_file(file.filename):
-                twelfth_certificate_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], twelfth_certificate_filename))
-                employee.twelfth_certificate = twelfth_certificate_filename
-
-        if 'post_graduation_certificate' in request.files and request.files['post_graduation_certificate'].filename:
-            file = request.files['post_graduation_certificate']
-            if file and allowed_file(file.filename):
-                post_graduation_certificate_filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], post_graduation_certificate_filename))
-                employee.post_graduation_certificate = post_graduation_certificate_filename
+        attach_employee_documents(employee, request.files)
 
         db.session.commit()
+
+        # Replaced documents may have left blobs without references
+        try:
+            gc_upload_blobs()
+        except Exception as gc_error:
+            db.session.rollback()
+            print(f"Upload GC failed: {gc_error}")
         return jsonify({'status': 'success', 'message': 'Employee info updated successfully.'})
     except Exception as e:
         db.session.rollback()
@@ -3754,6 +5010,8 @@ def create_asset_request():
             status='Pending TL Approval'
         )
         db.session.add(new_request)
+        db.session.flush()  # Need the ID for the item rows
+        sync_asset_request_items(new_request, data.get('itemDetails', []))
         db.session.commit()
         
         print(f"Asset request created with ID: {new_request.id}, Status: {new_request.status}, Team Lead ID: {new_request.team_lead_id}")
@@ -3990,25 +5248,19 @@ def get_birthday_alerts():
         # Get current date in Indian timezone
         current_date = datetime.now(indian_tz).date()
         
-        # Get all employee info records with DOB
-        all_employees = EmployeeInfo.query.filter(EmployeeInfo.dob.isnot(None)).all()
+        # Only employees whose birthday falls in the next three days
+        upcoming = [(current_date + timedelta(days=offset)).strftime('%m-%d') for offset in range(3)]
+        all_employees = EmployeeInfo.query.filter(
+            EmployeeInfo.birth_date.isnot(None),
+            db.func.strftime('%m-%d', EmployeeInfo.birth_date).in_(upcoming)
+        ).all()
         
         birthday_alerts = []
         
         for emp in all_employees:
-            if emp.dob:
+            if emp.birth_date:
                 try:
-                    # Parse DOB string (format might be YYYY-MM-DD or DD-MM-YYYY)
-                    dob = None
-                    for fmt in ['%Y-%m-%d', '%d-%m-%Y', '%Y/%m/%d', '%d/%m/%Y']:
-                        try:
-                            dob = datetime.strptime(emp.dob, fmt).date()
-                            break
-                        except ValueError:
-                            continue
-                    
-                    if not dob:
-                        continue
+                    dob = emp.birth_date
                     
                     # Calculate birthday for this year
                     birthday_this_year = dob.replace(year=current_date.year)
@@ -4094,7 +5346,11 @@ def get_user_asset_requests():
     if not user:
         return jsonify({'status': 'error', 'message': 'User not authenticated'}), 401
     
-    requests = AssetRequest.query.filter_by(indenter_id=user.id).order_by(AssetRequest.request_date.desc()).all()
+    query = AssetRequest.query.filter_by(indenter_id=user.id).order_by(AssetRequest.request_date.desc())
+    if requested_export_format():
+        return export_query(ASSET_EXPORT_COLUMNS, query, 'asset_indents', requested_export_format())
+
+    requests = query.all()
     requests_list = [{
         'id': req.id,
         'request_date': req.request_date.strftime('%Y-%m-%d'),
@@ -4215,6 +5471,17 @@ def get_my_approved_requests():
         unique_requests = {req.id: req for req in approved_requests}.values()
         sorted_requests = sorted(unique_requests, key=lambda x: x.request_date, reverse=True)
         
+        # Load line items and totals for all requests at once instead of parsing JSON per row
+        request_ids = [req.id for req in sorted_requests]
+        items_by_request = {}
+        if request_ids:
+            items = AssetRequestItem.query.filter(
+                AssetRequestItem.asset_request_id.in_(request_ids)
+            ).order_by(AssetRequestItem.asset_request_id, AssetRequestItem.position).all()
+            for item in items:
+                items_by_request.setdefault(item.asset_request_id, []).append(asset_item_to_dict(item))
+        totals_by_request = asset_request_totals(request_ids)
+        
         requests_list = []
         for req in sorted_requests:
             # Get indenter name
@@ -4228,12 +5495,7 @@ def get_my_approved_requests():
                     team_lead_name = team_lead.name
             
             # Get item details
-            item_details = []
-            if req.item_details:
-                try:
-                    item_details = json.loads(req.item_details) if isinstance(req.item_details, str) else req.item_details
-                except:
-                    item_details = []
+            item_details = items_by_request.get(req.id, [])
             
             requests_list.append({
                 'id': req.id,
@@ -4242,6 +5504,7 @@ def get_my_approved_requests():
                 'team_lead_name': team_lead_name,
                 'status': req.status,
                 'item_details': item_details,
+                'grand_total': totals_by_request.get(req.id, 0.0) - float(req.discount_amount or 0),
                 'justification': req.justification or '',
                 'procurement_type': req.procurement_type or '',
                 'md_approval': getattr(req, 'md_approval', False),
@@ -4396,9 +5659,8 @@ def download_asset_request(request_id):
         if 'Procurement' not in user_roles:
             return jsonify({'status': 'error', 'message': 'Access denied. Procurement role required.'}), 403
 
-        # Parse item details
-        item_details = json.loads(req.item_details) if req.item_details else []
-        procurement_items = json.loads(req.procurement_items) if req.procurement_items else []
+        # Load normalized item details
+        item_details = [asset_item_to_dict(item) for item in req.items.order_by(AssetRequestItem.position).all()]
 
         # Create PDF content (simplified version - you can enhance this)
         from reportlab.lib.pagesizes import letter
@@ -4474,7 +5736,7 @@ def download_asset_request(request_id):
             story.append(Paragraph(f"<b>Discount Amount:</b> ₹{req.discount_amount}", styles['Normal']))
         
         # Calculate grand total
-        grand_total = sum(float(item.get('total', 0)) for item in item_details)
+        grand_total = asset_request_totals([req.id]).get(req.id, 0.0)
         if req.discount_amount:
             grand_total -= float(req.discount_amount)
         story.append(Paragraph(f"<b>Grand Total:</b> ₹{grand_total:.2f}", styles['Normal']))
@@ -4497,18 +5759,185 @@ def download_asset_request(request_id):
         print(f"Error generating PDF: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
-@app.route('/api/user/roles')
-def api_get_user_roles():
-    user_email = session.get('user')
-    user = User.query.filter_by(email=user_email).first()
-    if not user:
-        return jsonify({'status': 'error', 'message': 'User not authenticated'}), 401
-    roles = [role.name for role in user.roles]
-    return jsonify({'status': 'success', 'roles': roles})
+@app.route('/api/asset_requests/vendor_rollup', methods=['GET'])
+def get_asset_vendor_rollup():
+    """Quote counts and amounts per vendor, aggregated in SQL"""
+    try:
+        user_email = session.get('user')
+        user = User.query.filter_by(email=user_email).first()
+        if not user:
+            return jsonify({'status': 'error', 'message': 'User not authenticated'}), 401
 
-@app.route('/api/project/<int:project_id>/tasks', methods=['POST'])
-def create_project_task(project_id):
-    user_email = session.get('user')
+        user_roles = [role.name for role in user.roles]
+        if not any(role in ['Procurement', 'Accounts', 'Director', 'Managing Director', 'Admin'] for role in user_roles):
+            return jsonify({'status': 'error', 'message': 'Unauthorized access'}), 403
+
+        quotes = db.session.query(
+            ProcurementQuote.vendor_name,
+            db.func.count(ProcurementQuote.id),
+            db.func.count(db.distinct(ProcurementQuote.asset_request_id)),
+            db.func.coalesce(db.func.sum(ProcurementQuote.cost), 0.0),
+            db.func.min(ProcurementQuote.cost),
+            db.func.max(ProcurementQuote.cost)
+        ).group_by(ProcurementQuote.vendor_name).all()
+
+        finalized = dict(db.session.query(
+            AssetRequest.finalized_vendor,
+            db.func.count(AssetRequest.id)
+        ).filter(AssetRequest.finalized_vendor.isnot(None)).group_by(AssetRequest.finalized_vendor).all())
+
+        vendors_list = []
+        for vendor_name, quote_count, request_count, total_cost, min_cost, max_cost in quotes:
+            vendors_list.append({
+                'vendor_name': vendor_name,
+                'quote_count': quote_count,
+                'request_count': request_count,
+                'total_quoted': float(total_cost),
+                'min_quote': min_cost,
+                'max_quote': max_cost,
+                'times_finalized': finalized.get(vendor_name, 0)
+            })
+        vendors_list.sort(key=lambda x: x['total_quoted'], reverse=True)
+
+        return jsonify({'status': 'success', 'vendors': vendors_list})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/asset_requests/items', methods=['GET'])
+def get_asset_request_items():
+    """Find indent line items by item name or vendor, with SQL-side totals"""
+    try:
+        user_email = session.get('user')
+        user = User.query.filter_by(email=user_email).first()
+        if not user:
+            return jsonify({'status': 'error', 'message': 'User not authenticated'}), 401
+
+        user_roles = [role.name for role in user.roles]
+        if not any(role in ['Procurement', 'Accounts', 'Director', 'Managing Director', 'Admin'] for role in user_roles):
+            return jsonify({'status': 'error', 'message': 'Unauthorized access'}), 403
+
+        name = request.args.get('name', '').strip()
+        vendor = request.args.get('vendor', '').strip()
+
+        query = db.session.query(AssetRequestItem, AssetRequest.status).join(
+            AssetRequest, AssetRequest.id == AssetRequestItem.asset_request_id
+        )
+        if name:
+            query = query.filter(AssetRequestItem.name.ilike(f'{name}%'))
+        if vendor:
+            query = query.filter(AssetRequestItem.vendor.ilike(f'{vendor}%'))
+
+        summary = query.with_entities(
+            db.func.count(AssetRequestItem.id),
+            db.func.coalesce(db.func.sum(AssetRequestItem.qty), 0),
+            db.func.coalesce(db.func.sum(AssetRequestItem.total), 0.0)
+        ).one()
+
+        items_list = []
+        for item, status in query.order_by(AssetRequestItem.asset_request_id.desc()).limit(500).all():
+            item_data = asset_item_to_dict(item)
+            item_data['asset_request_id'] = item.asset_request_id
+            item_data['request_status'] = status
+            items_list.append(item_data)
+
+        return jsonify({
+            'status': 'success',
+            'items': items_list,
+            'item_count': summary[0],
+            'total_qty': int(summary[1]),
+            'total_amount': float(summary[2])
+        })
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# === Budget Ledger API Endpoints ===
+@app.route('/api/budget/analytics', methods=['GET'])
+def get_budget_analytics():
+    """Budget utilization per head/project and month, read from the ledger rollups"""
+    try:
+        user_email = session.get('user')
+        user = User.query.filter_by(email=user_email).first()
+        if not user:
+            return jsonify({'status': 'error', 'message': 'User not authenticated'}), 401
+
+        user_roles = [role.name for role in user.roles]
+        if not any(role in ['Accounts', 'Finance', 'Director', 'Managing Director', 'Admin'] for role in user_roles):
+            return jsonify({'status': 'error', 'message': 'Unauthorized access'}), 403
+
+        budget_head = request.args.get('budget_head')
+        project_id = request.args.get('project_id', type=int)
+        month = request.args.get('month')  # Format: YYYY-MM
+
+        if budget_head:
+            ledger = get_budget_ledger(budget_head, project_id, create=False)
+            ledgers = [ledger] if ledger else []
+        else:
+            ledgers = BudgetLedger.query.order_by(BudgetLedger.budget_head).all()
+
+        ledger_ids = [ledger.id for ledger in ledgers]
+        monthly_query = BudgetMonthlyUtilization.query.filter(BudgetMonthlyUtilization.ledger_id.in_(ledger_ids)) if ledger_ids else None
+        monthly_by_ledger = {}
+        if monthly_query is not None:
+            if month:
+                monthly_query = monthly_query.filter_by(month=month)
+            for row in monthly_query.order_by(BudgetMonthlyUtilization.month).all():
+                monthly_by_ledger.setdefault(row.ledger_id, []).append({
+                    'month': row.month,
+                    'utilized': row.utilized,
+                    'entry_count': row.entry_count
+                })
+
+        heads = []
+        for ledger in ledgers:
+            head_data = budget_ledger_to_dict(ledger)
+            head_data['monthly'] = monthly_by_ledger.get(ledger.id, [])
+            heads.append(head_data)
+
+        return jsonify({'status': 'success', 'budget_heads': heads})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/budget/allocate', methods=['POST'])
+def allocate_budget():
+    """Set the allocation for a budget head/project and recompute its balance"""
+    try:
+        user_email = session.get('user')
+        user = User.query.filter_by(email=user_email).first()
+        if not user:
+            return jsonify({'status': 'error', 'message': 'User not authenticated'}), 401
+
+        user_roles = [role.name for role in user.roles]
+        if not any(role in ['Accounts', 'Finance', 'Admin'] for role in user_roles):
+            return jsonify({'status': 'error', 'message': 'Unauthorized access'}), 403
+
+        data = request.get_json()
+        budget_head = data.get('budget_head')
+        allocated = _to_float(data.get('allocated'), None)
+        if not budget_head or allocated is None:
+            return jsonify({'status': 'error', 'message': 'budget_head and allocated are required'}), 400
+
+        ledger = get_budget_ledger(budget_head, data.get('project_id'))
+        ledger.allocated = allocated
+        ledger.balance = allocated - (ledger.utilized or 0.0)
+        db.session.commit()
+
+        return jsonify({'status': 'success', 'message': 'Budget allocation saved', 'budget': budget_ledger_to_dict(ledger)})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/user/roles')
+def api_get_user_roles():
+    user_email = session.get('user')
+    user = User.query.filter_by(email=user_email).first()
+    if not user:
+        return jsonify({'status': 'error', 'message': 'User not authenticated'}), 401
+    roles = [role.name for role in user.roles]
+    return jsonify({'status': 'success', 'roles': roles})
+
+@app.route('/api/project/<int:project_id>/tasks', methods=['POST'])
+def create_project_task(project_id):
+    user_email = session.get('user')
     user = User.query.filter_by(email=user_email).first()
     project = PersonalProject.query.filter_by(id=project_id, user_id=user.id).first()
     if not project:
@@ -4555,6 +5984,7 @@ def update_asset_request_status(request_id):
         # --- Stage 2: Procurement Details ---
         elif req.status == 'Pending Procurement Approval' and 'Procurement' in user_roles and role == 'Procurement':
             req.procurement_items = json.dumps(update_data.get('procurement_items'))
+            sync_procurement_quotes(req, update_data.get('procurement_items'))
             req.status = 'Pending TL Final Approval'
             # (Email notification logic for Team Lead for final approval here)
             db.session.commit()
@@ -4615,6 +6045,15 @@ def update_asset_request_status(request_id):
             req.branch_name = update_data.get('branchName')
             req.account_holder_name = update_data.get('accountHolderName')
             req.status = 'Pending Final Delivery'
+
+            # Post the approved spend to the budget ledger in the same transaction
+            allocation = safe_float_convert(str(update_data.get('budgetAllocation') or '').replace(',', ''))
+            ledger = post_budget_utilization(req, user.id, allocation)
+            if ledger:
+                if not req.budget_utilized:
+                    req.budget_utilized = f"{ledger.utilized:.2f}"
+                if not req.available_balance:
+                    req.available_balance = f"{ledger.balance:.2f}"
             db.session.commit()
             procurement_users = User.query.join(User.roles).filter(Role.name == 'Procurement').all()
             for proc_user in procurement_users:
@@ -4694,26 +6133,32 @@ def toggle_task(task_id):
 
 
 ##------salaries endpoints------
-def _fetch_attendance_data_from_firestore(month_year_str, company):
+def _stream_firestore_attendance(month_year_str, company):
     records = []
-    try:
-        docs = db_firestore.collection(month_year_str).stream()
+    docs = db_firestore.collection(month_year_str).stream()
+
+    for doc in docs:
+        # We assume your attendance data is in a subcollection named 'door_access'
+        subcollection_ref = doc.reference.collection('door_access')
+        sub_docs = subcollection_ref.stream()
+        for sub_doc in sub_docs:
+            sub_doc_data = sub_doc.to_dict()
+            
+            # Check for an exact match of the normalized branch name.
+            if sub_doc_data.get('Branch', '').lower() == company.lower():
+                records.append(sub_doc_data)
+    
+    return records
 
-        for doc in docs:
-            # We assume your attendance data is in a subcollection named 'door_access'
-            subcollection_ref = doc.reference.collection('door_access')
-            sub_docs = subcollection_ref.stream()
-            for sub_doc in sub_docs:
-                sub_doc_data = sub_doc.to_dict()
-                
-                # Check for an exact match of the normalized branch name.
-                if sub_doc_data.get('Branch', '').lower() == company.lower():
-                    records.append(sub_doc_data)
-        
-        return records
-    except Exception as e:
-        print(f"Error fetching from Firestore for {month_year_str}: {e}")
-        return None
+@single_flight('firestore-attendance', CIRCUIT_BREAKERS['firestore'].timeout)
+def _scan_firestore_attendance(month_year_str, company):
+    if db_firestore is None:
+        raise RuntimeError('Firestore client is not initialized')
+    return CIRCUIT_BREAKERS['firestore'].call(_stream_firestore_attendance, month_year_str, company)
+
+def _fetch_attendance_data_from_firestore(month_year_str, company):
+    return guarded_fetch('firestore', f'firestore:{month_year_str}:{company.lower()}',
+                         _scan_firestore_attendance, month_year_str, company)
 
 @app.route('/api/download_attendance_report', methods=['GET'])
 def download_attendance_report():
@@ -5382,16 +6827,18 @@ if __name__ == '__main__':
 @app.route('/api/holidays', methods=['GET'])
 def get_holidays():
     try:
-        holidays = Holiday.query.order_by(Holiday.date.asc()).all()
-        holidays_data = []
-        for holiday in holidays:
-            holidays_data.append({
+        def build():
+            holidays = Holiday.query.order_by(Holiday.day.asc(), Holiday.date.asc()).all()
+            return [{
                 'id': holiday.id,
                 'name': holiday.name,
                 'date': holiday.date,
                 'created_by': holiday.creator.name if holiday.creator else 'Unknown',
                 'created_at': holiday.created_at.strftime('%Y-%m-%d %H:%M:%S')
-            })
+            } for holiday in holidays]
+
+        # Creator names come from user rows, so renames invalidate the list too
+        holidays_data = cache_get_or_set('holidays:all', build, tags=('table:holiday', 'table:user'))
         return jsonify({'status': 'success', 'holidays': holidays_data})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -5563,15 +7010,11 @@ def get_evaluation_team_leads():
             return jsonify({'status': 'error', 'message': 'User not authenticated'}), 401
         
         # Get users with Team Lead role
-        team_leads = User.query.join(User.roles).filter(Role.name == 'Team Lead').all()
-        
-        team_lead_data = []
-        for tl in team_leads:
-            team_lead_data.append({
-                'id': tl.id,
-                'name': tl.name,
-                'email': tl.email
-            })
+        def build():
+            team_leads = User.query.join(User.roles).filter(Role.name == 'Team Lead').all()
+            return [{'id': tl.id, 'name': tl.name, 'email': tl.email} for tl in team_leads]
+
+        team_lead_data = cache_get_or_set('team_leads:all', build, tags=('table:user', 'table:role'))
         
         return jsonify({'status': 'success', 'team_leads': team_lead_data})
         
@@ -5591,6 +7034,10 @@ def submit_evaluation():
         
         if not user:
             return jsonify({'status': 'error', 'message': 'User not found'}), 404
+
+        signature_error = check_signature(data.get('signature'))
+        if signature_error:
+            return jsonify({'status': 'error', 'message': signature_error}), 400
         
         # Create evaluation report
         evaluation_report = EvaluationReport(
@@ -5649,6 +7096,8 @@ def submit_evaluation():
         )
         
         db.session.add(self_evaluation)
+        db.session.flush()
+        refresh_evaluation_summaries([evaluation_report.id])
         db.session.commit()
         
         return jsonify({'status': 'success', 'message': 'Evaluation submitted successfully', 'evaluation_id': evaluation_report.id})
@@ -5745,6 +7194,23 @@ def get_evaluation_reports():
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+def can_view_evaluation_report(user, user_roles, report):
+    """Whether user may open an evaluation report, based on role and report status"""
+    # Team Lead access: Reports assigned to user as Team Lead (any status)
+    if 'Team Lead' in user_roles and report.team_lead_id == user.id:
+        return True
+    # HR access: Reports with status 'Team Lead has Reviewed' (not assigned to user as Team Lead) or 'HR has Reviewed' (HR's own submissions)
+    if 'HR' in user_roles and ((report.status == 'Team Lead has Reviewed' and report.team_lead_id != user.id) or report.status == 'HR has Reviewed'):
+        return True
+    # Director access: Reports with status 'HR has Reviewed' or 'Completed' (not assigned to user as Team Lead) or 'Director has Reviewed' (Director's own submissions)
+    if 'Director' in user_roles and ((report.status in ['HR has Reviewed', 'Completed'] and report.team_lead_id != user.id) or report.status == 'Director has Reviewed'):
+        return True
+    # Fourth priority: Managing Director (only if not previous cases)
+    if is_managing_director(user_roles) and report.status == 'Director has Reviewed':
+        return True
+    # Last priority: Employee (always allow access to their own reports)
+    return 'Employee' in user_roles and report.employee_id == user.id
+
 @app.route('/api/evaluation/report/<int:report_id>')
 def get_evaluation_report(report_id):
     """Get specific evaluation report details with all previous evaluations"""
@@ -5765,40 +7231,24 @@ def get_evaluation_report(report_id):
         
         # Check if user has permission to view this report
         user_roles = [role.name for role in user.roles]
-        can_view = False
-        
-        # Allow access based on user roles and report assignment/status
-        
-        # Team Lead access: Reports assigned to user as Team Lead (any status)
-        if 'Team Lead' in user_roles and report.team_lead_id == user.id:
-            can_view = True
-        # HR access: Reports with status 'Team Lead has Reviewed' (not assigned to user as Team Lead) or 'HR has Reviewed' (HR's own submissions)
-        elif 'HR' in user_roles and ((report.status == 'Team Lead has Reviewed' and report.team_lead_id != user.id) or report.status == 'HR has Reviewed'):
-            can_view = True
-        # Director access: Reports with status 'HR has Reviewed' or 'Completed' (not assigned to user as Team Lead) or 'Director has Reviewed' (Director's own submissions)
-        elif 'Director' in user_roles and ((report.status in ['HR has Reviewed', 'Completed'] and report.team_lead_id != user.id) or report.status == 'Director has Reviewed'):
-            can_view = True
-        # Fourth priority: Managing Director (only if not previous cases)
-        elif is_managing_director(user_roles) and report.status == 'Director has Reviewed':
-            can_view = True
-        # Last priority: Employee (always allow access to their own reports)
-        elif 'Employee' in user_roles and report.employee_id == user.id:
-            can_view = True
-        
-        if not can_view:
+        if not can_view_evaluation_report(user, user_roles, report):
             return jsonify({'status': 'error', 'message': 'Access denied'}), 403
         
-        # Get all evaluation responses for this report
-        responses = EvaluationResponse.query.filter_by(evaluation_report_id=report_id).all()
+        # Get all evaluation responses for this report; the signature column
+        # stays deferred, only whether one exists is selected
+        responses = db.session.query(EvaluationResponse, EvaluationResponse.signature.isnot(None)) \
+            .filter(EvaluationResponse.evaluation_report_id == report_id) \
+            .order_by(EvaluationResponse.id).all()
         
         # Organize responses by page number
         evaluations = {}
-        for response in responses:
+        for response, has_signature in responses:
             evaluations[response.page_number] = {
                 'evaluator_role': response.evaluator_role,
                 'evaluator_name': response.evaluator_name,
                 'evaluation_date': response.evaluation_date.strftime('%Y-%m-%d') if response.evaluation_date else None,
-                'signature': response.signature,
+                'has_signature': bool(has_signature),
+                'signature_url': url_for('get_evaluation_signature', report_id=report_id, page_number=response.page_number) if has_signature else None,
                 'attendance_score': response.attendance_score,
                 'attendance_comments': response.attendance_comments,
                 'discipline_score': response.discipline_score,
@@ -5879,6 +7329,77 @@ def get_evaluation_report(report_id):
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+# Drawn signatures are raster data URLs. Anything else served from our origin
+# (image/svg+xml in particular) could carry script, so it is refused on save
+# and never served inline.
+SIGNATURE_DATA_URL_RE = re.compile(r'data:([\w.+-]+/[\w.+-]+);base64,')
+SIGNATURE_IMAGE_TYPES = {'image/png', 'image/jpeg'}
+
+def check_signature(signature):
+    """Error message for a signature data URL that is not PNG/JPEG base64, else None"""
+    if not isinstance(signature, str):
+        return None if signature is None else 'Signature must be a string'
+    match = SIGNATURE_DATA_URL_RE.match(signature)
+    if not match and not signature.startswith('data:'):
+        return None  # typed signature
+    if not match or match.group(1).lower() not in SIGNATURE_IMAGE_TYPES:
+        return 'Signature images must be PNG or JPEG data URLs'
+    try:
+        base64.b64decode(signature[match.end():], validate=True)
+    except (binascii.Error, ValueError):
+        return 'Signature image is not valid base64'
+    return None
+
+@app.route('/api/evaluation/report/<int:report_id>/signature/<int:page_number>')
+def get_evaluation_signature(report_id, page_number):
+    """Serve the signature for one page of an evaluation report.
+
+    Drawn signatures (data:image/...;base64 URLs) are returned as image bytes so
+    they can be used directly as an <img> src; typed signatures come back as JSON.
+    """
+    try:
+        if 'user' not in session:
+            return jsonify({'status': 'error', 'message': 'User not authenticated'}), 401
+        
+        user = User.query.filter_by(email=session['user']).first()
+        if not user:
+            return jsonify({'status': 'error', 'message': 'User not found'}), 404
+        
+        report = EvaluationReport.query.get(report_id)
+        if not report:
+            return jsonify({'status': 'error', 'message': 'Report not found'}), 404
+        if not can_view_evaluation_report(user, [role.name for role in user.roles], report):
+            return jsonify({'status': 'error', 'message': 'Access denied'}), 403
+        
+        signature = db.session.query(EvaluationResponse.signature).filter(
+            EvaluationResponse.evaluation_report_id == report_id,
+            EvaluationResponse.page_number == page_number,
+            EvaluationResponse.signature.isnot(None)
+        ).order_by(EvaluationResponse.id.desc()).limit(1).scalar()
+        if signature is None:
+            return jsonify({'status': 'error', 'message': 'Signature not found'}), 404
+        
+        match = SIGNATURE_DATA_URL_RE.match(signature)
+        if not match:
+            return jsonify({'status': 'success', 'signature': signature})
+        mimetype = match.group(1).lower()
+        if mimetype not in SIGNATURE_IMAGE_TYPES:
+            # Stored before uploads were restricted; never serve it inline
+            return jsonify({'status': 'error', 'message': f'Signature type {mimetype} is not served'}), 415
+        try:
+            image = base64.b64decode(signature[match.end():], validate=False)
+        except (binascii.Error, ValueError):
+            return jsonify({'status': 'error', 'message': 'Stored signature is not valid base64'}), 500
+        response = Response(image, mimetype=mimetype)
+        response.headers['Cache-Control'] = 'private, max-age=3600'
+        response.headers['X-Content-Type-Options'] = 'nosniff'
+        response.headers['Content-Security-Policy'] = "default-src 'none'"
+        response.set_etag(hashlib.sha256(image).hexdigest())
+        return response.make_conditional(request)
+        
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 @app.route('/api/evaluation/submit_response', methods=['POST'])
 def submit_evaluation_response():
     """Submit evaluation response (Team Lead, HR, Director, MD)"""
@@ -5892,6 +7413,10 @@ def submit_evaluation_response():
         
         if not user:
             return jsonify({'status': 'error', 'message': 'User not found'}), 404
+
+        signature_error = check_signature(data.get('signature'))
+        if signature_error:
+            return jsonify({'status': 'error', 'message': signature_error}), 400
         
         # Get the evaluation report
         report = EvaluationReport.query.get(data.get('evaluation_report_id'))
@@ -6021,6 +7546,8 @@ def submit_evaluation_response():
         elif evaluator_role == 'Managing Director':
             report.status = 'Completed'
         
+        db.session.flush()
+        refresh_evaluation_summaries([report.id])
         db.session.commit()
         
         return jsonify({'status': 'success', 'message': f'{evaluator_role} evaluation submitted successfully'})
@@ -6034,17 +7561,17 @@ def submit_evaluation_response():
 def get_vendors():
     """Get all vendors for dropdown"""
     try:
-        vendors = Vendor.query.all()
-        vendors_list = []
-        for vendor in vendors:
-            vendors_list.append({
+        def build():
+            return [{
                 'id': vendor.id,
                 'name': vendor.name,
                 'address': vendor.address,
                 'contact_no': vendor.contact_no,
                 'email': vendor.email,
                 'gst_number': vendor.gst_number
-            })
+            } for vendor in Vendor.query.all()]
+
+        vendors_list = cache_get_or_set('vendors:all', build, tags=('table:vendor',))
         return jsonify({'status': 'success', 'vendors': vendors_list})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -6135,6 +7662,2421 @@ def update_vendor(vendor_id):
         db.session.rollback()
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+# === Search Index (SQLite FTS5) ===
+# One FTS5 table holds a document per searchable row. The rowid encodes the
+# entity type and primary key so updates and deletes are single-row lookups.
+# Announcements carry their audience (target roles, target emails, expiry) in
+# UNINDEXED columns so search applies the same visibility as /api/announcements.
+SEARCH_ENTITY_CODES = {'employee': 1, 'leave': 2, 'permission': 3, 'travel': 4, 'vendor': 5, 'announcement': 6}
+SEARCH_REQUEST_TYPES = ('leave', 'permission', 'travel')
+SEARCH_SNIPPET_MARKS = ('\x02', '\x03')  # highlight sentinels, swapped for <b>/</b> after escaping
+search_enabled = False
+
+def _search_rowid(entity_type, entity_id):
+    return (SEARCH_ENTITY_CODES[entity_type] << 40) | int(entity_id)
+
+def _join_text(*parts):
+    return ' '.join(str(p) for p in parts if p)
+
+def _search_document(obj):
+    """Return (entity_type, id, title, body, owner_id, lead_id) for an indexable row, or None"""
+    if isinstance(obj, EmployeeInfo):
+        if obj.is_deleted:
+            return None
+        return ('employee', obj.id, obj.full_name, _join_text(obj.designation, obj.office_branch, obj.employee_id, obj.email), obj.user_id, None)
+    if isinstance(obj, LeaveRequest):
+        return ('leave', obj.id, obj.applicant_name, _join_text(obj.reason, obj.department, obj.emp_no), obj.user_id, obj.team_lead_id)
+    if isinstance(obj, PermissionRequest):
+        return ('permission', obj.id, obj.applicant_name, _join_text(obj.reason, obj.going_to), obj.user_id, obj.team_lead_id)
+    if isinstance(obj, TravelRequest):
+        return ('travel', obj.id, obj.company, obj.purpose, obj.user_id, None)
+    if isinstance(obj, Vendor):
+        return ('vendor', obj.id, obj.name, _join_text(obj.gst_number, obj.address, obj.email), None, None)
+    if isinstance(obj, Announcement):
+        if not obj.is_active:
+            return None
+        return ('announcement', obj.id, obj.title, obj.content, obj.author_id, None)
+    return None
+
+_SEARCH_MODELS = {EmployeeInfo: 'employee', LeaveRequest: 'leave', PermissionRequest: 'permission',
+                  TravelRequest: 'travel', Vendor: 'vendor', Announcement: 'announcement'}
+
+def _search_audience(obj):
+    """(roles, emails, expires_at) columns restricting who may find obj; empty strings mean no restriction"""
+    if not isinstance(obj, Announcement):
+        return '', '', ''
+    # '|a|b|' so a single instr() tests membership
+    roles = ''.join(f'|{role}' for role in _load_json_list(obj.target_roles))
+    emails = ''.join(f'|{email}' for email in _load_json_list(obj.target_users))
+    expires = obj.expires_at.strftime('%Y-%m-%d %H:%M:%S') if obj.expires_at else ''
+    return roles + '|' if roles else '', emails + '|' if emails else '', expires
+
+def _search_row(doc, audience):
+    entity_type, entity_id, title, body, owner_id, lead_id = doc
+    roles, emails, expires = audience
+    return {'rowid': _search_rowid(entity_type, entity_id), 'entity_type': entity_type, 'entity_id': entity_id,
+            'title': title or '', 'body': body or '', 'owner_id': owner_id, 'lead_id': lead_id,
+            'audience_roles': roles, 'audience_emails': emails, 'expires_at': expires}
+
+SEARCH_INSERT_SQL = """
+    INSERT INTO search_index (rowid, title, body, entity_type, entity_id, owner_id, lead_id,
+                              audience_roles, audience_emails, expires_at)
+    VALUES (:rowid, :title, :body, :entity_type, :entity_id, :owner_id, :lead_id,
+            :audience_roles, :audience_emails, :expires_at)
+"""
+
+def _collect_search_change(op, obj):
+    entity_type = _SEARCH_MODELS.get(type(obj))
+    if not entity_type or obj.id is None:
+        return None
+    doc = None if op == 'delete' else _search_document(obj)
+    # A missing document means the row was deleted or is no longer searchable
+    return ('upsert', _search_row(doc, _search_audience(obj))) if doc else ('delete', _search_rowid(entity_type, obj.id))
+
+def _apply_search_changes(changes):
+    if not search_enabled:
+        return
+    with db.engine.begin() as conn:
+        for op, value in changes:
+            rowid = value['rowid'] if op == 'upsert' else value
+            conn.execute(text("DELETE FROM search_index WHERE rowid = :rowid"), {'rowid': rowid})
+            if op == 'upsert':
+                conn.execute(text(SEARCH_INSERT_SQL), value)
+
+register_commit_hook(_collect_search_change, _apply_search_changes)
+
+def index_search_rows(model, ids):
+    """Index rows written with Core inserts, which bypass the commit hooks"""
+    if not search_enabled or not ids:
+        return
+    changes = [_collect_search_change('insert', obj) for obj in model.query.filter(model.id.in_(ids))]
+    _apply_search_changes([change for change in changes if change])
+
+def rebuild_search_index():
+    """Drop and repopulate the search index from the source tables"""
+    with db.engine.begin() as conn:
+        conn.execute(text("DELETE FROM search_index"))
+        for model in _SEARCH_MODELS:
+            rows = [_search_row(doc, _search_audience(obj))
+                    for obj in model.query.yield_per(500) for doc in [_search_document(obj)] if doc]
+            if rows:
+                conn.execute(text(SEARCH_INSERT_SQL), rows)
+        conn.execute(text("INSERT INTO search_index (search_index) VALUES ('optimize')"))
+
+def _fts_query(raw):
+    """Turn free text into an FTS5 prefix query; every term must match"""
+    terms = [t.replace('"', '') for t in raw.split()]
+    return ' '.join(f'"{t}"*' for t in terms if t)
+
+def _search_snippet(raw):
+    """HTML-escape an FTS snippet, then turn the highlight sentinels into <b> tags"""
+    start, end = SEARCH_SNIPPET_MARKS
+    return html.escape(raw or '').replace(start, '<b>').replace(end, '</b>')
+
+with app.app_context():
+    try:
+        with db.engine.begin() as conn:
+            columns = [row[1] for row in conn.execute(text("PRAGMA table_info(search_index)"))]
+            if columns and 'audience_roles' not in columns:
+                conn.execute(text("DROP TABLE search_index"))  # pre-audience layout; rebuilt below
+            conn.execute(text("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+                    title, body,
+                    entity_type UNINDEXED, entity_id UNINDEXED, owner_id UNINDEXED, lead_id UNINDEXED,
+                    audience_roles UNINDEXED, audience_emails UNINDEXED, expires_at UNINDEXED,
+                    tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+                )
+            """))
+            is_empty = conn.execute(text("SELECT 1 FROM search_index LIMIT 1")).first() is None
+        search_enabled = True
+        if is_empty:
+            rebuild_search_index()
+    except Exception as e:
+        print(f"Search index unavailable: {e}")
+
+@app.route('/api/search', methods=['GET'])
+def search():
+    """Ranked full-text search across employees, requests, vendors and announcements"""
+    user_email = session.get('user')
+    if not user_email:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+
+    user = User.query.filter_by(email=user_email).first()
+    if not user:
+        return jsonify({'status': 'error', 'message': 'User not found'}), 404
+
+    if not search_enabled:
+        return jsonify({'status': 'error', 'message': 'Search is not available'}), 503
+
+    match = _fts_query(request.args.get('q', ''))
+    if not match:
+        return jsonify({'status': 'error', 'message': 'Search query is required'}), 400
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+    user_roles = [role.name for role in user.roles]
+
+    conditions = ["search_index MATCH :match"]
+    params = {'match': match, 'user_id': user.id}
+
+    entity_type = request.args.get('type')
+    if entity_type:
+        if entity_type not in SEARCH_ENTITY_CODES:
+            return jsonify({'status': 'error', 'message': 'Invalid search type'}), 400
+        conditions.append("entity_type = :entity_type")
+        params['entity_type'] = entity_type
+
+    # Leave/permission/travel requests are only visible to the applicant,
+    # their team lead and HR/Director/Admin/MD
+    if not (any(role in ['HR', 'Director', 'Admin'] for role in user_roles) or is_managing_director(user_roles)):
+        conditions.append("(entity_type NOT IN ('leave', 'permission', 'travel') OR owner_id = :user_id OR lead_id = :user_id)")
+
+    # Announcements: same audience and expiry rules as get_announcements
+    audience = ["(audience_roles = '' AND audience_emails = '')", "instr(audience_emails, :audience_email) > 0"]
+    for position, role in enumerate(user_roles):
+        audience.append(f"instr(audience_roles, :audience_role_{position}) > 0")
+        params[f'audience_role_{position}'] = f'|{role}|'
+    params['audience_email'] = f'|{user_email}|'
+    params['now'] = datetime.now(indian_tz).strftime('%Y-%m-%d %H:%M:%S')
+    conditions.append(f"(entity_type != 'announcement' OR (({' OR '.join(audience)}) "
+                      "AND (expires_at = '' OR expires_at >= :now)))")
+
+    where = ' AND '.join(conditions)
+    try:
+        total = db.session.execute(text(f"SELECT count(*) FROM search_index WHERE {where}"), params).scalar()
+        rows = db.session.execute(text(f"""
+            SELECT entity_type, entity_id, title,
+                   snippet(search_index, 1, :mark_start, :mark_end, '...', 12) AS snippet,
+                   bm25(search_index, 10.0, 1.0) AS score
+            FROM search_index
+            WHERE {where}
+            ORDER BY score
+            LIMIT :limit OFFSET :offset
+        """), dict(params, limit=per_page, offset=(page - 1) * per_page,
+                  mark_start=SEARCH_SNIPPET_MARKS[0], mark_end=SEARCH_SNIPPET_MARKS[1])).all()
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+    results = [{
+        'type': row.entity_type,
+        'id': row.entity_id,
+        'title': row.title,
+        'snippet': _search_snippet(row.snippet),
+        'score': round(-row.score, 4)
+    } for row in rows]
+
+    return jsonify({'status': 'success', 'query': request.args.get('q'), 'page': page, 'per_page': per_page,
+                    'total': total, 'results': results})
+
+@app.route('/api/search/rebuild', methods=['POST'])
+def rebuild_search():
+    """Rebuild the search index from scratch (Admin only)"""
+    user_email = session.get('user')
+    if not user_email:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+
+    user = User.query.filter_by(email=user_email).first()
+    if not user or 'Admin' not in [role.name for role in user.roles]:
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 403
+
+    if not search_enabled:
+        return jsonify({'status': 'error', 'message': 'Search is not available'}), 503
+
+    try:
+        rebuild_search_index()
+        return jsonify({'status': 'success', 'message': 'Search index rebuilt'})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# === Event Stream (Server-Sent Events) ===
+# Committed status changes are written to EventLog and pushed to this
+# worker's subscribers straight away. A background thread tails EventLog
+# for rows written by other Passenger workers so every process sees them.
+EVENT_POLL_INTERVAL = 1.0  # seconds between EventLog tails
+EVENT_KEEPALIVE = 15  # seconds between SSE keepalive comments
+# An open stream holds a request thread for its whole life, so serve it from a
+# threaded server (Passenger with several threads per worker, gunicorn gthread);
+# with single-threaded workers each open dashboard pins a whole process. Streams
+# are closed after EVENT_STREAM_MAX_SECONDS; EventSource reconnects by itself
+# and picks up missed events through Last-Event-ID.
+EVENT_STREAM_MAX_SECONDS = int(os.environ.get('EVENT_STREAM_MAX_SECONDS', 300))
+EVENT_RECONNECT_MS = 1000  # retry hint sent just before a stream is closed on schedule
+EVENT_LOG_RETENTION = 5000  # rows kept for Last-Event-ID replay
+EVENT_QUEUE_SIZE = 500
+
+_EVENT_REQUEST_MODELS = {LeaveRequest: 'leave', PermissionRequest: 'permission', TravelRequest: 'travel', AssetRequest: 'asset'}
+_EVENT_REVIEWER_ROLES = {'leave': ['HR', 'Director'], 'permission': ['HR', 'Director'], 'travel': ['Director'], 'asset': []}
+
+_event_subscribers = {}  # queue -> {'user_id', 'email', 'roles'}
+_event_lock = threading.Lock()
+_event_tail_state = {'pid': None, 'last_id': 0}
+
+def _attr_changed(obj, *names):
+    state = inspect(obj)
+    return any(state.attrs[name].history.has_changes() for name in names)
+
+def _pending_role(status):
+    """Map an approval status such as 'Pending TL Final Approval' to the role that acts on it"""
+    if status == 'Pending Final Delivery':
+        return 'Procurement'
+    if not status or not status.startswith('Pending ') or not status.endswith(' Approval'):
+        return None
+    role = status[len('Pending '):-len(' Approval')].replace(' Final', '')
+    return 'Team Lead' if role == 'TL' else role
+
+def _request_status_event(kind, request_id, status, owner_id, team_lead_id=None):
+    roles = list(_EVENT_REVIEWER_ROLES[kind])
+    pending_role = _pending_role(status)
+    if pending_role:
+        roles.append(pending_role)
+    return (f'{kind}_status', {'type': kind, 'id': request_id, 'status': status},
+            {'users': [owner_id, team_lead_id], 'roles': roles})
+
+def _collect_event(op, obj):
+    """Build a (kind, payload, audience) delta for changes clients care about"""
+    if op == 'delete':
+        return None
+
+    kind = _EVENT_REQUEST_MODELS.get(type(obj))
+    if kind:
+        if op == 'update' and not _attr_changed(obj, 'status'):
+            return None
+        owner_id = obj.indenter_id if kind == 'asset' else obj.user_id
+        return _request_status_event(kind, obj.id, obj.status, owner_id, getattr(obj, 'team_lead_id', None))
+
+    if isinstance(obj, ConveyanceRequest):
+        if op == 'update' and not _attr_changed(obj, 'status_hr', 'status_accounts'):
+            return None
+        return ('conveyance_status', {'type': 'conveyance', 'id': obj.id, 'status_hr': obj.status_hr, 'status_accounts': obj.status_accounts},
+                {'users': [obj.user_id], 'roles': ['HR', 'Accounts']})
+
+    if isinstance(obj, Task):
+        if op == 'update' and not _attr_changed(obj, 'status', 'assigned_to_id'):
+            return None
+        return ('task', {'id': obj.id, 'task_name': obj.task_name, 'status': obj.status, 'op': op},
+                {'users': [obj.assigned_to_id, obj.assigned_by_id]})
+
+    if isinstance(obj, Announcement):
+        if op == 'insert' and not obj.is_active:
+            return None
+        if op == 'update' and not _attr_changed(obj, 'title', 'content', 'is_active', 'priority'):
+            return None
+        target_roles = _load_json_list(obj.target_roles)
+        target_users = _load_json_list(obj.target_users)
+        return ('announcement', {'id': obj.id, 'title': obj.title, 'priority': obj.priority, 'is_active': obj.is_active, 'op': op},
+                {'users': [obj.author_id], 'roles': target_roles, 'emails': target_users, 'all': not target_roles and not target_users})
+
+    return None
+
+def _event_visible(audience, subscriber):
+    return bool(audience.get('all')) or \
+        subscriber['user_id'] in audience.get('users', []) or \
+        subscriber['email'] in audience.get('emails', []) or \
+        any(role in subscriber['roles'] for role in audience.get('roles', []))
+
+def _deliver_event(event_id, kind, payload, audience):
+    with _event_lock:
+        subscribers = list(_event_subscribers.items())
+    for q, subscriber in subscribers:
+        if _event_visible(audience, subscriber):
+            try:
+                q.put_nowait((event_id, kind, payload))
+            except queue.Full:
+                pass  # slow client; it can resync with Last-Event-ID
+
+def _publish_events(events):
+    now = datetime.now(indian_tz)
+    rows = []
+    for kind, payload, audience in events:
+        audience['users'] = [u for u in audience.get('users', []) if u]
+        rows.append({'kind': kind, 'payload': json.dumps(payload), 'audience': json.dumps(audience),
+                     'origin_pid': os.getpid(), 'created_at': now})
+    with db.engine.begin() as conn:
+        conn.execute(EventLog.__table__.insert(), rows)
+        # The write lock is held, so the new rows take the top len(rows) ids in order
+        last_id = conn.execute(db.select(db.func.max(EventLog.id))).scalar()
+        event_ids = range(last_id - len(rows) + 1, last_id + 1)
+        conn.execute(EventLog.__table__.delete().where(EventLog.id <= last_id - EVENT_LOG_RETENTION))
+    delivered = [(event_id, kind, payload, audience) for event_id, (kind, payload, audience) in zip(event_ids, events)]
+    for event_row in delivered:
+        _deliver_event(*event_row)
+
+register_commit_hook(_collect_event, _publish_events)
+
+def _read_event_log(after_id, limit=500):
+    with db.engine.connect() as conn:
+        return conn.execute(
+            EventLog.__table__.select().where(EventLog.id > after_id).order_by(EventLog.id).limit(limit)
+        ).all()
+
+def _tail_event_log():
+    """Forward events committed by other worker processes to local subscribers"""
+    pid = os.getpid()
+    while True:
+        time.sleep(EVENT_POLL_INTERVAL)
+        try:
+            with app.app_context():
+                rows = _read_event_log(_event_tail_state['last_id'])
+        except Exception as e:
+            print(f"Event log tail failed: {e}")
+            continue
+        for row in rows:
+            _event_tail_state['last_id'] = row.id
+            if row.origin_pid != pid:
+                _deliver_event(row.id, row.kind, json.loads(row.payload), json.loads(row.audience))
+
+def _ensure_event_tail():
+    # Started lazily so each forked worker gets its own thread
+    with _event_lock:
+        if _event_tail_state['pid'] == os.getpid():
+            return
+        _event_tail_state['pid'] = os.getpid()
+        _event_tail_state['last_id'] = db.session.query(db.func.max(EventLog.id)).scalar() or 0
+    threading.Thread(target=_tail_event_log, name='event-log-tail', daemon=True).start()
+
+@app.route('/api/events/stream')
+def event_stream():
+    """SSE stream of status changes, announcements and task assignments for the current user"""
+    user_email = session.get('user')
+    if not user_email:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+
+    user = User.query.filter_by(email=user_email).first()
+    if not user:
+        return jsonify({'status': 'error', 'message': 'User not found'}), 404
+
+    subscriber = {'user_id': user.id, 'email': user.email, 'roles': [role.name for role in user.roles]}
+
+    _ensure_event_tail()
+    q = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+    with _event_lock:
+        _event_subscribers[q] = subscriber
+
+    # Replay anything missed since the client's last event (EventSource reconnects)
+    backlog = []
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if last_event_id and last_event_id.isdigit():
+        cursor = int(last_event_id)
+        for row in _read_event_log(cursor, limit=EVENT_QUEUE_SIZE):
+            if _event_visible(json.loads(row.audience), subscriber):
+                backlog.append((row.id, row.kind, json.loads(row.payload)))
+    else:
+        cursor = db.session.query(db.func.max(EventLog.id)).scalar() or 0
+
+    def format_event(event_id, kind, payload):
+        return f"id: {event_id}\nevent: {kind}\ndata: {json.dumps(payload)}\n\n"
+
+    def generate():
+        last_sent = cursor
+        deadline = time.monotonic() + EVENT_STREAM_MAX_SECONDS
+        try:
+            yield f"retry: {EVENT_KEEPALIVE * 1000}\n\n"
+            replayed_up_to = backlog[-1][0] if backlog else 0
+            for event_row in backlog:
+                yield format_event(*event_row)
+                last_sent = max(last_sent, event_row[0])
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event_row = q.get(timeout=min(EVENT_KEEPALIVE, remaining))
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event_row[0] > replayed_up_to:  # skip events already replayed
+                    yield format_event(*event_row)
+                    last_sent = max(last_sent, event_row[0])
+            # Free the thread; the id-only event sets the client's Last-Event-ID
+            # so the reconnect replays whatever lands in between
+            yield f"retry: {EVENT_RECONNECT_MS}\nid: {last_sent}\n\n"
+        finally:
+            with _event_lock:
+                _event_subscribers.pop(q, None)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# === Bulk Approval Endpoint ===
+# Workflow for leave/permission/travel approvals, keyed by current status.
+# Mirrors the single-request approve_* endpoints above.
+BULK_TRANSITION_MODELS = {'leave': LeaveRequest, 'permission': PermissionRequest, 'travel': TravelRequest}
+BULK_TRANSITIONS = {
+    'leave': {
+        'Pending': {'role': 'Team Lead', 'assigned_only': True, 'next': 'Pending HR Approval',
+                    'sign': 'reporting_authority_sign', 'date': 'reporting_authority_date', 'remarks': 'remarks'},
+        'Pending HR Approval': {'role': 'HR', 'next': 'Pending Director Approval', 'sign': 'hr_sign', 'date': 'hr_date'},
+        'Pending Director Approval': {'role': 'Director', 'next': 'Approved',
+                                      'sign': 'director_sign', 'date': 'director_date', 'remarks': 'remarks'},
+    },
+    'permission': {
+        'Pending': {'role': 'Team Lead', 'assigned_only': True, 'next': 'Pending HR Approval', 'sign': 'team_lead_sign'},
+        'Pending HR Approval': {'role': 'HR', 'next': 'Pending Director Approval', 'sign': 'hr_sign'},
+        'Pending Director Approval': {'role': 'Director', 'next': 'Approved', 'sign': 'director_sign'},
+    },
+    'travel': {
+        'Pending Director Approval': {'role': 'Director', 'next': 'Approved', 'sign': 'director_sign'},
+    },
+}
+BULK_TRANSITION_LIMIT = 500
+
+@app.route('/api/requests/bulk_transition', methods=['POST'])
+def bulk_transition_requests():
+    """Approve or reject many leave/permission/travel requests in one transaction"""
+    user_email = session.get('user')
+    if not user_email:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+
+    user = User.query.filter_by(email=user_email).first()
+    if not user:
+        return jsonify({'status': 'error', 'message': 'User not found'}), 404
+
+    data = request.get_json() or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'status': 'error', 'message': 'items must be a non-empty list'}), 400
+    if len(items) > BULK_TRANSITION_LIMIT:
+        return jsonify({'status': 'error', 'message': f'At most {BULK_TRANSITION_LIMIT} items per call'}), 400
+
+    user_roles = [role.name for role in user.roles]
+    today = datetime.now(indian_tz).strftime('%Y-%m-%d')
+    results = [None] * len(items)
+
+    # Validate the shape of each item before touching the database
+    ids_by_type = {}
+    for index, item in enumerate(items):
+        kind = item.get('type') if isinstance(item, dict) else None
+        request_id = item.get('id') if isinstance(item, dict) else None
+        if kind not in BULK_TRANSITION_MODELS or not isinstance(request_id, int):
+            results[index] = {'type': kind, 'id': request_id, 'status': 'error', 'message': 'Invalid type or id'}
+        elif item.get('action') not in ('approve', 'reject'):
+            results[index] = {'type': kind, 'id': request_id, 'status': 'error', 'message': 'Invalid action'}
+        else:
+            ids_by_type.setdefault(kind, set()).add(request_id)
+
+    try:
+        # One UNION ALL query fetches the current state of every referenced request
+        current = {}
+        if ids_by_type:
+            selects = []
+            for kind, ids in ids_by_type.items():
+                model = BULK_TRANSITION_MODELS[kind]
+                team_lead_col = model.team_lead_id if hasattr(model, 'team_lead_id') else db.null()
+                selects.append(db.select(db.literal(kind).label('kind'), model.id.label('id'), model.status.label('status'),
+                                         model.user_id.label('user_id'), team_lead_col.label('team_lead_id'))
+                               .where(model.id.in_(ids)))
+            query = selects[0] if len(selects) == 1 else db.union_all(*selects)
+            current = {(row.kind, row.id): row for row in db.session.execute(query)}
+
+        # Group allowed transitions so each distinct change is one conditional UPDATE
+        groups = {}
+        seen = set()
+        for index, item in enumerate(items):
+            if results[index]:
+                continue
+            kind, request_id, action = item['type'], item['id'], item['action']
+            row = current.get((kind, request_id))
+            if (kind, request_id) in seen:
+                results[index] = {'type': kind, 'id': request_id, 'status': 'error', 'message': 'Duplicate item'}
+                continue
+            seen.add((kind, request_id))
+            if not row:
+                results[index] = {'type': kind, 'id': request_id, 'status': 'error', 'message': 'Request not found'}
+                continue
+            rule = BULK_TRANSITIONS[kind].get(row.status)
+            if not rule:
+                results[index] = {'type': kind, 'id': request_id, 'status': 'error', 'message': f'Request is {row.status}'}
+                continue
+            if rule['role'] not in user_roles or (rule.get('assigned_only') and row.team_lead_id != user.id):
+                results[index] = {'type': kind, 'id': request_id, 'status': 'error', 'message': 'Not authorized to approve this request'}
+                continue
+
+            values = {'status': rule['next'] if action == 'approve' else 'Rejected'}
+            if item.get('sign') is not None:
+                values[rule['sign']] = item['sign']
+            if rule.get('date'):
+                values[rule['date']] = item.get('date') or today
+            if rule.get('remarks') and item.get('remarks') is not None:
+                values[rule['remarks']] = item['remarks']
+
+            key = (kind, row.status, tuple(sorted(values.items())))
+            groups.setdefault(key, []).append(index)
+
+        events = []
+        cache_tags = set()
+        for (kind, from_status, values), indexes in groups.items():
+            model = BULK_TRANSITION_MODELS[kind]
+            values = dict(values)
+            ids = [items[i]['id'] for i in indexes]
+            # The status guard means a concurrent change leaves some rows untouched;
+            # RETURNING names exactly the rows this statement moved
+            updated_ids = set(db.session.execute(
+                db.update(model).where(model.id.in_(ids), model.status == from_status).values(**values)
+                .returning(model.id).execution_options(synchronize_session=False)
+            ).scalars())
+            for i in indexes:
+                request_id = items[i]['id']
+                if request_id in updated_ids:
+                    row = current[(kind, request_id)]
+                    results[i] = {'type': kind, 'id': request_id, 'status': 'success', 'new_status': values['status']}
+                    events.append(_request_status_event(kind, request_id, values['status'], row.user_id, row.team_lead_id))
+                    cache_tags.update((f'table:{model.__tablename__}', f'user:{row.user_id}'))
+                else:
+                    results[i] = {'type': kind, 'id': request_id, 'status': 'error', 'message': 'Request was changed by another user'}
+
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+    # Core UPDATEs bypass the ORM commit hooks, so publish the deltas directly
+    cache_invalidate(*cache_tags)
+    if events:
+        try:
+            _publish_events(events)
+        except Exception as e:
+            print(f"Bulk transition event publish failed: {e}")
+
+    succeeded = sum(1 for r in results if r['status'] == 'success')
+    return jsonify({'status': 'success', 'succeeded': succeeded, 'failed': len(results) - succeeded, 'results': results})
+
+# === Bulk Employee Import ===
+EMPLOYEE_IMPORT_BATCH_SIZE = 500
+# Columns that are not set from an import sheet
+EMPLOYEE_IMPORT_SKIP = {'id', 'user_id', 'is_deleted', 'provident_fund', 'professional_tax', 'pdc', 'aadhaar_card',
+                        'pan_card', 'resume', 'passport_photo', 'tenth_certificate', 'twelfth_certificate',
+                        'post_graduation_certificate', 'birth_date'}
+EMPLOYEE_IMPORT_DATE_STRINGS = {'dob'}  # String columns that hold a YYYY-MM-DD date
+
+def _import_header(name):
+    return str(name or '').strip().lower().replace(' ', '_')
+
+def _iter_import_rows(upload):
+    """Yield (row_number, dict) from a CSV or XLSX upload without loading it all"""
+    filename = (upload.filename or '').lower()
+    if filename.endswith('.csv'):
+        reader = csv.reader(io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline=''))
+        headers = [_import_header(h) for h in next(reader, [])]
+        for row_number, values in enumerate(reader, start=2):
+            if any(v.strip() for v in values):
+                yield row_number, dict(zip(headers, values))
+    elif filename.endswith('.xlsx'):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise ValueError('XLSX import requires openpyxl')
+        workbook = load_workbook(upload.stream, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            headers = [_import_header(h) for h in next(rows, ())]
+            for row_number, values in enumerate(rows, start=2):
+                if any(v not in (None, '') for v in values):
+                    yield row_number, dict(zip(headers, values))
+        finally:
+            workbook.close()
+    else:
+        raise ValueError('Upload a .csv or .xlsx file')
+
+def _coerce_import_value(column, raw):
+    """Convert a sheet cell to the column's type; returns (value, error)"""
+    if raw is None or (isinstance(raw, str) and not raw.strip()):
+        return None, None
+    if isinstance(column.type, (db.Date, db.DateTime)) or column.name in EMPLOYEE_IMPORT_DATE_STRINGS:
+        value = safe_date_convert(raw.strftime('%Y-%m-%d') if hasattr(raw, 'strftime') else str(raw).strip())
+        if value is None:
+            return None, f'{column.name}: expected YYYY-MM-DD'
+        return (value.isoformat() if column.name in EMPLOYEE_IMPORT_DATE_STRINGS else value), None
+    if isinstance(column.type, db.Float):
+        value = _to_float(raw, None)
+        return (value, None) if value is not None else (None, f'{column.name}: expected a number')
+    if isinstance(column.type, db.Integer):
+        value = _to_int(raw, None)
+        return (value, None) if value is not None else (None, f'{column.name}: expected a whole number')
+    value = str(raw).strip()
+    if value.endswith('.0') and isinstance(raw, float):
+        value = value[:-2]  # Excel stores numeric IDs and phone numbers as floats
+    length = getattr(column.type, 'length', None)
+    if length and len(value) > length:
+        return None, f'{column.name}: longer than {length} characters'
+    return value, None
+
+def _validate_import_row(row):
+    """Map a sheet row onto EmployeeInfo columns; returns (values, errors)"""
+    values, errors = {}, []
+    for column in EmployeeInfo.__table__.columns:
+        if column.name in EMPLOYEE_IMPORT_SKIP:
+            continue
+        value, error = _coerce_import_value(column, row.get(column.name))
+        if error:
+            errors.append(error)
+        values[column.name] = value
+    if not values.get('full_name'):
+        errors.append('full_name is required')
+    if not values.get('email') or '@' not in values['email']:
+        errors.append('a valid email is required')
+    else:
+        values['email'] = values['email'].lower()
+    values['is_deleted'] = False
+    values['birth_date'] = parse_date_value(values.get('dob'))
+    values['provident_fund'] = calculate_provident_fund(values.get('basic'))
+    values['professional_tax'] = calculate_professional_tax(values.get('actual_gross_salary'))
+    return values, errors
+
+def _import_employee_batch(batch, create_users, password_hash, employee_role_id, dry_run):
+    """Resolve users for one batch with set-based queries and insert with executemany"""
+    errors = []
+    emails = [values['email'] for _, values, _ in batch]
+    users = {email.lower(): user_id for user_id, email in db.session.query(User.id, User.email)
+             .filter(db.func.lower(User.email).in_(emails))}
+    existing_info = {user_id for (user_id,) in db.session.query(EmployeeInfo.user_id)
+                     .filter(EmployeeInfo.user_id.in_(list(users.values())))}
+    existing_info_emails = {email.lower() for (email,) in db.session.query(EmployeeInfo.email)
+                            .filter(db.func.lower(EmployeeInfo.email).in_(emails))}
+
+    ready, new_users = [], []
+    for row_number, values, pf_no in batch:
+        user_id = users.get(values['email'])
+        if user_id in existing_info or values['email'] in existing_info_emails:
+            errors.append({'row': row_number, 'email': values['email'], 'errors': ['Employee info already exists']})
+        elif user_id is None and not create_users:
+            errors.append({'row': row_number, 'email': values['email'], 'errors': ['User not found; create the user first or enable create_users']})
+        else:
+            if user_id is None:
+                new_users.append({'name': values['full_name'], 'username': values['email'].split('@')[0], 'email': values['email'],
+                                  'password': password_hash, 'created_by_admin': True, 'pf_no': pf_no, 'is_deleted': False})
+            ready.append((values, pf_no))
+
+    if dry_run or not ready:
+        return len(ready), len(new_users), errors, []
+
+    if new_users:
+        db.session.execute(User.__table__.insert(), new_users)
+        created = {email.lower(): user_id for user_id, email in db.session.query(User.id, User.email)
+                   .filter(User.email.in_([u['email'] for u in new_users]))}
+        users.update(created)
+        if employee_role_id:
+            db.session.execute(user_roles.insert(), [{'user_id': user_id, 'role_id': employee_role_id} for user_id in created.values()])
+
+    rows = []
+    pf_updates = []
+    for values, pf_no in ready:
+        rows.append(dict(values, user_id=users[values['email']]))
+        if pf_no:
+            pf_updates.append({'uid': users[values['email']], 'pf_no': pf_no})
+    db.session.execute(EmployeeInfo.__table__.insert(), rows)
+    if pf_updates:
+        db.session.execute(User.__table__.update().where(User.id == db.bindparam('uid')).values(pf_no=db.bindparam('pf_no')), pf_updates)
+    return len(ready), len(new_users), errors, [row['user_id'] for row in rows]
+
+@app.route('/api/employees/import', methods=['POST'])
+def import_employees():
+    """Bulk import EmployeeInfo rows from a CSV/XLSX upload (HR/Admin only)"""
+    user_email = session.get('user')
+    if not user_email:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+
+    user = User.query.filter_by(email=user_email).first()
+    if not user or not any(role.name in ['HR', 'Admin'] for role in user.roles):
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 403
+
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({'status': 'error', 'message': 'No file uploaded'}), 400
+
+    batch_size = min(max(request.form.get('batch_size', EMPLOYEE_IMPORT_BATCH_SIZE, type=int), 1), 5000)
+    dry_run = request.form.get('dry_run') in ('1', 'true', 'yes')
+    create_users = request.form.get('create_users') in ('1', 'true', 'yes')
+    password_hash = None
+    employee_role = None
+    if create_users and not dry_run:
+        default_password = request.form.get('default_password')
+        if not default_password:
+            return jsonify({'status': 'error', 'message': 'default_password is required when create_users is set'}), 400
+        # Hashed once; every new account gets the same initial password
+        password_hash = generate_password_hash(default_password)
+        employee_role = Role.query.filter_by(name='Employee').first()
+
+    report = []
+    imported = users_created = total_rows = 0
+    seen_emails = set()
+    batch = []
+
+    def flush_batch():
+        nonlocal imported, users_created
+        count, created, errors, user_ids = _import_employee_batch(
+            batch, create_users, password_hash, employee_role.id if employee_role else None, dry_run)
+        if not dry_run:
+            db.session.commit()
+            cache_invalidate('table:user', 'table:employee_info')
+            index_search_rows(EmployeeInfo, [info_id for (info_id,) in db.session.query(EmployeeInfo.id)
+                                             .filter(EmployeeInfo.user_id.in_(user_ids))] if user_ids else [])
+        imported += count
+        users_created += created
+        report.extend(errors)
+        batch.clear()
+
+    try:
+        for row_number, row in _iter_import_rows(upload):
+            total_rows += 1
+            values, errors = _validate_import_row(row)
+            if not errors and values['email'] in seen_emails:
+                errors.append('duplicate email in file')
+            if errors:
+                report.append({'row': row_number, 'email': values.get('email'), 'errors': errors})
+                continue
+            seen_emails.add(values['email'])
+            pf_no, _ = _coerce_import_value(User.__table__.c.pf_no, row.get('pf_no'))
+            batch.append((row_number, values, pf_no))
+            if len(batch) >= batch_size:
+                flush_batch()
+        if batch:
+            flush_batch()
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': str(e), 'imported': imported, 'errors': report}), 500
+
+    report.sort(key=lambda r: r['row'])
+    return jsonify({
+        'status': 'success',
+        'dry_run': dry_run,
+        'total_rows': total_rows,
+        'imported': imported,
+        'users_created': users_created,
+        'failed': len(report),
+        'errors': report
+    })
+
+# === Payroll Run Engine ===
+PAYROLL_EARNINGS = ['basic', 'hra', 'conveyance', 'vehicle_maintenance', 'special_allowance', 'add_others']
+PAYROLL_FIXED_DEDUCTIONS = ['esi', 'income_tax', 'advance', 'other_deductions']
+PAYROLL_LINE_COLUMNS = [c.name for c in PayrollLine.__table__.columns if c.name not in ('id', 'run_id')]
+
+def load_payroll_frame():
+    """Load earnings/deduction columns for all active employees into a DataFrame"""
+    columns = [EmployeeInfo.id.label('employee_info_id'), EmployeeInfo.user_id, EmployeeInfo.full_name,
+               EmployeeInfo.employee_id, EmployeeInfo.designation, EmployeeInfo.office_branch,
+               EmployeeInfo.account_number, EmployeeInfo.actual_gross_salary, EmployeeInfo.loss_of_pay,
+               EmployeeInfo.no_of_lop_days, EmployeeInfo.total_days, EmployeeInfo.ndp]
+    columns += [getattr(EmployeeInfo, name) for name in PAYROLL_EARNINGS + PAYROLL_FIXED_DEDUCTIONS]
+    columns += [getattr(EmployeeInfo, f'earnings_{name}') for name in PAYROLL_EARNINGS]
+    query = db.session.query(*columns).filter(EmployeeInfo.is_deleted == False)
+    return pd.DataFrame.from_records(query.all(), columns=[c.key for c in columns])
+
+def compute_payroll(frame):
+    """Vectorized payroll for a frame from load_payroll_frame.
+
+    Earnings use the earnings_* columns, falling back to the actuals. LOP is
+    the actual gross per day times LOP days (no_of_lop_days, else
+    total_days - ndp); an existing manual loss_of_pay is kept when neither is
+    known. PF and PT follow calculate_provident_fund/calculate_professional_tax.
+    """
+    out = frame[['employee_info_id', 'user_id', 'full_name', 'employee_id', 'designation',
+                 'office_branch', 'account_number']].copy()
+
+    for name in PAYROLL_EARNINGS:
+        out[name] = frame[f'earnings_{name}'].astype(float).fillna(frame[name].astype(float)).fillna(0.0)
+    out['total_earnings'] = out[PAYROLL_EARNINGS].sum(axis=1)
+
+    actual_gross = frame['actual_gross_salary'].astype(float)
+    actual_gross = actual_gross.fillna(frame[PAYROLL_EARNINGS].astype(float).fillna(0.0).sum(axis=1))
+
+    total_days = frame['total_days'].astype(float)
+    ndp = frame['ndp'].astype(float)
+    lop_days = frame['no_of_lop_days'].astype(float).fillna((total_days - ndp).clip(lower=0))
+    days = total_days.where(total_days > 0, 30.0)
+    computed_lop = (actual_gross / days * lop_days).round(2)
+    out['total_days'] = frame['total_days']
+    out['ndp'] = frame['ndp']
+    out['lop_days'] = lop_days.fillna(0.0)
+    out['loss_of_pay'] = computed_lop.fillna(frame['loss_of_pay'].astype(float)).fillna(0.0)
+
+    basic = out['basic'].to_numpy()
+    out['provident_fund'] = np.where(basic >= 15000, 15000 * 0.12, basic * 0.12)
+    out['professional_tax'] = np.select([actual_gross > 20000, actual_gross >= 15001], [200.0, 150.0], 0.0)
+    for name in PAYROLL_FIXED_DEDUCTIONS:
+        out[name] = frame[name].astype(float).fillna(0.0)
+
+    out['total_deductions'] = out[['provident_fund', 'professional_tax', 'loss_of_pay'] + PAYROLL_FIXED_DEDUCTIONS].sum(axis=1)
+    out['net_pay'] = (out['total_earnings'] - out['total_deductions']).round(2)
+    return out
+
+def _payroll_records(frame):
+    # NaN/NA -> None and NumPy scalars -> Python types for the DB driver
+    frame = frame[PAYROLL_LINE_COLUMNS].astype(object)
+    return frame.where(frame.notna(), None).to_dict('records')
+
+def payroll_run_to_dict(run):
+    return {
+        'id': run.id,
+        'month': run.month,
+        'version': run.version,
+        'employee_count': run.employee_count,
+        'total_earnings': run.total_earnings,
+        'total_deductions': run.total_deductions,
+        'total_net_pay': run.total_net_pay,
+        'created_by': run.created_by,
+        'created_at': run.created_at.strftime('%Y-%m-%d %H:%M') if run.created_at else None
+    }
+
+def _payroll_user():
+    user_email = session.get('user')
+    user = User.query.filter_by(email=user_email).first() if user_email else None
+    if not user or not any(role.name in ['HR', 'Accounts', 'Finance', 'Admin'] for role in user.roles):
+        return None
+    return user
+
+@app.route('/api/payroll/run', methods=['POST'])
+def run_payroll():
+    """Compute payroll for every active employee and store it as a new versioned snapshot"""
+    user = _payroll_user()
+    if not user:
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 403
+
+    data = request.get_json(silent=True) or {}
+    month = data.get('month') or datetime.now(indian_tz).strftime('%Y-%m')
+    try:
+        datetime.strptime(month, '%Y-%m')
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'month must be YYYY-MM'}), 400
+
+    try:
+        frame = load_payroll_frame()
+        started = time.perf_counter()
+        payroll = compute_payroll(frame)
+        compute_ms = round((time.perf_counter() - started) * 1000, 2)
+
+        totals = {
+            'employee_count': len(payroll),
+            'total_earnings': round(float(payroll['total_earnings'].sum()), 2),
+            'total_deductions': round(float(payroll['total_deductions'].sum()), 2),
+            'total_net_pay': round(float(payroll['net_pay'].sum()), 2)
+        }
+        if data.get('dry_run'):
+            return jsonify({'status': 'success', 'dry_run': True, 'month': month, 'compute_ms': compute_ms, **totals})
+
+        begin_immediate()  # max(version) + 1 below is read-then-insert
+        version = (db.session.query(db.func.max(PayrollRun.version)).filter_by(month=month).scalar() or 0) + 1
+        run = PayrollRun(month=month, version=version, created_by=user.id, **totals)
+        db.session.add(run)
+        db.session.flush()
+
+        records = _payroll_records(payroll)
+        for record in records:
+            record['run_id'] = run.id
+        if records:
+            db.session.execute(PayrollLine.__table__.insert(), records)
+        db.session.commit()
+
+        return jsonify({'status': 'success', 'run': payroll_run_to_dict(run), 'compute_ms': compute_ms})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/payroll/runs', methods=['GET'])
+def get_payroll_runs():
+    """List payroll snapshots, newest first, optionally for one month"""
+    if not _payroll_user():
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 403
+
+    query = PayrollRun.query
+    if request.args.get('month'):
+        query = query.filter_by(month=request.args.get('month'))
+    runs = query.order_by(PayrollRun.month.desc(), PayrollRun.version.desc()).all()
+    return jsonify({'status': 'success', 'runs': [payroll_run_to_dict(run) for run in runs]})
+
+@app.route('/api/payroll/runs/<int:run_id>', methods=['GET'])
+def get_payroll_run(run_id):
+    """Payroll snapshot header and lines"""
+    if not _payroll_user():
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 403
+
+    run = PayrollRun.query.get(run_id)
+    if not run:
+        return jsonify({'status': 'error', 'message': 'Payroll run not found'}), 404
+
+    lines = db.session.execute(
+        db.select(*[PayrollLine.__table__.c[name] for name in PAYROLL_LINE_COLUMNS])
+        .where(PayrollLine.run_id == run_id).order_by(PayrollLine.full_name)
+    ).mappings().all()
+    return jsonify({'status': 'success', 'run': payroll_run_to_dict(run), 'lines': [dict(line) for line in lines]})
+
+# === Payslip PDFs ===
+PAYSLIP_WORKERS = int(os.environ.get('PAYSLIP_WORKERS', len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 2))
+PAYSLIP_SERIAL_THRESHOLD = 8  # below this, starting the job process costs more than it saves
+class _ZipStreamBuffer:
+    """Write-only sink for zipfile; bytes are drained after each member so the ZIP streams"""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def _render_payslips(lines):
+    """Yield (name, pdf) in order; large batches render in a payslip_pdf job process.
+
+    Forking a pool straight from this (multithreaded) worker could copy held
+    locks and open SQLite handles into the children, so the pool lives in a
+    fresh process that only imports reportlab.
+    """
+    if len(lines) < PAYSLIP_SERIAL_THRESHOLD or PAYSLIP_WORKERS < 2 or 'fork' not in multiprocessing.get_all_start_methods():
+        yield from map(render_payslip_pdf, lines)
+        return
+    workers = min(PAYSLIP_WORKERS, len(lines))
+    job = subprocess.Popen([sys.executable, '-m', 'payslip_pdf', '--workers', str(workers)],
+                           cwd=basedir, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        # The job reads every line before writing, so this cannot block on a full stdout pipe
+        pickle.dump(lines, job.stdin, protocol=pickle.HIGHEST_PROTOCOL)
+        job.stdin.close()
+        for _ in range(len(lines)):
+            try:
+                yield pickle.load(job.stdout)
+            except EOFError:
+                raise RuntimeError(f'Payslip job exited early with code {job.wait()}')
+        job.stdout.close()
+        if job.wait():
+            raise RuntimeError(f'Payslip job failed with code {job.returncode}')
+    finally:
+        if job.poll() is None:
+            job.kill()
+            job.wait()
+
+@app.route('/api/payroll/runs/<int:run_id>/payslips', methods=['GET'])
+def download_payslips(run_id):
+    """Stream a ZIP with one payslip PDF per employee in a payroll snapshot"""
+    if not _payroll_user():
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 403
+
+    run = PayrollRun.query.get(run_id)
+    if not run:
+        return jsonify({'status': 'error', 'message': 'Payroll run not found'}), 404
+
+    query = db.session.query(PayrollLine, User.pf_no, EmployeeInfo.date_of_joining, EmployeeInfo.total_leaves) \
+        .join(User, User.id == PayrollLine.user_id) \
+        .join(EmployeeInfo, EmployeeInfo.id == PayrollLine.employee_info_id) \
+        .filter(PayrollLine.run_id == run_id)
+    if request.args.get('employee_info_id', type=int):
+        query = query.filter(PayrollLine.employee_info_id == request.args.get('employee_info_id', type=int))
+
+    # Plain dicts so the lines can be pickled to the workers
+    lines = []
+    for line, pf_no, date_of_joining, total_leaves in query.order_by(PayrollLine.full_name):
+        data = {name: getattr(line, name) for name in PAYROLL_LINE_COLUMNS}
+        data.update(month=run.month, pf_no=pf_no, total_leaves=total_leaves,
+                    date_of_joining=date_of_joining.strftime('%d-%m-%Y') if date_of_joining else None)
+        lines.append(data)
+    if not lines:
+        return jsonify({'status': 'error', 'message': 'No payslips in this payroll run'}), 404
+
+    def generate():
+        sink = _ZipStreamBuffer()
+        with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED) as archive:
+            for name, pdf in _render_payslips(lines):
+                archive.writestr(name, pdf)
+                yield sink.drain()
+        yield sink.drain()
+
+    return Response(generate(), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename=payslips_{run.month}_v{run.version}.zip',
+        'X-Accel-Buffering': 'no'
+    })
+
+# === Evaluation Score Summaries ===
+EVALUATION_SCORE_COLUMNS = [c.name for c in EvaluationResponse.__table__.columns if c.name.endswith('_score')]
+EVALUATION_STAGES = {'Employee': 'self', 'Team Lead': 'team_lead', 'HR': 'hr',
+                     'Director': 'director', 'Managing Director': 'md'}
+EVALUATION_STAGE_COLUMNS = [f'{stage}_avg' for stage in EVALUATION_STAGES.values()]
+EVALUATION_GROUPS = {'branch': EvaluationReport.office_branch,
+                     'position': EvaluationReport.position,
+                     'team_lead': EvaluationReport.team_lead_id}
+EVALUATION_SCORE_BINS = 10  # scores are entered on a 1-10 scale
+
+def refresh_evaluation_summaries(report_ids=None):
+    """Recompute EvaluationScoreSummary rows for the given reports (all when None).
+
+    Each response contributes the mean of its non-empty *_score columns; when a
+    stage was submitted more than once the latest response wins. Runs in the
+    caller's transaction so the summary commits together with the response.
+    """
+    columns = [EvaluationResponse.id, EvaluationResponse.evaluation_report_id, EvaluationResponse.evaluator_role]
+    columns += [getattr(EvaluationResponse, name) for name in EVALUATION_SCORE_COLUMNS]
+    query = db.session.query(*columns)
+    summaries = EvaluationScoreSummary.__table__.delete()
+    if report_ids is not None:
+        report_ids = list(report_ids)
+        if not report_ids:
+            return 0
+        query = query.filter(EvaluationResponse.evaluation_report_id.in_(report_ids))
+        summaries = summaries.where(EvaluationScoreSummary.evaluation_report_id.in_(report_ids))
+    frame = pd.DataFrame.from_records(query.all(), columns=[c.key for c in columns])
+    db.session.execute(summaries)
+    if frame.empty:
+        return 0
+
+    frame['stage'] = frame['evaluator_role'].map(EVALUATION_STAGES)
+    frame['avg'] = frame[EVALUATION_SCORE_COLUMNS].astype(float).mean(axis=1)
+    frame = frame.dropna(subset=['stage', 'avg']).sort_values('id')
+    frame = frame.drop_duplicates(['evaluation_report_id', 'stage'], keep='last')
+    stages = frame.pivot(index='evaluation_report_id', columns='stage', values='avg')
+    stages = stages.reindex(columns=list(EVALUATION_STAGES.values()))
+
+    now = datetime.now(indian_tz)
+    rows = []
+    for report_id, values in zip(stages.index, stages.to_numpy(dtype=float)):
+        present = values[~np.isnan(values)]
+        row = {f'{stage}_avg': (None if np.isnan(v) else round(float(v), 2))
+               for stage, v in zip(stages.columns, values)}
+        row.update(evaluation_report_id=int(report_id), overall_avg=round(float(present.mean()), 2),
+                   stages_completed=int(present.size), updated_at=now)
+        rows.append(row)
+    if rows:
+        db.session.execute(EvaluationScoreSummary.__table__.insert(), rows)
+    return len(rows)
+
+def _score_group_stats(groups, values, n_groups):
+    """Vectorized count/mean/std/min/max/quartiles/histogram per group index"""
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    sums = np.bincount(groups, weights=values, minlength=n_groups)
+    squares = np.bincount(groups, weights=values * values, minlength=n_groups)
+    mean = sums / counts
+    std = np.sqrt(np.maximum(squares / counts - mean * mean, 0.0))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    def quantile(q):
+        # Linear interpolation inside each group's sorted slice
+        pos = starts + q * (counts - 1)
+        lo = np.floor(pos).astype(int)
+        hi = np.ceil(pos).astype(int)
+        return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+    # Bin k (1-based) holds averages in (k-1, k]
+    buckets = np.clip(np.ceil(values).astype(int), 1, EVALUATION_SCORE_BINS) - 1
+    histogram = np.bincount(groups * EVALUATION_SCORE_BINS + buckets,
+                            minlength=n_groups * EVALUATION_SCORE_BINS).reshape(n_groups, EVALUATION_SCORE_BINS)
+    return {
+        'count': counts, 'mean': mean, 'std': std,
+        'min': values[starts], 'max': values[starts + counts - 1],
+        'p25': quantile(0.25), 'median': quantile(0.5), 'p75': quantile(0.75),
+        'histogram': histogram,
+    }
+
+def _score_stats_row(stats, index):
+    row = {key: round(float(stats[key][index]), 2) for key in ('mean', 'std', 'min', 'max', 'p25', 'median', 'p75')}
+    row['count'] = int(stats['count'][index])
+    row['histogram'] = stats['histogram'][index].tolist()
+    return row
+
+with app.app_context():
+    try:
+        missing = db.session.query(EvaluationReport.id).outerjoin(
+            EvaluationScoreSummary, EvaluationScoreSummary.evaluation_report_id == EvaluationReport.id
+        ).filter(EvaluationScoreSummary.id.is_(None)).all()
+        if missing:
+            refresh_evaluation_summaries([report_id for report_id, in missing])
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Evaluation summary backfill failed: {e}")
+
+@app.route('/api/evaluation/analytics', methods=['GET'])
+def evaluation_analytics():
+    """Score distributions per branch, position or team lead from the summary table"""
+    if 'user' not in session:
+        return jsonify({'status': 'error', 'message': 'User not authenticated'}), 401
+    user = User.query.filter_by(email=session['user']).first()
+    user_roles = [role.name for role in user.roles] if user else []
+    if not (any(role in user_roles for role in ['HR', 'Director', 'Admin']) or is_managing_director(user_roles)):
+        return jsonify({'status': 'error', 'message': 'Access denied'}), 403
+
+    group_by = request.args.get('group_by', 'branch')
+    stage = request.args.get('stage', 'overall')
+    if group_by not in EVALUATION_GROUPS:
+        return jsonify({'status': 'error', 'message': f'group_by must be one of {", ".join(EVALUATION_GROUPS)}'}), 400
+    if stage != 'overall' and stage not in EVALUATION_STAGES.values():
+        return jsonify({'status': 'error', 'message': 'Invalid stage'}), 400
+
+    try:
+        value_columns = [EvaluationScoreSummary.overall_avg]
+        value_columns += [getattr(EvaluationScoreSummary, name) for name in EVALUATION_STAGE_COLUMNS]
+        query = db.session.query(EVALUATION_GROUPS[group_by], *value_columns) \
+            .join(EvaluationReport, EvaluationReport.id == EvaluationScoreSummary.evaluation_report_id)
+        if request.args.get('status'):
+            query = query.filter(EvaluationReport.status == request.args['status'])
+        if request.args.get('employment_status'):
+            query = query.filter(EvaluationReport.employment_status == request.args['employment_status'])
+        rows = query.all()
+
+        keys = np.array(['' if r[0] is None else str(r[0]) for r in rows], dtype=object)
+        scores = np.array([r[1:] for r in rows], dtype=float).reshape(len(rows), len(value_columns))
+        column = 0 if stage == 'overall' else 1 + EVALUATION_STAGE_COLUMNS.index(f'{stage}_avg')
+        scored = ~np.isnan(scores[:, column])
+        keys, scores = keys[scored], scores[scored]
+        values = scores[:, column]
+
+        payload = {'status': 'success', 'group_by': group_by, 'stage': stage,
+                   'evaluations': int(values.size), 'bins': list(range(1, EVALUATION_SCORE_BINS + 1)),
+                   'groups': [], 'overall': None}
+        if not values.size:
+            return jsonify(payload)
+
+        labels, inverse = np.unique(keys, return_inverse=True)
+        stats = _score_group_stats(inverse, values, labels.size)
+        org = _score_group_stats(np.zeros(values.size, dtype=int), values, 1)
+
+        # Per-stage means for each group, ignoring stages a report has not reached
+        stage_scores = scores[:, 1:]
+        reached = ~np.isnan(stage_scores)
+        stage_counts = np.stack([np.bincount(inverse, weights=reached[:, i], minlength=labels.size)
+                                 for i in range(stage_scores.shape[1])], axis=1)
+        stage_sums = np.stack([np.bincount(inverse, weights=np.nan_to_num(stage_scores[:, i]), minlength=labels.size)
+                               for i in range(stage_scores.shape[1])], axis=1)
+        stage_means = np.divide(stage_sums, stage_counts, out=np.full(stage_sums.shape, np.nan), where=stage_counts > 0)
+
+        names = {}
+        if group_by == 'team_lead':
+            ids = [int(label) for label in labels if label]
+            names = {str(uid): name for uid, name in db.session.query(User.id, User.name).filter(User.id.in_(ids))}
+
+        groups = []
+        for i, label in enumerate(labels):
+            row = _score_stats_row(stats, i)
+            row['key'] = label or None
+            row['label'] = names.get(label, label) if label else 'Unspecified'
+            row['stage_means'] = {name: (None if np.isnan(v) else round(float(v), 2))
+                                  for name, v in zip(EVALUATION_STAGES.values(), stage_means[i])}
+            groups.append(row)
+        groups.sort(key=lambda g: (-g['mean'], g['label']))
+
+        payload['groups'] = groups
+        payload['overall'] = _score_stats_row(org, 0)
+        return jsonify(payload)
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# === Request Metrics ===
+# Every request records wall time, SQL statement count/time, response size and
+# status per (route, method). Each thread writes only to its own shard, so the
+# hot path takes no locks; /api/_metrics merges the shards when scraped. When a
+# thread exits its shard is folded into a retired aggregate, so thread-per-
+# request servers do not accumulate dead shards.
+# Figures are per process; with several workers each one reports its own.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_WINDOW_SLOTS = 5  # rolling quantiles cover the last 5 one-minute slots
+METRICS_QUANTILES = (0.5, 0.95, 0.99)
+
+# HDR-style log-linear buckets: each power of two from 2^-14 s (~61us) to 2^6 s
+# is split into 4 equal sub-buckets, keeping relative error under 25%.
+_LATENCY_MIN_EXP = -14
+_LATENCY_MAX_EXP = 6
+_LATENCY_SUB_BUCKETS = 4
+LATENCY_BOUNDS = [2.0 ** _LATENCY_MIN_EXP] + [
+    2.0 ** exp * (1 + (sub + 1) / _LATENCY_SUB_BUCKETS)
+    for exp in range(_LATENCY_MIN_EXP, _LATENCY_MAX_EXP)
+    for sub in range(_LATENCY_SUB_BUCKETS)
+]
+
+def _latency_bucket(seconds):
+    """Index into LATENCY_BOUNDS for a duration (len(LATENCY_BOUNDS) is +Inf)"""
+    return bisect.bisect_left(LATENCY_BOUNDS, seconds)
+
+class _RouteMetrics:
+    """Counters for one (route, method) inside one thread's shard"""
+    __slots__ = ('buckets', 'count', 'seconds', 'sql_statements', 'sql_seconds', 'response_bytes',
+                 'statuses', 'window', 'window_minutes')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BOUNDS) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.response_bytes = 0
+        self.statuses = {}
+        self.window = [[0] * (len(LATENCY_BOUNDS) + 1) for _ in range(METRICS_WINDOW_SLOTS)]
+        self.window_minutes = [None] * METRICS_WINDOW_SLOTS
+
+    def record(self, seconds, sql_statements, sql_seconds, response_bytes, status):
+        bucket = _latency_bucket(seconds)
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.sql_statements += sql_statements
+        self.sql_seconds += sql_seconds
+        self.response_bytes += response_bytes
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+        minute = int(time.time() // 60)
+        slot = minute % METRICS_WINDOW_SLOTS
+        if self.window_minutes[slot] != minute:
+            self.window[slot] = [0] * (len(LATENCY_BOUNDS) + 1)
+            self.window_minutes[slot] = minute
+        self.window[slot][bucket] += 1
+
+    def absorb(self, other):
+        """Add the counters of an exited thread's shard"""
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.seconds += other.seconds
+        self.sql_statements += other.sql_statements
+        self.sql_seconds += other.sql_seconds
+        self.response_bytes += other.response_bytes
+        for status, value in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + value
+        for slot, minute in enumerate(other.window_minutes):
+            if minute is None:
+                continue
+            if self.window_minutes[slot] == minute:
+                self.window[slot] = [a + b for a, b in zip(self.window[slot], other.window[slot])]
+            elif self.window_minutes[slot] is None or self.window_minutes[slot] < minute:
+                self.window[slot] = list(other.window[slot])
+                self.window_minutes[slot] = minute
+
+_metrics_local = threading.local()
+_metrics_shards = []  # one {(route, method): _RouteMetrics} dict per live thread
+_metrics_retired = {}  # shards of exited threads, merged
+_shards_lock = threading.RLock()  # shard registration/retirement and scrapes only
+
+class _ThreadSentinel:
+    """Kept in a thread-local; finalized when its thread exits"""
+    __slots__ = ('__weakref__',)
+
+def _retire_shard(shard, shards, retired):
+    with _shards_lock:
+        for key, stats in shard.items():
+            if key in retired:
+                retired[key].absorb(stats)
+            else:
+                retired[key] = stats
+        shards.remove(shard)
+
+def _thread_shard(attr, shards, retired):
+    """This thread's shard, registered in shards and folded into retired when the thread exits"""
+    shard = getattr(_metrics_local, attr, None)
+    if shard is None:
+        shard, sentinel = {}, _ThreadSentinel()
+        setattr(_metrics_local, attr, shard)
+        setattr(_metrics_local, attr + '_sentinel', sentinel)
+        with _shards_lock:
+            shards.append(shard)
+        weakref.finalize(sentinel, _retire_shard, shard, shards, retired)
+    return shard
+
+def _metrics_shard():
+    return _thread_shard('shard', _metrics_shards, _metrics_retired)
+
+with app.app_context():
+    @event.listens_for(db.engine, 'before_cursor_execute')
+    def _metrics_before_cursor(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(db.engine, 'after_cursor_execute')
+    def _metrics_after_cursor(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_query_start'].pop()
+        sql = getattr(_metrics_local, 'sql', None)
+        if sql is not None:  # only statements issued while serving a request
+            sql[0] += 1
+            sql[1] += elapsed
+        record_query_stats(cursor, statement, parameters, executemany, elapsed)
+
+@app.before_request
+def _metrics_start_request():
+    _metrics_local.started = time.perf_counter()
+    _metrics_local.sql = [0, 0.0]
+
+@app.after_request
+def _metrics_finish_request(response):
+    started = getattr(_metrics_local, 'started', None)
+    sql = getattr(_metrics_local, 'sql', None)
+    if started is None or sql is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else '<unmatched>'
+    # Streamed bodies (SSE, ZIP downloads) have no length up front and count as 0
+    size = response.content_length or 0
+    stats = _metrics_shard().get((route, request.method))
+    if stats is None:
+        stats = _metrics_shard()[(route, request.method)] = _RouteMetrics()
+    stats.record(elapsed, sql[0], sql[1], size, response.status_code)
+    response.headers['Server-Timing'] = (f'app;dur={elapsed * 1000:.1f}, '
+                                         f'db;dur={sql[1] * 1000:.1f};desc="{sql[0]} queries"')
+    return response
+
+@app.teardown_request
+def _metrics_end_request(exc):
+    _metrics_local.started = None
+    _metrics_local.sql = None
+
+def _window_quantiles(counts, quantiles):
+    """Bucket upper bounds at the given quantiles of a merged rolling-window histogram"""
+    total = sum(counts)
+    if not total:
+        return {}
+    results, running, q_index = {}, 0, 0
+    for index, value in enumerate(counts):
+        running += value
+        while q_index < len(quantiles) and running >= quantiles[q_index] * total:
+            results[quantiles[q_index]] = LATENCY_BOUNDS[index] if index < len(LATENCY_BOUNDS) else float('inf')
+            q_index += 1
+    return results
+
+def _prometheus_labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+def render_prometheus_metrics():
+    """Merge the per-thread shards into Prometheus text exposition format"""
+    merged = {}
+    current_minute = int(time.time() // 60)
+    with _shards_lock:
+        for shard in list(_metrics_shards) + [_metrics_retired]:
+            for key, stats in list(shard.items()):
+                total = merged.get(key)
+                if total is None:
+                    total = merged[key] = {'buckets': [0] * (len(LATENCY_BOUNDS) + 1), 'count': 0, 'seconds': 0.0,
+                                           'sql_statements': 0, 'sql_seconds': 0.0, 'response_bytes': 0,
+                                           'statuses': {}, 'window': [0] * (len(LATENCY_BOUNDS) + 1)}
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], stats.buckets)]
+                total['count'] += stats.count
+                total['seconds'] += stats.seconds
+                total['sql_statements'] += stats.sql_statements
+                total['sql_seconds'] += stats.sql_seconds
+                total['response_bytes'] += stats.response_bytes
+                for status, value in list(stats.statuses.items()):
+                    total['statuses'][status] = total['statuses'].get(status, 0) + value
+                for minute, counts in zip(list(stats.window_minutes), list(stats.window)):
+                    if minute is not None and current_minute - minute < METRICS_WINDOW_SLOTS:
+                        total['window'] = [a + b for a, b in zip(total['window'], counts)]
+
+    lines = [
+        '# HELP erp_http_request_duration_seconds Request wall time per route.',
+        '# TYPE erp_http_request_duration_seconds histogram',
+    ]
+    for (route, method), total in sorted(merged.items()):
+        running = 0
+        for bound, value in zip(LATENCY_BOUNDS + [float('inf')], total['buckets']):
+            running += value
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'erp_http_request_duration_seconds_bucket{_prometheus_labels(route=route, method=method, le=le)} {running}')
+        labels = _prometheus_labels(route=route, method=method)
+        lines.append(f'erp_http_request_duration_seconds_sum{labels} {total["seconds"]!r}')
+        lines.append(f'erp_http_request_duration_seconds_count{labels} {total["count"]}')
+
+    sections = [
+        ('erp_http_request_duration_window_seconds', 'gauge',
+         f'Request wall time quantiles over the last {METRICS_WINDOW_SLOTS} minutes.'),
+        ('erp_http_requests_total', 'counter', 'Requests per route and status.'),
+        ('erp_http_sql_statements_total', 'counter', 'SQL statements executed while serving the route.'),
+        ('erp_http_sql_duration_seconds_total', 'counter', 'Time spent in SQL statements while serving the route.'),
+        ('erp_http_response_bytes_total', 'counter', 'Response body bytes (streamed bodies excluded).'),
+    ]
+    for name, kind, help_text in sections:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for (route, method), total in sorted(merged.items()):
+            if name == 'erp_http_request_duration_window_seconds':
+                for quantile, value in _window_quantiles(total['window'], METRICS_QUANTILES).items():
+                    lines.append(f'{name}{_prometheus_labels(route=route, method=method, quantile=quantile)} {value!r}')
+            elif name == 'erp_http_requests_total':
+                for status, value in sorted(total['statuses'].items()):
+                    lines.append(f'{name}{_prometheus_labels(route=route, method=method, status=status)} {value}')
+            else:
+                field = {'erp_http_sql_statements_total': 'sql_statements',
+                         'erp_http_sql_duration_seconds_total': 'sql_seconds',
+                         'erp_http_response_bytes_total': 'response_bytes'}[name]
+                lines.append(f'{name}{_prometheus_labels(route=route, method=method)} {total[field]!r}')
+
+    lines.append('# HELP erp_dependency_circuit_open Whether the dependency circuit breaker is open (1) or half-open (0.5).')
+    lines.append('# TYPE erp_dependency_circuit_open gauge')
+    for breaker in CIRCUIT_BREAKERS.values():
+        value = {'closed': 0, 'half_open': 0.5, 'open': 1}[breaker.status()['state']]
+        lines.append(f'erp_dependency_circuit_open{_prometheus_labels(dependency=breaker.name)} {value}')
+    return '\n'.join(lines) + '\n'
+
+def _metrics_auth_error():
+    """Error response unless the caller is an Admin or presents the METRICS_TOKEN bearer"""
+    token = request.headers.get('Authorization', '')
+    if METRICS_TOKEN and hmac.compare_digest(token, f'Bearer {METRICS_TOKEN}'):
+        return None
+    user_email = session.get('user')
+    if not user_email:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    user = User.query.filter_by(email=user_email).first()
+    if not user or 'Admin' not in [role.name for role in user.roles]:
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 403
+    return None
+
+@app.route('/api/_metrics', methods=['GET'])
+def prometheus_metrics():
+    """Per-route request metrics in Prometheus text format (Admin or METRICS_TOKEN bearer)"""
+    denied = _metrics_auth_error()
+    if denied:
+        return denied
+
+    return Response(render_prometheus_metrics(), mimetype='text/plain; version=0.0.4')
+
+# === Query Statistics ===
+# A pg_stat_statements-style collector for SQLite. Statements are grouped by a
+# normalized fingerprint (literals and IN-lists collapsed) and aggregated per
+# thread shard like the request metrics above. Statements slower than
+# SLOW_QUERY_MS are printed together with their EXPLAIN QUERY PLAN.
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+QUERY_STATS_SORTS = {'total': 'total_ms', 'mean': 'mean_ms', 'p99': 'p99_ms', 'max': 'max_ms', 'count': 'count'}
+
+_SQL_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER_RE = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_SQL_IN_LIST_RE = re.compile(r'\bIN\s*\((?:\s*\?\s*,)*\s*\?\s*\)', re.IGNORECASE)
+_SQL_VALUES_RE = re.compile(r'\bVALUES\s*(\([^()]*\))(?:\s*,\s*\([^()]*\))+', re.IGNORECASE)
+_SQL_SPACE_RE = re.compile(r'\s+')
+
+@functools.lru_cache(maxsize=4096)
+def normalize_sql(statement):
+    """Fingerprint a statement: literals become ?, IN-lists and multi-row VALUES collapse"""
+    sql = _SQL_STRING_RE.sub('?', statement)
+    sql = _SQL_NUMBER_RE.sub('?', sql)
+    sql = _SQL_IN_LIST_RE.sub('IN (...)', sql)
+    sql = _SQL_VALUES_RE.sub(r'VALUES \1, ...', sql)
+    return _SQL_SPACE_RE.sub(' ', sql).strip()
+
+class _QueryStats:
+    """Aggregates for one fingerprint inside one thread's shard"""
+    __slots__ = ('buckets', 'count', 'seconds', 'max_seconds', 'rows', 'slow')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BOUNDS) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.slow = 0
+
+    def absorb(self, other):
+        """Add the aggregates of an exited thread's shard"""
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.seconds += other.seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+        self.rows += other.rows
+        self.slow += other.slow
+
+_query_stats_shards = []  # one {fingerprint: _QueryStats} dict per live thread
+_query_stats_retired = {}  # shards of exited threads, merged
+_query_plans = {}  # fingerprint -> last EXPLAIN QUERY PLAN lines
+
+def _query_stats_shard():
+    return _thread_shard('query_shard', _query_stats_shards, _query_stats_retired)
+
+def _explain_query_plan(cursor, statement, parameters):
+    """EXPLAIN QUERY PLAN on a side cursor of the same DBAPI connection"""
+    try:
+        rows = cursor.connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters or ()).fetchall()
+    except Exception as e:
+        return [f'(plan unavailable: {e})']
+    # rows are (id, parent, notused, detail); indent children under parents
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[node_id] + detail)
+    return lines
+
+def record_query_stats(cursor, statement, parameters, executemany, seconds):
+    fingerprint = normalize_sql(statement)
+    shard = _query_stats_shard()
+    stats = shard.get(fingerprint)
+    if stats is None:
+        stats = shard[fingerprint] = _QueryStats()
+    stats.buckets[_latency_bucket(seconds)] += 1
+    stats.count += 1
+    stats.seconds += seconds
+    stats.max_seconds = max(stats.max_seconds, seconds)
+    if cursor.rowcount and cursor.rowcount > 0:  # sqlite3 reports -1 for SELECT
+        stats.rows += cursor.rowcount
+
+    if seconds * 1000 < SLOW_QUERY_MS:
+        return
+    stats.slow += 1
+    if not executemany and fingerprint.upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'WITH ')):
+        _query_plans[fingerprint] = _explain_query_plan(cursor, statement, parameters)
+    plan = '\n'.join('    ' + line for line in _query_plans.get(fingerprint, []))
+    route = request.url_rule.rule if has_request_context() and request.url_rule else '-'
+    print(f"Slow query ({seconds * 1000:.1f} ms, {route}): {fingerprint}" + (f"\n{plan}" if plan else ''))
+
+def query_stats_snapshot(sort='total', limit=50):
+    """Merge the per-thread shards into a list of per-fingerprint summaries"""
+    merged = {}
+    with _shards_lock:
+        for shard in list(_query_stats_shards) + [_query_stats_retired]:
+            for fingerprint, stats in list(shard.items()):
+                total = merged.setdefault(fingerprint, {'buckets': [0] * (len(LATENCY_BOUNDS) + 1), 'count': 0,
+                                                        'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0, 'slow': 0})
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], stats.buckets)]
+                total['count'] += stats.count
+                total['seconds'] += stats.seconds
+                total['max_seconds'] = max(total['max_seconds'], stats.max_seconds)
+                total['rows'] += stats.rows
+                total['slow'] += stats.slow
+
+    results = []
+    for fingerprint, total in merged.items():
+        if not total['count']:
+            continue
+        p99 = _window_quantiles(total['buckets'], (0.99,)).get(0.99, 0.0)
+        results.append({
+            'fingerprint': fingerprint,
+            'count': total['count'],
+            'total_ms': round(total['seconds'] * 1000, 3),
+            'mean_ms': round(total['seconds'] * 1000 / total['count'], 3),
+            'p99_ms': round(min(p99, total['max_seconds']) * 1000, 3),
+            'max_ms': round(total['max_seconds'] * 1000, 3),
+            'rows': total['rows'],
+            'rows_per_call': round(total['rows'] / total['count'], 2),
+            'slow': total['slow'],
+            'plan': _query_plans.get(fingerprint),
+        })
+    results.sort(key=lambda row: row[QUERY_STATS_SORTS.get(sort, 'total_ms')], reverse=True)
+    return results[:limit] if limit else results
+
+def reset_query_stats():
+    with _shards_lock:
+        for shard in list(_query_stats_shards) + [_query_stats_retired]:
+            shard.clear()
+    _query_plans.clear()
+
+@app.route('/api/_query_stats', methods=['GET', 'DELETE'])
+def query_stats():
+    """Per-fingerprint SQL statistics (Admin or METRICS_TOKEN bearer); DELETE resets them"""
+    denied = _metrics_auth_error()
+    if denied:
+        return denied
+
+    if request.method == 'DELETE':
+        reset_query_stats()
+        return jsonify({'status': 'success', 'message': 'Query statistics reset'})
+
+    sort = request.args.get('sort', 'total')
+    if sort not in QUERY_STATS_SORTS:
+        return jsonify({'status': 'error', 'message': f'sort must be one of {", ".join(QUERY_STATS_SORTS)}'}), 400
+    limit = _to_int(request.args.get('limit'), 50)
+    return jsonify({'status': 'success', 'slow_query_ms': SLOW_QUERY_MS, 'pid': os.getpid(),
+                    'statements': query_stats_snapshot(sort, limit)})
+
+# === Shared Cache ===
+# A cache shared by every worker process on the host, stored in a small SQLite
+# file next to the main database. Entries carry a TTL and a set of tags; the
+# commit hook below publishes `table:<name>` and `user:<id>` tags for every
+# committed change, which drops the tagged entries for all workers at once.
+# Each tag also has a version: get_or_set only stores a freshly built value if
+# none of its tags were invalidated while it was being built.
+def _default_shared_cache_path():
+    database = make_url(app.config['SQLALCHEMY_DATABASE_URI']).database
+    if database and database != ':memory:':
+        return database + '-cache'
+    return os.path.join(basedir, 'shared_cache.db')
+
+SHARED_CACHE_PATH = os.environ.get('SHARED_CACHE_PATH') or _default_shared_cache_path()
+SHARED_CACHE_DEFAULT_TTL = int(os.environ.get('SHARED_CACHE_TTL', 300))
+SHARED_CACHE_MAX_ENTRIES = int(os.environ.get('SHARED_CACHE_MAX_ENTRIES', 5000))
+SHARED_CACHE_MAX_BYTES = int(os.environ.get('SHARED_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+SHARED_CACHE_EVICT_EVERY = 64  # sets between LRU sweeps (per process)
+SHARED_CACHE_TOUCH_SECONDS = 5  # coarse last_access updates keep hits read-only most of the time
+_CACHE_MISS = object()
+_cache_local = threading.local()
+_cache_sets = [0]
+
+def _cache_conn():
+    """Per-thread connection to the cache file (reopened after a fork)"""
+    conn = getattr(_cache_local, 'conn', None)
+    if conn is None or _cache_local.pid != os.getpid():
+        conn = sqlite3.connect(SHARED_CACHE_PATH, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS cache_entry (
+                key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,
+                expires_at REAL NOT NULL, last_access REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS ix_cache_entry_last_access ON cache_entry (last_access);
+            CREATE TABLE IF NOT EXISTS cache_tag (
+                tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS ix_cache_tag_key ON cache_tag (key);
+            CREATE TABLE IF NOT EXISTS cache_tag_version (
+                tag TEXT PRIMARY KEY, version INTEGER NOT NULL) WITHOUT ROWID;
+        """)
+        _cache_local.conn, _cache_local.pid = conn, os.getpid()
+    return conn
+
+def _cache_tag_versions(conn, tags):
+    if not tags:
+        return {}
+    rows = conn.execute(f"SELECT tag, version FROM cache_tag_version WHERE tag IN ({','.join('?' * len(tags))})",
+                        list(tags)).fetchall()
+    versions = dict.fromkeys(tags, 0)
+    versions.update(rows)
+    return versions
+
+def cache_get(key):
+    """Cached value for key, or _CACHE_MISS"""
+    try:
+        conn = _cache_conn()
+        row = conn.execute('SELECT value, expires_at, last_access FROM cache_entry WHERE key = ?', (key,)).fetchone()
+        now = time.time()
+        if row is None or row[1] < now:
+            return _CACHE_MISS
+        if now - row[2] > SHARED_CACHE_TOUCH_SECONDS:
+            conn.execute('UPDATE cache_entry SET last_access = ? WHERE key = ?', (now, key))
+        return pickle.loads(row[0])
+    except (sqlite3.Error, pickle.PickleError, EOFError) as e:
+        print(f"Shared cache read failed for {key}: {e}")
+        return _CACHE_MISS
+
+def cache_set(key, value, ttl=None, tags=(), expected_versions=None):
+    """Store value under key; skipped if any tag moved past expected_versions"""
+    blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    now = time.time()
+    tags = sorted(set(tags))
+    try:
+        conn = _cache_conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if expected_versions is not None and _cache_tag_versions(conn, tags) != expected_versions:
+                conn.execute('ROLLBACK')
+                return False
+            conn.execute("""
+                INSERT INTO cache_entry (key, value, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value, size = excluded.size,
+                    expires_at = excluded.expires_at, last_access = excluded.last_access
+            """, (key, blob, len(blob), now + (ttl or SHARED_CACHE_DEFAULT_TTL), now))
+            conn.execute('DELETE FROM cache_tag WHERE key = ?', (key,))
+            conn.executemany('INSERT INTO cache_tag (tag, key) VALUES (?, ?)', [(tag, key) for tag in tags])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+    except sqlite3.Error as e:
+        print(f"Shared cache write failed for {key}: {e}")
+        return False
+
+    _cache_sets[0] += 1
+    if _cache_sets[0] % SHARED_CACHE_EVICT_EVERY == 0:
+        cache_evict()
+    return True
+
+def cache_get_or_set(key, builder, ttl=None, tags=()):
+    """Return the cached value for key, building and storing it on a miss"""
+    value = cache_get(key)
+    if value is not _CACHE_MISS:
+        return value
+    try:
+        versions = _cache_tag_versions(_cache_conn(), sorted(set(tags)))
+    except sqlite3.Error:
+        return builder()
+    value = builder()
+    cache_set(key, value, ttl, tags, expected_versions=versions)
+    return value
+
+def cache_invalidate(*tags):
+    """Drop every entry carrying one of tags, in every worker"""
+    tags = sorted(set(tags))
+    if not tags:
+        return
+    try:
+        conn = _cache_conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany("""
+                INSERT INTO cache_tag_version (tag, version) VALUES (?, 1)
+                ON CONFLICT(tag) DO UPDATE SET version = version + 1
+            """, [(tag,) for tag in tags])
+            placeholders = ','.join('?' * len(tags))
+            conn.execute(f"DELETE FROM cache_entry WHERE key IN (SELECT key FROM cache_tag WHERE tag IN ({placeholders}))", tags)
+            conn.execute(f"DELETE FROM cache_tag WHERE key NOT IN (SELECT key FROM cache_entry)")
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+    except sqlite3.Error as e:
+        print(f"Shared cache invalidation failed for {tags}: {e}")
+
+def cache_evict():
+    """Drop expired entries, then least recently used ones beyond the size limits"""
+    try:
+        conn = _cache_conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM cache_entry WHERE expires_at < ?', (time.time(),))
+            count, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entry').fetchone()
+            if count > SHARED_CACHE_MAX_ENTRIES or total > SHARED_CACHE_MAX_BYTES:
+                # Walk from the oldest access until both limits are met again
+                excess_bytes = total - SHARED_CACHE_MAX_BYTES
+                excess_count = count - SHARED_CACHE_MAX_ENTRIES
+                victims, freed = [], 0
+                for key, size in conn.execute('SELECT key, size FROM cache_entry ORDER BY last_access'):
+                    if len(victims) >= excess_count and freed >= excess_bytes:
+                        break
+                    victims.append((key,))
+                    freed += size
+                conn.executemany('DELETE FROM cache_entry WHERE key = ?', victims)
+            conn.execute('DELETE FROM cache_tag WHERE key NOT IN (SELECT key FROM cache_entry)')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+    except sqlite3.Error as e:
+        print(f"Shared cache eviction failed: {e}")
+
+def _collect_cache_tags(op, obj):
+    table = getattr(obj, '__tablename__', None)
+    if not table:
+        return None
+    tags = {f'table:{table}'}
+    if isinstance(obj, User) and obj.id is not None:
+        tags.add(f'user:{obj.id}')
+    user_id = getattr(obj, 'user_id', None)
+    if isinstance(user_id, int):
+        tags.add(f'user:{user_id}')
+    return tags
+
+def _invalidate_cache_tags(tag_sets):
+    cache_invalidate(*set().union(*tag_sets))
+
+register_commit_hook(_collect_cache_tags, _invalidate_cache_tags, include_collections=True)
+
+# === Team Availability ===
+# Approved leave and permission intervals per scope (a team, a project group or
+# an office branch), held in a sorted interval index: starts ascending plus the
+# running maximum of ends, so "who is out between A and B" is two binary
+# searches and a vectorized filter. Indexes are built lazily per worker and
+# dropped whenever one of AVAILABILITY_TAGS moves in the shared cache, i.e.
+# after any committed change to leave, permissions or membership.
+AVAILABILITY_TAGS = ('table:leave_request', 'table:permission_request', 'table:team', 'table:group',
+                     'table:user', 'table:employee_info')
+AVAILABILITY_SCOPES = ('team', 'group', 'branch')
+AVAILABILITY_ROLES = ['Team Lead', 'HR', 'Director', 'Admin']
+AVAILABILITY_KINDS = ('leave', 'permission')
+
+class IntervalIndex:
+    """Closed [start, end] day-ordinal intervals sorted by start for overlap queries"""
+
+    def __init__(self, starts, ends, user_ids, kinds, request_ids):
+        order = np.argsort(starts, kind='stable')
+        self.starts = np.asarray(starts, dtype=np.int64)[order]
+        self.ends = np.asarray(ends, dtype=np.int64)[order]
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)[order]
+        self.kinds = np.asarray(kinds, dtype=np.int8)[order]
+        self.request_ids = np.asarray(request_ids, dtype=np.int64)[order]
+        self.max_end = np.maximum.accumulate(self.ends) if len(self.ends) else self.ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def overlapping(self, start, end):
+        """Positions of the intervals that intersect [start, end]"""
+        hi = int(np.searchsorted(self.starts, end, side='right'))
+        # Every interval before lo ends before start
+        lo = int(np.searchsorted(self.max_end[:hi], start, side='left'))
+        positions = np.arange(lo, hi)
+        return positions[self.ends[lo:hi] >= start]
+
+class _AvailabilityScope:
+    def __init__(self, member_ids, branches=None):
+        self.member_ids = np.asarray(sorted(member_ids), dtype=np.int64)
+        self.branches = branches  # user_id -> branch, for the all-branches heatmap
+        self.index = None
+
+_availability_scopes = {}
+_availability_versions = [None]
+_availability_lock = threading.Lock()
+
+def _availability_members(scope, scope_id):
+    """Active user ids in a team, group or branch ({user_id: branch} for branch=None)"""
+    active = User.is_deleted.is_(False)
+    if scope == 'team':
+        rows = db.session.query(team_members.c.user_id).join(User, User.id == team_members.c.user_id) \
+            .filter(team_members.c.team_id == scope_id, active).all()
+    elif scope == 'group':
+        rows = db.session.query(group_members.c.user_id).join(User, User.id == group_members.c.user_id) \
+            .filter(group_members.c.group_id == scope_id, active).all()
+    else:
+        query = db.session.query(EmployeeInfo.user_id, EmployeeInfo.office_branch) \
+            .join(User, User.id == EmployeeInfo.user_id) \
+            .filter(active, EmployeeInfo.is_deleted.is_(False))
+        if scope_id is not None:
+            query = query.filter(EmployeeInfo.office_branch == scope_id)
+        return {user_id: branch or 'Unassigned' for user_id, branch in query}
+    return {user_id: None for (user_id,) in rows}
+
+def _build_availability_index(user_ids):
+    starts, ends, owners, kinds, request_ids = [], [], [], [], []
+    for chunk_start in range(0, len(user_ids), 500):
+        chunk = [int(user_id) for user_id in user_ids[chunk_start:chunk_start + 500]]
+        for request_id, user_id, from_day, to_day in db.session.query(
+                LeaveRequest.id, LeaveRequest.user_id, LeaveRequest.from_day, LeaveRequest.to_day
+        ).filter(LeaveRequest.user_id.in_(chunk), LeaveRequest.status == 'Approved', LeaveRequest.from_day.isnot(None)):
+            starts.append(from_day.toordinal())
+            ends.append(max(from_day, to_day or from_day).toordinal())
+            owners.append(user_id); kinds.append(0); request_ids.append(request_id)
+        for request_id, user_id, day in db.session.query(
+                PermissionRequest.id, PermissionRequest.user_id, PermissionRequest.day
+        ).filter(PermissionRequest.user_id.in_(chunk), PermissionRequest.status == 'Approved', PermissionRequest.day.isnot(None)):
+            starts.append(day.toordinal())
+            ends.append(day.toordinal())
+            owners.append(user_id); kinds.append(1); request_ids.append(request_id)
+    return IntervalIndex(starts, ends, owners, kinds, request_ids)
+
+def availability_scope(scope, scope_id):
+    """The members and interval index of one scope, rebuilt after relevant commits"""
+    try:
+        versions = _cache_tag_versions(_cache_conn(), AVAILABILITY_TAGS)
+    except sqlite3.Error:
+        versions = None  # no shared cache: never reuse an index
+    key = (scope, scope_id)
+    with _availability_lock:
+        if versions is None or versions != _availability_versions[0]:
+            _availability_scopes.clear()
+            _availability_versions[0] = versions
+        cached = _availability_scopes.get(key)
+    if cached is not None:
+        return cached
+
+    members = _availability_members(scope, scope_id)
+    built = _AvailabilityScope(members, members if scope == 'branch' else None)
+    built.index = _build_availability_index(built.member_ids)
+    with _availability_lock:
+        if versions is not None and _availability_versions[0] == versions:
+            _availability_scopes[key] = built
+    return built
+
+def _out_of_office(scope_data, start, end):
+    """{user_id: [interval, ...]} for members with approved leave or permission in [start, end]"""
+    index = scope_data.index
+    out = {}
+    for position in index.overlapping(start.toordinal(), end.toordinal()):
+        user_id = int(index.user_ids[position])
+        out.setdefault(user_id, []).append({
+            'type': AVAILABILITY_KINDS[index.kinds[position]],
+            'request_id': int(index.request_ids[position]),
+            'from': datetime.fromordinal(int(index.starts[position])).strftime('%Y-%m-%d'),
+            'to': datetime.fromordinal(int(index.ends[position])).strftime('%Y-%m-%d'),
+        })
+    return out
+
+def availability_heatmap(scope_data, month_start, days):
+    """Per-day counts of members on leave / on permission, per branch when the scope has them"""
+    index = scope_data.index
+    members = scope_data.member_ids
+    first = month_start.toordinal()
+    positions = index.overlapping(first, first + days - 1)
+    if scope_data.branches is not None:
+        labels = sorted(set(scope_data.branches.values()))
+        label_of_member = np.array([labels.index(scope_data.branches[int(u)]) for u in members], dtype=np.int64)
+    else:
+        labels = [None]
+        label_of_member = np.zeros(len(members), dtype=np.int64)
+
+    counts = {}
+    for kind_code, kind in enumerate(AVAILABILITY_KINDS):
+        selected = positions[index.kinds[positions] == kind_code]
+        rows = np.searchsorted(members, index.user_ids[selected])
+        starts = np.clip(index.starts[selected] - first, 0, days - 1)
+        ends = np.clip(index.ends[selected] - first, 0, days - 1)
+        # Difference array per member, so overlapping requests of one person count once
+        diff = np.zeros((len(members), days + 1), dtype=np.int32)
+        np.add.at(diff, (rows, starts), 1)
+        np.add.at(diff, (rows, ends + 1), -1)
+        out = np.cumsum(diff, axis=1)[:, :days] > 0
+        per_label = np.zeros((len(labels), days), dtype=np.int64)
+        np.add.at(per_label, label_of_member, out)
+        counts[kind] = per_label
+    headcount = np.bincount(label_of_member, minlength=len(labels))
+    return labels, headcount, counts
+
+def _availability_request():
+    """(user, scope, scope_id) for the current request, or an error response"""
+    if 'user' not in session:
+        return None, (jsonify({'status': 'error', 'message': 'User not authenticated'}), 401)
+    user = User.query.filter_by(email=session['user']).first()
+    if not user:
+        return None, (jsonify({'status': 'error', 'message': 'User not found'}), 404)
+    scopes = [scope for scope in AVAILABILITY_SCOPES if request.args.get(scope) or request.args.get(f'{scope}_id')]
+    if len(scopes) > 1:
+        return None, (jsonify({'status': 'error', 'message': 'Pass only one of team_id, group_id or branch'}), 400)
+    scope = scopes[0] if scopes else 'branch'
+    if scope == 'branch':
+        scope_id = request.args.get('branch') or None
+    else:
+        scope_id = _to_int(request.args.get(f'{scope}_id') or request.args.get(scope), None)
+        if scope_id is None:
+            return None, (jsonify({'status': 'error', 'message': f'{scope}_id must be a number'}), 400)
+
+    user_roles = [role.name for role in user.roles]
+    if not (any(role in user_roles for role in AVAILABILITY_ROLES) or is_managing_director(user_roles)):
+        # Everyone else may only look at teams and groups they belong to
+        table = {'team': team_members, 'group': group_members}.get(scope)
+        member = table is not None and db.session.query(table).filter(
+            table.c.user_id == user.id, getattr(table.c, f'{scope}_id') == scope_id).first() is not None
+        if not member:
+            return None, (jsonify({'status': 'error', 'message': 'Access denied'}), 403)
+    return (user, scope, scope_id), None
+
+@app.route('/api/availability/out', methods=['GET'])
+def availability_out():
+    """Members of a team, group or branch with approved leave or permission between from and to"""
+    context, error = _availability_request()
+    if error:
+        return error
+    _, scope, scope_id = context
+    start = parse_date_value(request.args.get('from'))
+    end = parse_date_value(request.args.get('to') or request.args.get('from'))
+    if not start or not end or end < start:
+        return jsonify({'status': 'error', 'message': 'from and to must be dates (YYYY-MM-DD) with from <= to'}), 400
+
+    try:
+        scope_data = availability_scope(scope, scope_id)
+        out = _out_of_office(scope_data, start, end)
+        names = dict(db.session.query(User.id, User.name).filter(User.id.in_(list(out)))) if out else {}
+        return jsonify({
+            'status': 'success', 'scope': scope, 'scope_id': scope_id,
+            'from': start.isoformat(), 'to': end.isoformat(),
+            'members': int(len(scope_data.member_ids)),
+            'available': int(len(scope_data.member_ids) - len(out)),
+            'out': [{'user_id': user_id, 'name': names.get(user_id), 'intervals': intervals}
+                    for user_id, intervals in sorted(out.items(), key=lambda item: names.get(item[0]) or '')],
+        })
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/availability/heatmap', methods=['GET'])
+def availability_heatmap_view():
+    """Headcount on leave / permission for every day of a month; all branches at once without a scope"""
+    context, error = _availability_request()
+    if error:
+        return error
+    _, scope, scope_id = context
+    month = request.args.get('month') or datetime.now(indian_tz).strftime('%Y-%m')
+    try:
+        month_start = datetime.strptime(month, '%Y-%m').date()
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'month must be YYYY-MM'}), 400
+    next_month = (month_start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    days = (next_month - month_start).days
+
+    try:
+        scope_data = availability_scope(scope, scope_id)
+        labels, headcount, counts = availability_heatmap(scope_data, month_start, days)
+        holidays = {day.isoformat(): name for name, day in db.session.query(Holiday.name, Holiday.day)
+                    .filter(Holiday.day >= month_start, Holiday.day < next_month)}
+        dates = [month_start + timedelta(days=offset) for offset in range(days)]
+        rows = []
+        for position, label in enumerate(labels):
+            rows.append({
+                'branch': label,
+                'headcount': int(headcount[position]),
+                'on_leave': counts['leave'][position].tolist(),
+                'on_permission': counts['permission'][position].tolist(),
+                'available': (headcount[position] - counts['leave'][position]).tolist(),
+            })
+        return jsonify({
+            'status': 'success', 'scope': scope, 'scope_id': scope_id, 'month': month,
+            'days': [{'date': day.isoformat(), 'weekend': day.weekday() >= 5,
+                      'holiday': holidays.get(day.isoformat())} for day in dates],
+            'rows': rows,
+        })
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# === Leave Conflict Check ===
+# A new leave request is checked against the applicant's own open (not rejected)
+# leave and against the capacity of every team they belong to. The own-overlap
+# lookup is an index seek on (user_id, from_day); team capacity reuses the
+# availability interval index above, counting each day's load from the start
+# and end events of the overlapping intervals rather than a members x days grid.
+# Overlaps always block; capacity breaches are reported as warnings unless
+# LEAVE_CAPACITY_MODE=reject.
+LEAVE_TEAM_CAPACITY = float(os.environ.get('LEAVE_TEAM_CAPACITY', 0.5))  # share of a team that may be off on one day
+LEAVE_CAPACITY_MODE = os.environ.get('LEAVE_CAPACITY_MODE', 'flag')  # 'flag' or 'reject'
+LEAVE_MAX_DAYS = int(os.environ.get('LEAVE_MAX_DAYS', 366))  # longest range a single request may span
+
+def leave_overlaps(user_id, start, end, exclude_id=None):
+    """The user's open leave requests that intersect [start, end]"""
+    query = db.session.query(LeaveRequest.id, LeaveRequest.from_day, LeaveRequest.to_day, LeaveRequest.status).filter(
+        LeaveRequest.user_id == user_id,
+        LeaveRequest.from_day <= end,
+        db.func.coalesce(LeaveRequest.to_day, LeaveRequest.from_day) >= start,
+        ~LeaveRequest.status.like('Rejected%'),
+    )
+    if exclude_id is not None:
+        query = query.filter(LeaveRequest.id != exclude_id)
+    return [{'request_id': request_id, 'from': from_day.isoformat(), 'to': (to_day or from_day).isoformat(), 'status': status}
+            for request_id, from_day, to_day, status in query.order_by(LeaveRequest.from_day)]
+
+def daily_leave_load(index, first, last):
+    """Members with approved leave on each day ordinal first..last, from the intervals' start/end events"""
+    positions = index.overlapping(first, last)
+    positions = positions[index.kinds[positions] == 0]
+    # Merge each member's overlapping requests so one person counts once per day
+    merged_starts, merged_ends, owner = [], [], None
+    spans = sorted(zip(index.user_ids[positions].tolist(), index.starts[positions].tolist(),
+                       index.ends[positions].tolist()))
+    for user_id, span_start, span_end in spans:
+        if merged_starts and owner == user_id and span_start <= merged_ends[-1] + 1:
+            merged_ends[-1] = max(merged_ends[-1], span_end)
+        else:
+            owner = user_id
+            merged_starts.append(span_start)
+            merged_ends.append(span_end)
+    starts = np.sort(np.asarray(merged_starts, dtype=np.int64))
+    ends = np.sort(np.asarray(merged_ends, dtype=np.int64))
+    days = np.arange(first, last + 1, dtype=np.int64)
+    # Out on day d: started on or before d, minus those that ended before d
+    return np.searchsorted(starts, days, side='right') - np.searchsorted(ends, days, side='left')
+
+def leave_capacity_breaches(user_id, start, end):
+    """Days on which taking [start, end] off would put a team of the user over LEAVE_TEAM_CAPACITY"""
+    breaches = []
+    for team_id, team_name in db.session.query(Team.id, Team.name).join(team_members, team_members.c.team_id == Team.id) \
+            .filter(team_members.c.user_id == user_id):
+        scope_data = availability_scope('team', team_id)
+        size = len(scope_data.member_ids)
+        if size < 2:
+            continue
+        allowed = max(1, int(size * LEAVE_TEAM_CAPACITY))
+        projected = daily_leave_load(scope_data.index, start.toordinal(), end.toordinal()) + 1
+        over = np.flatnonzero(projected > allowed)
+        if over.size:
+            breaches.append({
+                'team_id': team_id, 'team': team_name, 'members': size, 'allowed_off': allowed,
+                'days': [{'date': (start + timedelta(days=int(offset))).isoformat(), 'off': int(projected[offset])}
+                         for offset in over],
+            })
+    return breaches
+
+def check_leave_request(user_id, from_date, to_date, exclude_id=None):
+    """(result, error message) for a proposed leave; result['ok'] is False if it must be rejected"""
+    start, end = parse_date_value(from_date), parse_date_value(to_date)
+    if not start or not end:
+        return None, 'from_date and to_date must be valid dates (YYYY-MM-DD)'
+    if end < start:
+        return None, 'to_date cannot be before from_date'
+    if (end - start).days + 1 > LEAVE_MAX_DAYS:
+        return None, f'A leave request cannot span more than {LEAVE_MAX_DAYS} days'
+    overlaps = leave_overlaps(user_id, start, end, exclude_id)
+    breaches = leave_capacity_breaches(user_id, start, end)
+    return {
+        'ok': not overlaps and not (breaches and LEAVE_CAPACITY_MODE == 'reject'),
+        'days': (end - start).days + 1,
+        'overlaps': overlaps,
+        'capacity': breaches,
+        'capacity_mode': LEAVE_CAPACITY_MODE,
+    }, None
+
+def leave_check_message(result):
+    if result['overlaps']:
+        first = result['overlaps'][0]
+        return f"Overlaps your leave request #{first['request_id']} ({first['from']} to {first['to']}, {first['status']})"
+    if result['capacity']:
+        breach = result['capacity'][0]
+        return (f"{breach['team']} would have more than {breach['allowed_off']} of {breach['members']} members "
+                f"on leave on {breach['days'][0]['date']}")
+    return None
+
+@app.route('/api/leave/check', methods=['POST'])
+def check_leave_dates():
+    """Dry run of the submit-time conflict check for the leave form"""
+    user_email = session.get('user')
+    if not user_email:
+        return jsonify({'status': 'error', 'message': 'User not authenticated'}), 401
+    user = User.query.filter_by(email=user_email).first()
+    if not user:
+        return jsonify({'status': 'error', 'message': 'User not found'}), 404
+
+    data = request.get_json(silent=True) or {}
+    try:
+        result, error = check_leave_request(user.id, data.get('from_date'), data.get('to_date'),
+                                            _to_int(data.get('exclude_request_id'), None))
+        if error:
+            return jsonify({'status': 'error', 'message': error}), 400
+        return jsonify(dict(result, status='success', message=leave_check_message(result)))
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# === Streaming Exports ===
+# List endpoints accept ?format=csv|xlsx and stream their rows instead of
+# building JSON. A column spec is a list of (header, expression[, formatter]);
+# export_query selects only those expressions and reads them with yield_per, so
+# memory stays flat however many rows match. CSV is generated chunk by chunk;
+# XLSX is written by openpyxl in write-only mode to a temporary file that is then
+# streamed and removed. Text that a spreadsheet would evaluate as a formula is
+# neutralised: CSV cells get a leading apostrophe, XLSX cells are written as
+# quote-prefixed strings.
+EXPORT_FORMATS = ('csv', 'xlsx')
+EXPORT_CHUNK_ROWS = 1000
+EXPORT_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+EXPORT_ROLES = ['HR', 'Accounts', 'Admin', 'Director']
+
+def requested_export_format():
+    """'csv' or 'xlsx' when the request asks for an export, else None"""
+    fmt = (request.args.get('format') or '').lower()
+    return fmt if fmt in EXPORT_FORMATS else None
+
+def _looks_like_formula(value):
+    return isinstance(value, str) and value.startswith(EXPORT_FORMULA_PREFIXES)
+
+def _export_cell(value, fmt='csv'):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if hasattr(value, 'toordinal'):
+        return value.isoformat()
+    if fmt == 'csv' and _looks_like_formula(value):
+        return "'" + value
+    return value
+
+def _csv_chunks(headers, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')  # lets Excel detect UTF-8
+    writer.writerow(headers)
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def _xlsx_chunks(headers, rows, sheet_title):
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+
+    def text_cell(value):
+        # openpyxl stores '=...' as a formula; force a literal string Excel won't re-parse on edit
+        cell = WriteOnlyCell(sheet, value=value)
+        cell.data_type = 's'
+        cell.quotePrefix = True
+        return cell
+
+    handle, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(handle)
+    try:
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet(title=sheet_title[:31] or 'Export')
+        sheet.append(headers)
+        for row in rows:
+            sheet.append([text_cell(value) if _looks_like_formula(value) else value for value in row])
+        workbook.save(path)
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(64 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
+
+def export_response(columns, rows, filename, fmt):
+    """Stream rows (tuples in column order) as an attachment in fmt"""
+    headers = [column[0] for column in columns]
+    formatters = [column[2] if len(column) > 2 else None for column in columns]
+
+    def formatted():
+        for row in rows:
+            yield [_export_cell(formatter(value) if formatter else value, fmt) for formatter, value in zip(formatters, row)]
+
+    if fmt == 'xlsx':
+        try:
+            import openpyxl  # noqa: F401
+        except ImportError:
+            return jsonify({'status': 'error', 'message': 'XLSX export requires openpyxl'}), 400
+        body = _xlsx_chunks(headers, formatted(), filename)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    else:
+        body = _csv_chunks(headers, formatted())
+        mimetype = 'text/csv'
+    stamp = datetime.now(indian_tz).strftime('%Y%m%d-%H%M')
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename={secure_filename(filename)}_{stamp}.{fmt}',
+        'X-Accel-Buffering': 'no'
+    })
+
+def export_query(columns, query, filename, fmt):
+    """Select the spec's expressions from query and stream them in chunks"""
+    rows = query.with_entities(*[column[1] for column in columns]).yield_per(EXPORT_CHUNK_ROWS)
+    return export_response(columns, rows, filename, fmt)
+
+def _export_denied(user):
+    user_roles = [role.name for role in user.roles] if user else []
+    if any(role in user_roles for role in EXPORT_ROLES) or is_managing_director(user_roles):
+        return None
+    return jsonify({'status': 'error', 'message': 'Unauthorized access'}), 403
+
+EMPLOYEE_EXPORT_COLUMNS = [
+    ('ID', EmployeeInfo.id), ('Employee ID', EmployeeInfo.employee_id), ('Full Name', EmployeeInfo.full_name),
+    ('Email', EmployeeInfo.email), ('DOB', EmployeeInfo.dob), ('Gender', EmployeeInfo.gender),
+    ('Phone', EmployeeInfo.phone_no), ('Address', EmployeeInfo.address), ('Office Branch', EmployeeInfo.office_branch),
+    ('Designation', EmployeeInfo.designation), ('Gross Salary', EmployeeInfo.actual_gross_salary),
+    ('Basic', EmployeeInfo.basic), ('HRA', EmployeeInfo.hra), ('Conveyance', EmployeeInfo.conveyance),
+    ('Vehicle Maintenance', EmployeeInfo.vehicle_maintenance), ('Special Allowance', EmployeeInfo.special_allowance),
+    ('Add Others', EmployeeInfo.add_others), ('Provident Fund', EmployeeInfo.provident_fund), ('ESI', EmployeeInfo.esi),
+    ('Professional Tax', EmployeeInfo.professional_tax), ('Income Tax', EmployeeInfo.income_tax),
+    ('Advance', EmployeeInfo.advance), ('Other Deductions', EmployeeInfo.other_deductions),
+    ('Loss of Pay', EmployeeInfo.loss_of_pay), ('Total Leaves', EmployeeInfo.total_leaves),
+    ('Leave Availed', EmployeeInfo.leave_availed), ('Balance Leaves', EmployeeInfo.balance_leaves),
+    ('LOP Days', EmployeeInfo.no_of_lop_days), ('NDP', EmployeeInfo.ndp),
+]
+CONVEYANCE_EXPORT_COLUMNS = [
+    ('ID', ConveyanceRequest.id), ('Applicant', User.name), ('Email', User.email),
+    ('Request Date', ConveyanceRequest.request_date), ('HR Status', ConveyanceRequest.status_hr),
+    ('Accounts Status', ConveyanceRequest.status_accounts),
+    ('Lines', db.select(db.func.count(ConveyanceClaimLine.id))
+        .where(ConveyanceClaimLine.conveyance_request_id == ConveyanceRequest.id).scalar_subquery()),
+    ('Distance (km)', db.select(db.func.coalesce(db.func.sum(ConveyanceClaimLine.distance_km), 0.0))
+        .where(ConveyanceClaimLine.conveyance_request_id == ConveyanceRequest.id).scalar_subquery()),
+    ('Amount', db.select(db.func.coalesce(db.func.sum(ConveyanceClaimLine.amount), 0.0))
+        .where(ConveyanceClaimLine.conveyance_request_id == ConveyanceRequest.id).scalar_subquery()),
+]
+ASSET_EXPORT_COLUMNS = [
+    ('ID', AssetRequest.id), ('Request Date', AssetRequest.request_date), ('Indenter', AssetRequest.indenter_name),
+    ('Office/Project', AssetRequest.office_project_type), ('Reference File No', AssetRequest.reference_file_no),
+    ('Purchase Type', AssetRequest.purchase_type), ('Budget Head', AssetRequest.budget_head),
+    ('Nature of Expenditure', AssetRequest.nature_of_expenditure), ('GST Applicable', AssetRequest.gst_applicable),
+    ('Finalized Vendor', AssetRequest.finalized_vendor), ('Status', AssetRequest.status),
+]
+ATTENDANCE_EXPORT_COLUMNS = [('Name', 'name'), ('Branch', 'branch'), ('Designation', 'designation'),
+                             ('Check-In', 'checkin'), ('Check-Out', 'checkout'), ('Status', 'status')]
+
+def export_finalized_requests(fmt):
+    """Approved/rejected leave and permission requests, newest first, as one UNION ALL stream"""
+    columns = [('ID', None), ('Type', None), ('Applicant', None), ('From', None), ('To', None),
+               ('Reason', None), ('Status', None), ('Remarks', None)]
+    leave = db.select(LeaveRequest.id, db.literal('Leave'), LeaveRequest.applicant_name, LeaveRequest.from_date,
+                      LeaveRequest.to_date, LeaveRequest.reason, LeaveRequest.status, LeaveRequest.remarks,
+                      LeaveRequest.from_day.label('sort_day')) \
+        .where(LeaveRequest.status.in_(['Approved', 'Rejected']))
+    permission = db.select(PermissionRequest.id, db.literal('Permission'), PermissionRequest.applicant_name,
+                           PermissionRequest.date, PermissionRequest.date, PermissionRequest.reason,
+                           PermissionRequest.status, db.literal(None), PermissionRequest.day.label('sort_day')) \
+        .where(PermissionRequest.status.in_(['Approved', 'Rejected']))
+    union = db.union_all(leave, permission).subquery()
+    statement = db.select(*list(union.c)[:8]).order_by(union.c.sort_day.desc())
+    rows = db.session.execute(statement.execution_options(yield_per=EXPORT_CHUNK_ROWS))
+    return export_response(columns, rows, 'finalized_requests', fmt)
+
+
+# === Conveyance Rollups ===
+# Totals come from ConveyanceMonthlySummary (one row per employee and month,
+# maintained by submit/mark-seen), so any grouping is a single grouped query.
+# `claims` cannot be summed across months (a claim may have lines in two), so it
+# is a distinct count over ConveyanceClaimLine in the requested range: one
+# claim per employee, branch and in the totals, though it appears in both
+# months' rows.
+# Month-end reconciliation: ?group_by=employee&month=YYYY-MM (add format=csv|xlsx).
+CONVEYANCE_ROLLUP_ROLES = ['HR', 'Accounts', 'Admin', 'Director']
+CONVEYANCE_ROLLUP_GROUPS = {
+    'employee': [ConveyanceMonthlySummary.user_id, User.name],
+    'month': [ConveyanceMonthlySummary.month],
+    'branch': [ConveyanceMonthlySummary.office_branch],
+}
+_MONTH_RE = re.compile(r'^\d{4}-(0[1-9]|1[0-2])$')
+
+@app.route('/api/conveyance/rollup')
+def conveyance_rollup():
+    """Conveyance claim totals per employee, month or branch"""
+    if 'user' not in session:
+        return jsonify({'status': 'error', 'message': 'User not authenticated'}), 401
+    user = User.query.filter_by(email=session['user']).first()
+    user_roles = [role.name for role in user.roles] if user else []
+    if not (any(role in user_roles for role in CONVEYANCE_ROLLUP_ROLES) or is_managing_director(user_roles)):
+        return jsonify({'status': 'error', 'message': 'Access denied'}), 403
+
+    group_by = request.args.get('group_by', 'month')
+    if group_by not in CONVEYANCE_ROLLUP_GROUPS:
+        return jsonify({'status': 'error', 'message': f'group_by must be one of {", ".join(CONVEYANCE_ROLLUP_GROUPS)}'}), 400
+    month = request.args.get('month')
+    start, end = request.args.get('from', month), request.args.get('to', month)
+    for value in (start, end):
+        if value and not _MONTH_RE.match(value):
+            return jsonify({'status': 'error', 'message': 'Months must be in YYYY-MM format'}), 400
+
+    summary = ConveyanceMonthlySummary
+    keys = CONVEYANCE_ROLLUP_GROUPS[group_by]
+    filters = []
+    if start:
+        filters.append(summary.month >= start)
+    if end:
+        filters.append(summary.month <= end)
+    if request.args.get('branch'):
+        filters.append(summary.office_branch == request.args['branch'])
+    if request.args.get('user_id', type=int):
+        filters.append(summary.user_id == request.args.get('user_id', type=int))
+
+    query = db.session.query(
+        *keys,
+        db.func.sum(summary.lines), db.func.sum(summary.distance_km),
+        db.func.sum(summary.amount), db.func.sum(summary.pending_amount)
+    )
+    if group_by == 'employee':
+        query = query.join(User, User.id == summary.user_id)
+    rows = query.filter(*filters).group_by(*keys).order_by(*keys).all()
+
+    # Distinct claims per group, read through the summary rows so the filters
+    # match the sums above. A claim belongs to one employee, so per-employee
+    # counts add up to the total; months and branches can share a claim, so
+    # their total is a separate row of the same statement.
+    line = ConveyanceClaimLine
+    claim_count = db.func.count(db.distinct(line.conveyance_request_id))
+    by_line = db.and_(summary.month == line.month, summary.user_id == line.user_id)
+    claims_statement = db.select(keys[0].label('key'), db.literal(False).label('is_total'), claim_count) \
+        .select_from(line).join(summary, by_line).where(*filters).group_by(keys[0])
+    if group_by != 'employee':
+        claims_statement = db.union_all(claims_statement, db.select(
+            db.null(), db.literal(True), claim_count).select_from(line).join(summary, by_line).where(*filters))
+    claims_by_key, total_claims = {}, 0
+    for key, is_total, count in db.session.execute(claims_statement):
+        if is_total:
+            total_claims = count
+        else:
+            claims_by_key[key] = count
+    if group_by == 'employee':
+        total_claims = sum(claims_by_key.values())
+    rows = [(*row[:len(keys)], claims_by_key.get(row[0], 0), *row[len(keys):]) for row in rows]
+
+    fmt = requested_export_format()
+    if fmt:
+        labels = {'employee': [('User ID',), ('Employee',)], 'month': [('Month',)], 'branch': [('Branch',)]}[group_by]
+        columns = labels + [('Claims',), ('Lines',), ('Distance (km)',), ('Amount',), ('Pending Amount',)]
+        return export_response(columns, rows, f'conveyance_rollup_{group_by}', fmt)
+
+    groups = []
+    for row in rows:
+        key = row[:len(keys)]
+        claims, lines, distance_km, amount, pending = row[len(keys):]
+        item = {'key': key[0], 'label': key[-1] or 'Unassigned', 'claims': int(claims or 0), 'lines': int(lines or 0),
+                'distance_km': round(distance_km or 0.0, 2), 'amount': round(amount or 0.0, 2),
+                'pending_amount': round(pending or 0.0, 2)}
+        item['seen_amount'] = round(item['amount'] - item['pending_amount'], 2)
+        groups.append(item)
+
+    totals = {name: round(sum(g[name] for g in groups), 2) for name in ['lines', 'distance_km', 'amount', 'pending_amount', 'seen_amount']}
+    totals['lines'] = int(totals['lines'])
+    totals['claims'] = int(total_claims)
+    return jsonify({'status': 'success', 'group_by': group_by, 'from': start, 'to': end,
+                    'groups': groups, 'totals': totals})
+
 if __name__ == '__main__':
     app.run(debug=True, port=5004)
 
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Benchmark - Drive the key endpoints against a seeded database
+
+Each route is called through the Flask test client as one of the seed_data.py
+personas. The script reports p50/p95/p99 latency, SQL statements per request
+(read from the Server-Timing header) and peak RSS, and saves everything as JSON
+so runs can be compared over time.
+
+    python seed_data.py --db bench.db --scale medium
+    python benchmark.py --db bench.db --iterations 20
+    python benchmark.py --db bench.db --compare benchmarks/results-20260101-120000.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from seed_data import PERSONAS, load_app
+
+# (name, persona, path) for every endpoint the benchmark and the budget tests cover
+BENCH_ROUTES = [
+    ('director_requests', 'director', '/api/director/requests'),
+    ('director_all_requests', 'director', '/api/director/all_requests'),
+    ('teamlead_requests', 'teamlead', '/api/teamlead/requests'),
+    ('teamlead_all_requests', 'teamlead', '/api/teamlead/all_requests'),
+    ('hr_requests', 'hr', '/api/hr/requests'),
+    ('hr_finalized_requests', 'hr', '/api/hr/finalized_requests'),
+    ('hr_conveyance_requests', 'hr', '/api/hr/conveyance_requests'),
+    ('accounts_conveyance_requests', 'accounts', '/api/accounts/conveyance_requests'),
+    ('conveyance_rollup', 'accounts', '/api/conveyance/rollup?group_by=employee'),
+    ('my_requests', 'employee', '/api/my_requests'),
+    ('user_leave_info', 'employee', '/api/user_leave_info'),
+    ('my_approved_requests', 'director', '/api/my_approved_requests'),
+    ('asset_requests', 'director', '/api/asset_requests'),
+    ('my_pending_indents', 'teamlead', '/api/my_pending_indents'),
+    ('get_all_employee_info', 'hr', '/api/get_all_employee_info'),
+    ('users', 'admin', '/api/users'),
+    ('announcements', 'employee', '/api/announcements'),
+    ('holidays', 'employee', '/api/holidays'),
+    ('birthday_alerts', 'employee', '/api/birthday_alerts'),
+    ('my_tasks', 'employee', '/api/my_tasks'),
+    ('dashboard_task_counts', 'employee', '/api/dashboard/task_counts'),
+    ('evaluation_reports', 'hr', '/api/evaluation/reports'),
+    ('evaluation_analytics', 'hr', '/api/evaluation/analytics?group_by=branch'),
+    ('search', 'director', '/api/search?q=site'),
+]
+
+_SERVER_TIMING_RE = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+
+
+def persona_client(portal, persona):
+    """A test client logged in as one of the seed_data.py personas"""
+    email = PERSONAS[persona][0]
+    client = portal.app.test_client()
+    with portal.app.app_context():
+        user = portal.User.query.filter_by(email=email).first()
+        if not user:
+            raise RuntimeError(f'{email} not found; seed the database with seed_data.py first')
+        roles = [role.name for role in user.roles]
+    with client.session_transaction() as session:
+        session['user'] = email
+        session['roles'] = roles
+    return client
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def measure(client, path, iterations=10, warmup=1):
+    """Time `iterations` GETs of path; returns latency percentiles and SQL counts"""
+    for _ in range(warmup):
+        client.get(path).close()
+
+    latencies, queries, sql_ms, sizes, statuses = [], [], [], [], set()
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response = client.get(path)
+        body = response.get_data()
+        latencies.append((time.perf_counter() - started) * 1000)
+        match = _SERVER_TIMING_RE.search(response.headers.get('Server-Timing', ''))
+        if match:
+            sql_ms.append(float(match.group(1)))
+            queries.append(int(match.group(2)))
+        sizes.append(len(body))
+        statuses.add(response.status_code)
+        response.close()
+
+    latencies.sort()
+
+    def percentile(q):
+        # nearest-rank on the sorted sample
+        return round(latencies[min(len(latencies) - 1, max(0, int(round(q * len(latencies) + 0.5)) - 1))], 2)
+
+    return {
+        'path': path,
+        'iterations': iterations,
+        'status': sorted(statuses),
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'mean_ms': round(sum(latencies) / len(latencies), 2),
+        'max_ms': round(latencies[-1], 2),
+        'queries': max(queries) if queries else None,
+        'sql_ms': round(sum(sql_ms) / len(sql_ms), 2) if sql_ms else None,
+        'bytes': max(sizes),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def table_counts(portal):
+    counts = {}
+    with portal.app.app_context():
+        for name in ['user', 'employee_info', 'leave_request', 'permission_request', 'travel_request',
+                     'conveyance_request', 'asset_request', 'task', 'evaluation_report', 'announcement']:
+            counts[name] = portal.db.session.execute(portal.text(f'SELECT COUNT(*) FROM "{name}"')).scalar()
+    return counts
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(portal, routes, iterations, warmup, verbose=False):
+    clients = {}
+    results = {}
+    for name, persona, path in routes:
+        if persona not in clients:
+            clients[persona] = persona_client(portal, persona)
+        # The endpoints print debug output; keep it out of the report unless asked for
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+            results[name] = dict(measure(clients[persona], path, iterations, warmup), persona=persona)
+        row = results[name]
+        print(f"   {name:<30} p50 {row['p50_ms']:>9.1f}  p95 {row['p95_ms']:>9.1f}  p99 {row['p99_ms']:>9.1f} ms"
+              f"  {row['queries'] if row['queries'] is not None else '-':>5} q  {row['bytes']:>9,} B"
+              f"  {row['peak_rss_mb']:>7.1f} MB  {row['status']}")
+    return results
+
+
+def print_comparison(results, baseline):
+    print(f"\n📈 Compared with {baseline['meta'].get('timestamp')} ({baseline['meta'].get('git')}):")
+    for name, row in results.items():
+        old = baseline['routes'].get(name)
+        if not old:
+            print(f"   {name:<30} (new)")
+            continue
+        change = (row['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 if old['p95_ms'] else 0.0
+        queries = ''
+        if row['queries'] is not None and old.get('queries') is not None and row['queries'] != old['queries']:
+            queries = f"  queries {old['queries']} -> {row['queries']}"
+        print(f"   {name:<30} p95 {old['p95_ms']:>9.1f} -> {row['p95_ms']:>9.1f} ms ({change:+6.1f}%){queries}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', default='bench.db', help='database seeded with seed_data.py')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--routes', help='comma-separated route names or path substrings to run')
+    parser.add_argument('--out', help='result file (default benchmarks/results-<timestamp>.json)')
+    parser.add_argument('--compare', help='earlier result file to diff against')
+    parser.add_argument('--verbose', action='store_true', help="show the endpoints' own print output")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"❌ {args.db} does not exist; create it with seed_data.py", file=sys.stderr)
+        return 1
+    routes = BENCH_ROUTES
+    if args.routes:
+        wanted = [part.strip() for part in args.routes.split(',') if part.strip()]
+        routes = [r for r in BENCH_ROUTES if any(w == r[0] or w in r[2] for w in wanted)]
+
+    portal = load_app(args.db)
+    meta = {
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'git': git_revision(),
+        'db': os.path.abspath(args.db),
+        'rows': table_counts(portal),
+        'iterations': args.iterations,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+    print("=" * 110)
+    print(f"⏱️  Benchmarking {len(routes)} routes against {args.db} ({meta['rows']['user']} users)")
+    print("=" * 110)
+    results = run(portal, routes, args.iterations, args.warmup, args.verbose)
+    meta['peak_rss_mb'] = peak_rss_mb()
+
+    out = args.out or os.path.join('benchmarks', f"results-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump({'meta': meta, 'routes': results}, f, indent=2)
+    print(f"\n💾 Saved {out} (peak RSS {meta['peak_rss_mb']} MB)")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
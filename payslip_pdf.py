@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Payslip PDF - Render payslips with reportlab, in-process or as a job process
+
+app.py renders small batches by calling render_payslip_pdf() directly. Large
+batches go to a separate `python -m payslip_pdf` process: the WSGI worker
+pickles the payslip lines (plain dicts) to its stdin, and it pickles one
+(file name, PDF bytes) pair per line back to stdout, in order. The job process
+only imports reportlab and has no threads or database connections, so it can
+fork its own render pool safely, which a multithreaded web worker cannot.
+
+    python -m payslip_pdf --workers 4 < lines.pickle > payslips.pickle
+"""
+
+import argparse
+import io
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+from werkzeug.utils import secure_filename
+
+PAYSLIP_COMPANY = 'SSEV SOFTWARE SOLUTIONS PRIVATE LIMITED'
+PAYSLIP_ADDRESS = ('Corporate office: #2-057/A/112, 1st Floor, VSS Nandadeep, Near Medchal RTA Office, '
+                   'Petbasheerabad Village, Kompally Road, Medchal District Telangana Hyderabad 500067. Ph.040-35042301.')
+
+def _build_payslip_styles():
+    """Styles are built once at import and inherited by the forked pool workers"""
+    styles = getSampleStyleSheet()
+    return {
+        'company': ParagraphStyle('PayslipCompany', parent=styles['Heading2'], alignment=1, spaceAfter=4),
+        'address': ParagraphStyle('PayslipAddress', parent=styles['Normal'], fontSize=8, alignment=1, spaceAfter=10),
+        'title': ParagraphStyle('PayslipTitle', parent=styles['Heading3'], alignment=1, spaceAfter=12),
+        'footer': ParagraphStyle('PayslipFooter', parent=styles['Normal'], fontSize=9, textColor=colors.HexColor('#666666')),
+        'table': TableStyle([
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+            ('FONTSIZE', (0, 0), (-1, -1), 9),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('BACKGROUND', (0, 6), (-1, 6), colors.HexColor('#dddddd')),
+            ('FONTNAME', (0, 6), (-1, 6), 'Helvetica-Bold'),
+            ('SPAN', (0, 5), (3, 5)),
+            ('ALIGN', (0, 5), (3, 5), 'CENTER'),
+            ('SPAN', (0, 6), (1, 6)),
+            ('SPAN', (2, 6), (3, 6)),
+            ('ALIGN', (0, 6), (-1, 6), 'CENTER'),
+            ('FONTNAME', (0, -2), (1, -2), 'Helvetica-Bold'),
+            ('SPAN', (0, -1), (3, -1)),
+            ('ALIGN', (0, -1), (3, -1), 'RIGHT'),
+            ('FONTNAME', (0, -1), (3, -1), 'Helvetica-Bold'),
+        ]),
+    }
+
+PAYSLIP_STYLES = _build_payslip_styles()
+
+def _money(value):
+    return f"{float(value or 0):.2f}"
+
+def render_payslip_pdf(line):
+    """Render one payslip from a plain dict of PayrollLine fields; returns (file name, PDF bytes)"""
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=36, bottomMargin=36)
+    month_title = datetime.strptime(line['month'], '%Y-%m').strftime('%B %Y')
+    rows = [
+        ['Employee No', line['employee_id'] or 'N/A', 'Designation', line['designation'] or 'N/A'],
+        ['Name', line['full_name'] or 'N/A', 'Total Days', line['total_days'] or 30],
+        ['Bank A/c No', line['account_number'] or 'N/A', 'LOP', f"{float(line['lop_days'] or 0):g}"],
+        ['PF No.', line['pf_no'] or 'N/A', 'Date of Joining', line['date_of_joining'] or 'N/A'],
+        ['Branch', line['office_branch'] or 'N/A', 'Effective work days', line['ndp'] or 0],
+        [f"Total Leaves : {line['total_leaves'] or 0}", '', '', ''],
+        ['Earnings', '', 'Deductions', ''],
+        ['BASIC', _money(line['basic']), 'PF', _money(line['provident_fund'])],
+        ['HRA', _money(line['hra']), 'ESI', _money(line['esi'])],
+        ['CONVEYANCE', _money(line['conveyance']), 'P. Tax', _money(line['professional_tax'])],
+        ['VEHICLE MAINTENANCE', _money(line['vehicle_maintenance']), 'Income Tax', _money(line['income_tax'])],
+        ['SPL ALLOWANCE', _money(line['special_allowance']), 'Advance', _money(line['advance'])],
+        ['Add Others', _money(line['add_others']), 'Others Deduction', _money(line['other_deductions'])],
+        ['', '', 'Loss of Pay', _money(line['loss_of_pay'])],
+        ['Total Earnings', _money(line['total_earnings']), 'Total Deduction', _money(line['total_deductions'])],
+        [f"Net Salary: {_money(line['net_pay'])}", '', '', ''],
+    ]
+    table = Table(rows, colWidths=[1.6 * inch, 1.4 * inch, 1.6 * inch, 1.4 * inch])
+    table.setStyle(PAYSLIP_STYLES['table'])
+    doc.build([
+        Paragraph(PAYSLIP_COMPANY, PAYSLIP_STYLES['company']),
+        Paragraph(PAYSLIP_ADDRESS, PAYSLIP_STYLES['address']),
+        Paragraph(f"Pay-Slip For The Month of {month_title}", PAYSLIP_STYLES['title']),
+        table,
+        Spacer(1, 20),
+        Paragraph('It is System generated, Signature not required', PAYSLIP_STYLES['footer']),
+    ])
+    name = secure_filename(f"{line['full_name'] or 'employee'}_{line['employee_info_id']}_{line['month']}.pdf")
+    return name, buffer.getvalue()
+
+
+def render_payslips(lines, workers):
+    """Yield (name, pdf) for lines in order, on a fork pool when workers > 1"""
+    if workers < 2 or len(lines) < 2:
+        yield from map(render_payslip_pdf, lines)
+        return
+    workers = min(workers, len(lines))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(render_payslip_pdf, lines, chunksize=max(1, min(16, len(lines) // (workers * 4))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    lines = pickle.load(sys.stdin.buffer)
+    out = sys.stdout.buffer
+    for payslip in render_payslips(lines, args.workers):
+        pickle.dump(payslip, out, protocol=pickle.HIGHEST_PROTOCOL)
+        out.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""
+Route Budgets - pytest plugin enforcing per-endpoint SQL and latency budgets
+
+route_budgets.json maps each route to a maximum SQL statement count and a p95
+latency ceiling, measured against a database seeded by seed_data.py at the
+reference scale declared in the same file. Collecting the file yields one test
+per route; a route over budget fails with a diff of measured vs allowed values.
+
+Every route fails the run as soon as it exceeds max_queries. Healthy routes carry
+two queries of headroom over `measured_queries` (the count last recorded at the
+reference scale). Routes with a known N+1 are budgeted at exactly their measured
+count, so the budget is a ratchet: lower it as each N+1 is fixed. Their
+`target_queries` records what they should cost and is informational only.
+
+    python -m pytest route_budgets.json
+    python -m pytest route_budgets.json --no-latency-budgets     # SQL counts only (shared CI boxes)
+    python -m pytest route_budgets.json --budget-db bench.db      # reuse an already seeded file
+
+Enabled from conftest.py via `pytest_plugins`.
+"""
+
+import contextlib
+import json
+import os
+
+import pytest
+
+DEFAULT_BUDGET_FILE = 'route_budgets.json'
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('route budgets')
+    group.addoption('--route-budgets', default=DEFAULT_BUDGET_FILE,
+                    help='budget file name to collect (default route_budgets.json)')
+    group.addoption('--budget-db', default=None,
+                    help='use this seeded database instead of seeding a temporary one')
+    group.addoption('--no-latency-budgets', action='store_true',
+                    help='only enforce SQL statement budgets')
+    group.addoption('--latency-budget-scale', type=float, default=1.0,
+                    help='multiply every latency ceiling (slow machines)')
+
+
+def pytest_configure(config):
+    config._route_budget_results = []
+    config._route_budget_portal = None
+
+
+def pytest_collect_file(parent, file_path):
+    if file_path.name == parent.config.getoption('route_budgets'):
+        return BudgetFile.from_parent(parent, path=file_path)
+    return None
+
+
+def _reference_portal(config, reference):
+    """Import the app against the reference database, seeding it on first use"""
+    if config._route_budget_portal is not None:
+        return config._route_budget_portal
+
+    from seed_data import load_app, seed
+
+    db_path = config.getoption('budget_db')
+    if db_path:
+        portal = load_app(db_path)
+    else:
+        name = f"budgets-{reference['users']}u-{reference['requests']}r-s{reference['seed']}.db"
+        db_path = os.path.join(str(config._tmp_path_factory.getbasetemp()), name)
+        fresh = not os.path.exists(db_path)
+        portal = load_app(db_path)
+        if fresh:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                seed(portal, reference['users'], reference['requests'], reference['seed'])
+    config._route_budget_portal = portal
+    return portal
+
+
+class BudgetFile(pytest.File):
+    def collect(self):
+        spec = json.loads(self.path.read_text())
+        reference = spec['reference']
+        for path, budget in spec['routes'].items():
+            yield RouteBudgetItem.from_parent(self, name=path, path_spec=path, budget=budget, reference=reference)
+
+
+class RouteBudgetExceeded(Exception):
+    pass
+
+
+class RouteBudgetItem(pytest.Item):
+    def __init__(self, *, path_spec, budget, reference, **kwargs):
+        super().__init__(**kwargs)
+        self.route = path_spec
+        self.budget = budget
+        self.reference = reference
+        self.measured = None
+
+    def runtest(self):
+        from benchmark import measure, persona_client
+
+        config = self.config
+        portal = _reference_portal(config, self.reference)
+        client = persona_client(portal, self.budget['persona'])
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            self.measured = measure(client, self.route, self.reference.get('iterations', 5),
+                                    self.reference.get('warmup', 1))
+
+        checks = [('status', self.measured['status'], [200], self.measured['status'] == [200])]
+        queries = self.measured['queries']
+        checks.append(('queries', queries, self.budget['max_queries'],
+                       queries is not None and queries <= self.budget['max_queries']))
+        if not config.getoption('no_latency_budgets') and 'max_p95_ms' in self.budget:
+            ceiling = round(self.budget['max_p95_ms'] * config.getoption('latency_budget_scale'), 1)
+            checks.append(('p95_ms', self.measured['p95_ms'], ceiling, self.measured['p95_ms'] <= ceiling))
+        self.checks = checks
+        config._route_budget_results.append(self)
+
+        if not all(ok for *_, ok in checks):
+            raise RouteBudgetExceeded()
+
+    def repr_failure(self, excinfo):
+        if not isinstance(excinfo.value, RouteBudgetExceeded):
+            return super().repr_failure(excinfo)
+        ref = self.reference
+        lines = [f"{self.route} over budget (as {self.budget['persona']}, "
+                 f"{ref['users']} users / {ref['requests']} requests, seed {ref['seed']})"]
+        for name, actual, allowed, ok in self.checks:
+            marker = '  ' if ok else '✗ '
+            if isinstance(actual, (int, float)) and isinstance(allowed, (int, float)):
+                delta = actual - allowed
+                lines.append(f"  {marker}{name:<8} {actual:>10} vs budget {allowed:<10} ({delta:+g})")
+            else:
+                lines.append(f"  {marker}{name:<8} {actual!s:>10} vs expected {allowed!s}")
+        if 'measured_queries' in self.budget:
+            lines.append(f"  (recorded queries: {self.budget['measured_queries']})")
+        if 'target_queries' in self.budget:
+            lines.append(f"  (target queries: {self.budget['target_queries']})")
+        return '\n'.join(lines)
+
+    def reportinfo(self):
+        return self.path, None, f"budget: {self.route}"
+
+
+def pytest_terminal_summary(terminalreporter, exitstatus, config):
+    results = config._route_budget_results
+    if not results:
+        return
+    terminalreporter.section('route budgets')
+    terminalreporter.write_line(f"{'route':<46} {'queries':>14} {'p95 ms':>20}")
+    for item in results:
+        checks = {name: (actual, allowed, ok) for name, actual, allowed, ok in item.checks}
+        q_actual, q_allowed, q_ok = checks['queries']
+        line = f"{item.route:<46} {q_actual!s:>6} / {q_allowed:<5}{'' if q_ok else '✗'}"
+        if 'p95_ms' in checks:
+            p_actual, p_allowed, p_ok = checks['p95_ms']
+            line += f" {p_actual:>9.1f} / {p_allowed:<7}{'' if p_ok else '✗'}"
+        if 'target_queries' in item.budget:
+            line += f"  target {item.budget['target_queries']}"
+        terminalreporter.write_line(line)
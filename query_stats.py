@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Query Stats - Dump the SQL statement statistics collected by a running portal
+
+Reads /api/_query_stats from the server (authenticating with METRICS_TOKEN)
+and prints the heaviest statement fingerprints with their query plans.
+
+    METRICS_TOKEN=... python query_stats.py --url http://localhost:5004 --sort p99 --limit 10
+    python query_stats.py --file stats.json       # print a previously saved --json dump
+"""
+
+import argparse
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+
+
+def fetch_stats(url, token, sort, limit, reset=False):
+    """Fetch (or reset) the statistics of one server process"""
+    request = urllib.request.Request(
+        f"{url.rstrip('/')}/api/_query_stats?sort={sort}&limit={limit}",
+        method='DELETE' if reset else 'GET',
+        headers={'Authorization': f'Bearer {token}'} if token else {},
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.load(response)
+
+
+def print_stats(data, show_plans=True):
+    statements = data.get('statements', [])
+    print("=" * 100)
+    print(f"SQL statement statistics (pid {data.get('pid')}, slow threshold {data.get('slow_query_ms')} ms)")
+    print("=" * 100)
+    if not statements:
+        print("No statements recorded yet.")
+        return
+
+    print(f"{'calls':>8} {'total ms':>11} {'mean ms':>9} {'p99 ms':>9} {'max ms':>9} {'rows/call':>9} {'slow':>5}  statement")
+    for row in statements:
+        fingerprint = row['fingerprint']
+        if len(fingerprint) > 120:
+            fingerprint = fingerprint[:117] + '...'
+        print(f"{row['count']:>8} {row['total_ms']:>11.1f} {row['mean_ms']:>9.3f} {row['p99_ms']:>9.3f} "
+              f"{row['max_ms']:>9.3f} {row['rows_per_call']:>9} {row['slow']:>5}  {fingerprint}")
+        if show_plans and row.get('plan'):
+            for line in row['plan']:
+                print(f"{'':>65}  | {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default=os.environ.get('PORTAL_URL', 'http://localhost:5004'))
+    parser.add_argument('--token', default=os.environ.get('METRICS_TOKEN'))
+    parser.add_argument('--sort', default='total', choices=['total', 'mean', 'p99', 'max', 'count'])
+    parser.add_argument('--limit', type=int, default=25)
+    parser.add_argument('--file', help='print a saved JSON dump instead of querying the server')
+    parser.add_argument('--json', action='store_true', help='print the raw JSON (to save and compare later)')
+    parser.add_argument('--no-plans', action='store_true')
+    parser.add_argument('--reset', action='store_true', help='clear the server statistics after dumping')
+    args = parser.parse_args()
+
+    try:
+        if args.file:
+            with open(args.file) as f:
+                data = json.load(f)
+        else:
+            data = fetch_stats(args.url, args.token, args.sort, args.limit)
+    except (OSError, urllib.error.URLError, ValueError) as e:
+        print(f"❌ Could not load query statistics: {e}", file=sys.stderr)
+        return 1
+
+    if data.get('status') == 'error':
+        print(f"❌ {data.get('message')}", file=sys.stderr)
+        return 1
+
+    if args.json:
+        print(json.dumps(data, indent=2))
+    else:
+        print_stats(data, show_plans=not args.no_plans)
+
+    if args.reset and not args.file:
+        fetch_stats(args.url, args.token, args.sort, args.limit, reset=True)
+        print("✅ Statistics reset")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
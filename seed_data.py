@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+"""
+Seed Data - Fill a separate database with a synthetic, reproducible tenant
+
+Creates users with roles and employee records, leave/permission/travel/
+conveyance/asset requests, tasks, projects and groups, evaluations,
+announcements and holidays. The same --seed always produces the same data, so
+benchmark runs against the same scale can be compared.
+
+    python seed_data.py --db bench.db --scale medium
+    python seed_data.py --db big.db --users 10000 --requests 1000000 --seed 7
+
+The target database must be empty (or pass --force); users.db is never touched.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+SCALES = {
+    'small': {'users': 200, 'requests': 5000},
+    'medium': {'users': 2000, 'requests': 100000},
+    'large': {'users': 10000, 'requests': 1000000},
+}
+# Share of --requests per request type
+REQUEST_MIX = {'leave': 0.35, 'permission': 0.25, 'travel': 0.10, 'conveyance': 0.15, 'asset': 0.15}
+CHUNK_SIZE = 5000
+SEED_PASSWORD = 'password'
+
+# Well-known accounts the benchmark and budget tests log in as
+PERSONAS = {
+    'admin': ('admin@bench.local', ['Admin', 'Employee']),
+    'director': ('director@bench.local', ['Director', 'Employee']),
+    'md': ('md@bench.local', ['Managing Director', 'Employee']),
+    'hr': ('hr@bench.local', ['HR', 'Employee']),
+    'accounts': ('accounts@bench.local', ['Accounts', 'Employee']),
+    'procurement': ('procurement@bench.local', ['Procurement', 'Employee']),
+    'teamlead': ('teamlead@bench.local', ['Team Lead', 'Employee']),
+    'employee': ('employee@bench.local', ['Employee']),
+}
+
+FIRST_NAMES = ['Aarav', 'Vivaan', 'Aditya', 'Ishaan', 'Diya', 'Ananya', 'Saanvi', 'Meera', 'Karthik', 'Priya',
+               'Rahul', 'Sneha', 'Arjun', 'Kavya', 'Rohan', 'Nisha', 'Vikram', 'Lakshmi', 'Suresh', 'Divya']
+LAST_NAMES = ['Sharma', 'Iyer', 'Reddy', 'Nair', 'Patel', 'Gupta', 'Menon', 'Rao', 'Kumar', 'Singh',
+              'Pillai', 'Das', 'Joshi', 'Mehta', 'Verma']
+BRANCHES = ['Chennai', 'Bangalore', 'Hyderabad', 'Pune', 'Mumbai', 'Delhi']
+DESIGNATIONS = ['Software Engineer', 'Senior Engineer', 'Analyst', 'Designer', 'Accountant',
+                'Field Officer', 'Project Manager', 'HR Executive', 'Intern']
+PLACES = ['Office', 'Client Site', 'Airport', 'Railway Station', 'Warehouse', 'Head Office', 'Site A', 'Site B']
+ITEMS = [('Laptop', 65000), ('Monitor', 12000), ('Keyboard', 1500), ('Office Chair', 8000),
+         ('Printer', 18000), ('Projector', 45000), ('Router', 4000), ('UPS', 9000)]
+VENDORS = ['Acme Traders', 'Sri Balaji Systems', 'Metro Office Supplies', 'TechWorld', 'Prime Electronics']
+BUDGET_HEADS = ['Capex', 'Opex', 'Project', 'Admin']
+WORDS = ('client meeting site visit family function medical appointment travel documentation review '
+         'training workshop audit delivery installation support vendor follow up quarterly report').split()
+
+LEAVE_STATUSES = ['Pending', 'Pending HR Approval', 'Pending Director Approval', 'Approved', 'Rejected']
+PERMISSION_STATUSES = ['Pending', 'Pending HR Approval', 'Pending Director Approval', 'Approved', 'Rejected']
+TRAVEL_STATUSES = ['Pending Director Approval', 'Approved', 'Rejected']
+ASSET_STATUSES = ['Pending TL Approval', 'Pending Procurement Approval', 'Pending TL Final Approval',
+                  'Pending Director Approval', 'Pending Managing Director Approval',
+                  'Pending Accounts Approval', 'Pending Final Delivery', 'Completed', 'Rejected']
+EVALUATION_FLOW = [('Employee', 2, 'Employee has Submitted'), ('Team Lead', 3, 'Team Lead has Reviewed'),
+                   ('HR', 4, 'HR has Reviewed'), ('Director', 5, 'Director has Reviewed'),
+                   ('Managing Director', 6, 'Completed')]
+
+
+def load_app(db_path):
+    """Import app.py against db_path instead of users.db"""
+    os.environ['DATABASE_URI'] = 'sqlite:///' + os.path.abspath(db_path)
+    import app as portal
+    return portal
+
+
+def _chunks(rows, size=CHUNK_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Seeder:
+    def __init__(self, portal, conn, users, requests, seed):
+        self.portal = portal
+        self.conn = conn
+        self.n_users = users
+        self.n_requests = requests
+        self.rng = random.Random(seed)
+        self.today = date(2026, 1, 1)  # fixed so dates are reproducible
+        self.counts = {}
+
+    # -- helpers -------------------------------------------------------
+    def insert(self, model_or_table, rows):
+        table = getattr(model_or_table, '__table__', model_or_table)
+        total = 0
+        for batch in _chunks(rows):
+            self.conn.execute(table.insert(), batch)
+            total += len(batch)
+        self.counts[table.name] = self.counts.get(table.name, 0) + total
+        return total
+
+    def next_id(self, model):
+        db = self.portal.db
+        return self.conn.execute(db.select(db.func.coalesce(db.func.max(model.id), 0))).scalar() + 1
+
+    def day(self, back=730, ahead=60):
+        return self.today + timedelta(days=self.rng.randint(-back, ahead))
+
+    def sentence(self, words=8):
+        return ' '.join(self.rng.choice(WORDS) for _ in range(words)).capitalize()
+
+    def name(self):
+        return f'{self.rng.choice(FIRST_NAMES)} {self.rng.choice(LAST_NAMES)}'
+
+    # -- people ----------------------------------------------------------
+    def seed_roles(self):
+        portal = self.portal
+        names = set(name for _, roles in PERSONAS.values() for name in roles)
+        names |= {'Admin', 'CEO', 'CTO', 'CFO', 'Director', 'Manager', 'Employee', 'Accounts', 'Finance', 'Procurement'}
+        existing = {name for name, in self.conn.execute(portal.Role.__table__.select().with_only_columns(portal.Role.name))}
+        self.insert(portal.Role, [{'name': name} for name in sorted(names - existing)])
+        self.role_ids = dict(self.conn.execute(portal.Role.__table__.select().with_only_columns(portal.Role.name, portal.Role.id)).all())
+
+    def seed_users(self):
+        portal = self.portal
+        password = portal.generate_password_hash(SEED_PASSWORD)  # hashed once; every account shares it
+        first_id = self.next_id(portal.User)
+        users, links = [], []
+        specials = list(PERSONAS.values())
+        n_leads = max(1, self.n_users // 15)
+        self.user_ids = list(range(first_id, first_id + self.n_users))
+        self.lead_ids, self.hr_ids, self.director_ids = [], [], []
+
+        for offset, user_id in enumerate(self.user_ids):
+            if offset < len(specials):
+                email, roles = specials[offset]
+            else:
+                email = f'user{offset}@bench.local'
+                roles = ['Employee']
+                if offset < len(specials) + n_leads:
+                    roles = ['Team Lead', 'Employee']
+                elif offset < len(specials) + n_leads + 4:
+                    roles = ['HR', 'Employee']
+                elif offset < len(specials) + n_leads + 6:
+                    roles = ['Director', 'Employee']
+            if 'Team Lead' in roles:
+                self.lead_ids.append(user_id)
+            if 'HR' in roles:
+                self.hr_ids.append(user_id)
+            if 'Director' in roles:
+                self.director_ids.append(user_id)
+            name = self.name()
+            users.append({'id': user_id, 'name': name, 'username': email.split('@')[0], 'email': email,
+                          'password': password, 'created_by_admin': True, 'pf_no': f'PF{user_id:06d}',
+                          'is_deleted': False})
+            links.extend({'user_id': user_id, 'role_id': self.role_ids[role]} for role in roles)
+        self.insert(portal.User, users)
+        self.insert(portal.user_roles, links)
+        self.names = {row['id']: row['name'] for row in users}
+        self.emails = {row['id']: row['email'] for row in users}
+        self.persona_ids = {key: self.user_ids[i] for i, key in enumerate(PERSONAS)}
+        # Everyone reports to a team lead; the persona team lead gets the employee persona
+        self.lead_of = {uid: self.rng.choice(self.lead_ids) for uid in self.user_ids}
+        self.lead_of[self.persona_ids['employee']] = self.persona_ids['teamlead']
+
+    def seed_employee_info(self):
+        portal = self.portal
+
+        def rows():
+            for number, user_id in enumerate(self.user_ids, start=1):
+                gross = float(self.rng.randrange(15000, 150000, 500))
+                basic = round(gross * 0.5, 2)
+                joined = self.day(back=3000, ahead=0)
+                yield {
+                    'user_id': user_id, 'full_name': self.names[user_id], 'email': self.emails[user_id],
+                    'dob': self.day(back=365 * 45, ahead=-365 * 21).strftime('%Y-%m-%d'),
+                    'gender': self.rng.choice(['Male', 'Female']),
+                    'phone_no': f'9{self.rng.randrange(10 ** 8, 10 ** 9)}',
+                    'address': f'{self.rng.randint(1, 400)}, {self.rng.choice(BRANCHES)}',
+                    'office_branch': self.rng.choice(BRANCHES), 'employee_id': f'EMP{number:05d}',
+                    'designation': self.rng.choice(DESIGNATIONS), 'marital_status': self.rng.choice(['Single', 'Married']),
+                    'date_of_joining': joined, 'confirmation_date': joined + timedelta(days=180),
+                    'account_number': f'{self.rng.randrange(10 ** 11, 10 ** 12)}',
+                    'actual_gross_salary': gross, 'basic': basic, 'hra': round(gross * 0.2, 2),
+                    'conveyance': 1600.0, 'vehicle_maintenance': 0.0,
+                    'special_allowance': round(gross * 0.3 - 1600.0, 2), 'add_others': 0.0,
+                    'provident_fund': round(min(basic, 15000) * 0.12, 2), 'esi': 0.0,
+                    'professional_tax': 200.0 if gross > 20000 else 150.0, 'income_tax': 0.0, 'advance': 0.0,
+                    'other_deductions': 0.0, 'loss_of_pay': 0.0, 'total_leaves': 24,
+                    'leave_availed': self.rng.randint(0, 24), 'total_days': 30, 'ndp': self.rng.randint(26, 30),
+                    'is_deleted': False,
+                }
+        self.insert(portal.EmployeeInfo, rows())
+
+    # -- requests --------------------------------------------------------
+    def request_count(self, kind):
+        return int(self.n_requests * REQUEST_MIX[kind])
+
+    def seed_leave(self):
+        portal = self.portal
+
+        def rows():
+            for _ in range(self.request_count('leave')):
+                user_id = self.rng.choice(self.user_ids)
+                start = self.day()
+                end = start + timedelta(days=self.rng.choice([0, 0, 1, 1, 2, 4]))
+                status = self.rng.choice(LEAVE_STATUSES)
+                lead = self.lead_of[user_id]
+                yield {
+                    'user_id': user_id, 'team_lead_id': lead, 'spv_name': self.names[lead],
+                    'applicant_name': self.names[user_id], 'department': self.rng.choice(DESIGNATIONS),
+                    'total_leaves': 24, 'leave_availed': self.rng.randint(0, 20), 'balance_leaves': self.rng.randint(0, 24),
+                    'from_date': start.strftime('%Y-%m-%d'), 'to_date': end.strftime('%Y-%m-%d'),
+                    'from_time': '09:30', 'to_time': '18:30', 'reason': self.sentence(),
+                    'applicant_sign': self.names[user_id], 'applicant_sign_date': start.strftime('%Y-%m-%d'),
+                    'status': status,
+                    'reporting_authority_sign': self.names[lead] if status != 'Pending' else None,
+                }
+        self.insert(portal.LeaveRequest, rows())
+
+    def seed_permission(self):
+        portal = self.portal
+
+        def rows():
+            for _ in range(self.request_count('permission')):
+                user_id = self.rng.choice(self.user_ids)
+                lead = self.lead_of[user_id]
+                hour = self.rng.randint(10, 16)
+                yield {
+                    'user_id': user_id, 'team_lead_id': lead, 'spv_name': self.names[lead],
+                    'date': self.day().strftime('%Y-%m-%d'), 'applicant_name': self.names[user_id],
+                    'reason': self.sentence(), 'time_out': f'{hour:02d}:00', 'time_in': f'{hour + 1:02d}:30',
+                    'going_to': self.rng.choice(PLACES), 'applicant_sign': self.names[user_id],
+                    'status': self.rng.choice(PERMISSION_STATUSES),
+                }
+        self.insert(portal.PermissionRequest, rows())
+
+    def seed_travel(self):
+        portal = self.portal
+
+        def rows():
+            for _ in range(self.request_count('travel')):
+                user_id = self.rng.choice(self.user_ids)
+                when = self.day()
+                journeys = [{'date': (when + timedelta(days=i * 2)).strftime('%Y-%m-%d'),
+                             'passengerName': self.names[user_id], 'from': self.rng.choice(BRANCHES),
+                             'to': self.rng.choice(BRANCHES), 'age': str(self.rng.randint(22, 58)),
+                             'class': self.rng.choice(['Economy', 'AC 2 Tier', 'Sleeper']),
+                             'flightNo': f'AI{self.rng.randint(100, 999)}'} for i in range(self.rng.randint(1, 2))]
+                yield {'user_id': user_id, 'company': 'Bench Corp', 'date': when.strftime('%Y-%m-%d'),
+                       'purpose': self.sentence(), 'applicant_sign': self.names[user_id],
+                       'status': self.rng.choice(TRAVEL_STATUSES), 'journey_details': json.dumps(journeys)}
+        self.insert(portal.TravelRequest, rows())
+
+    def seed_conveyance(self):
+        portal = self.portal
+
+        def rows():
+            for _ in range(self.request_count('conveyance')):
+                when = self.day()
+                claims = []
+                for i in range(self.rng.randint(1, 4)):
+                    kms = self.rng.randint(3, 60)
+                    claims.append({'date': (when + timedelta(days=i)).strftime('%Y-%m-%d'),
+                                   'from': self.rng.choice(PLACES), 'to': self.rng.choice(PLACES),
+                                   'mode': self.rng.choice(['Bike', 'Car', 'Auto', 'Bus']),
+                                   'kms': str(kms), 'amount': str(kms * 4)})
+                yield {'user_id': self.rng.choice(self.user_ids), 'claim_details': json.dumps(claims),
+                       'status_hr': self.rng.choice(['Pending', 'Seen']),
+                       'status_accounts': self.rng.choice(['Pending', 'Seen']),
+                       'request_date': datetime.combine(when, datetime.min.time())}
+        self.insert(portal.ConveyanceRequest, rows())
+
+    def seed_assets(self):
+        portal = self.portal
+        first_id = self.next_id(portal.AssetRequest)
+        item_rows = []
+
+        def rows():
+            for request_id in range(first_id, first_id + self.request_count('asset')):
+                user_id = self.rng.choice(self.user_ids)
+                when = self.day()
+                items = []
+                for position in range(self.rng.randint(1, 3)):
+                    name, cost = self.rng.choice(ITEMS)
+                    qty = self.rng.randint(1, 5)
+                    item = {'name': name, 'brand': 'Generic', 'vendor': self.rng.choice(VENDORS),
+                            'tentativeCost': cost, 'qty': qty, 'tax': 18, 'taxType': 'GST',
+                            'total': round(cost * qty * 1.18, 2), 'requiredBy': when.strftime('%Y-%m-%d'),
+                            'warranty': '1 year', 'remarks': ''}
+                    items.append(item)
+                    item_rows.append({'asset_request_id': request_id, 'position': position, 'name': name,
+                                      'brand': 'Generic', 'vendor': item['vendor'], 'tentative_cost': float(cost),
+                                      'qty': qty, 'tax': 18.0, 'tax_type': 'GST', 'total': item['total'],
+                                      'required_by': item['requiredBy'], 'warranty': '1 year', 'remarks': ''})
+                yield {'id': request_id, 'indenter_id': user_id, 'indenter_name': self.names[user_id],
+                       'office_project_type': 'Office', 'team_lead_id': self.lead_of[user_id],
+                       'reference_file_no': f'REF/{request_id}', 'purchase_type': 'Purchase',
+                       'budget_head': self.rng.choice(BUDGET_HEADS), 'nature_of_expenditure': 'Capital',
+                       'gst_applicable': 'Yes', 'item_details': json.dumps(items),
+                       'request_date': datetime.combine(when, datetime.min.time()),
+                       'justification': self.sentence(), 'status': self.rng.choice(ASSET_STATUSES),
+                       'discount_amount': 0.0, 'items_backfilled': True}
+                if len(item_rows) >= CHUNK_SIZE:
+                    self.insert(portal.AssetRequestItem, item_rows)
+                    item_rows.clear()
+        self.insert(portal.AssetRequest, rows())
+        self.insert(portal.AssetRequestItem, item_rows)
+
+    # -- collaboration ---------------------------------------------------
+    def seed_tasks_and_groups(self):
+        portal = self.portal
+        self.insert(portal.Task, ({
+            'task_name': self.sentence(4), 'assigned_by_id': self.lead_of[uid], 'assigned_to_id': uid,
+            'status': self.rng.choice(['Pending', 'Completed']),
+            'created_at': datetime.combine(self.day(), datetime.min.time()),
+        } for uid in self.user_ids for _ in range(3)))
+
+        n_projects = max(1, self.n_users // 40)
+        first_project = self.next_id(portal.Project)
+        self.insert(portal.Project, ({
+            'id': first_project + i, 'project_name': f'Project {i + 1}', 'group_name': f'Group {i + 1}',
+            'start_date': self.day().strftime('%Y-%m-%d'), 'deadline': self.day(back=0, ahead=365).strftime('%Y-%m-%d'),
+            'budget_head': self.rng.choice(BUDGET_HEADS), 'created_by': self.emails[self.rng.choice(self.lead_ids)],
+        } for i in range(n_projects)))
+
+        first_group = self.next_id(portal.Group)
+        n_groups = max(1, self.n_users // 20)
+        self.insert(portal.Group, ({
+            'id': first_group + i, 'name': f'Group {i + 1}', 'group_type': self.rng.choice(['development', 'design', 'marketing']),
+            'description': self.sentence(), 'project_id': first_project + i % n_projects,
+        } for i in range(n_groups)))
+        self.insert(portal.group_members, ({'group_id': first_group + i, 'user_id': uid}
+                                           for i in range(n_groups)
+                                           for uid in self.rng.sample(self.user_ids, min(8, len(self.user_ids)))))
+
+        n_teams = max(1, self.n_users // 25)
+        first_team = self.next_id(portal.Team)
+        self.insert(portal.Team, ({'id': first_team + i, 'name': f'Bench Team {first_team + i}',
+                                   'description': self.sentence()} for i in range(n_teams)))
+        self.insert(portal.team_members, ({'team_id': first_team + i % n_teams, 'user_id': uid}
+                                          for i, uid in enumerate(self.user_ids)))
+
+    def seed_evaluations(self):
+        portal = self.portal
+        first_report = self.next_id(portal.EvaluationReport)
+        score_columns = portal.EVALUATION_SCORE_COLUMNS
+        reports, responses = [], []
+        for offset, user_id in enumerate(self.rng.sample(self.user_ids, len(self.user_ids) // 2)):
+            report_id = first_report + offset
+            stages = self.rng.randint(1, len(EVALUATION_FLOW))
+            created = datetime.combine(self.day(back=365, ahead=0), datetime.min.time())
+            reports.append({'id': report_id, 'employee_id': user_id, 'team_lead_id': self.lead_of[user_id],
+                            'status': EVALUATION_FLOW[stages - 1][2], 'name': self.names[user_id],
+                            'position': self.rng.choice(DESIGNATIONS), 'email_id': self.emails[user_id],
+                            'office_branch': self.rng.choice(BRANCHES),
+                            'employment_status': self.rng.choice(['Internship', 'Probation', 'Confirmation']),
+                            'salary': float(self.rng.randrange(15000, 150000, 500)),
+                            'created_at': created, 'updated_at': created})
+            base = self.rng.randint(4, 9)
+            for role, page, _ in EVALUATION_FLOW[:stages]:
+                evaluator = {'Employee': user_id, 'Team Lead': self.lead_of[user_id]}.get(
+                    role, self.rng.choice(self.hr_ids if role == 'HR' else self.director_ids))
+                row = {'evaluation_report_id': report_id, 'evaluator_id': evaluator, 'evaluator_role': role,
+                       'page_number': page, 'evaluator_name': self.names[evaluator],
+                       'signature': self.names[evaluator], 'evaluation_date': created.date(),
+                       'created_at': created, 'updated_at': created}
+                for column in score_columns:
+                    row[column] = max(1, min(10, base + self.rng.randint(-2, 2)))
+                responses.append(row)
+        self.insert(portal.EvaluationReport, reports)
+        self.insert(portal.EvaluationResponse, responses)
+
+    def seed_announcements_and_holidays(self):
+        portal = self.portal
+        author = self.persona_ids['admin']
+        self.insert(portal.Announcement, ({
+            'title': self.sentence(4), 'content': self.sentence(30), 'author_id': author,
+            'created_at': datetime.combine(self.day(back=180, ahead=0), datetime.min.time()),
+            'is_active': True, 'priority': self.rng.choice(['Low', 'Normal', 'High', 'Urgent']),
+            'target_roles': json.dumps(self.rng.choice([[], [], ['HR'], ['Team Lead'], ['Employee']])),
+            'target_users': json.dumps([]),
+        } for _ in range(50 + self.n_users // 100)))
+        holidays = []
+        for year in (self.today.year - 1, self.today.year):
+            for month, day_, name in [(1, 1, "New Year's Day"), (1, 14, 'Pongal'), (1, 26, 'Republic Day'),
+                                      (3, 14, 'Holi'), (4, 14, 'Tamil New Year'), (5, 1, 'May Day'),
+                                      (8, 15, 'Independence Day'), (9, 7, 'Ganesh Chaturthi'),
+                                      (10, 2, 'Gandhi Jayanti'), (10, 20, 'Diwali'), (11, 1, 'Kannada Rajyotsava'),
+                                      (12, 25, 'Christmas')]:
+                holidays.append({'name': name, 'date': date(year, month, day_).strftime('%Y-%m-%d'),
+                                 'created_by': author})
+        self.insert(portal.Holiday, holidays)
+
+    def run(self):
+        steps = [self.seed_roles, self.seed_users, self.seed_employee_info, self.seed_leave, self.seed_permission,
+                 self.seed_travel, self.seed_conveyance, self.seed_assets, self.seed_tasks_and_groups,
+                 self.seed_evaluations, self.seed_announcements_and_holidays]
+        for step in steps:
+            started = time.perf_counter()
+            step()
+            print(f"   ✅ {step.__name__[5:]:<28} {time.perf_counter() - started:6.1f}s")
+        return self.counts
+
+
+def seed(portal, users, requests, seed=42, rebuild_search=True):
+    """Fill the app's database (portal.db) with synthetic data; returns rows per table"""
+    with portal.app.app_context():
+        with portal.db.engine.begin() as conn:
+            conn.exec_driver_sql('PRAGMA synchronous = OFF')
+            counts = Seeder(portal, conn, users, requests, seed).run()
+
+        # Derived tables and columns the ORM write paths would normally maintain
+        portal.refresh_evaluation_summaries()
+        portal.db.session.commit()
+        portal.backfill_typed_dates()
+        portal.backfill_conveyance_claim_lines()
+        if rebuild_search and portal.search_enabled:
+            started = time.perf_counter()
+            portal.rebuild_search_index()
+            print(f"   ✅ {'search index':<28} {time.perf_counter() - started:6.1f}s")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', default='bench.db', help='SQLite file to create/fill (default bench.db)')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--users', type=int, help='override the number of users for --scale')
+    parser.add_argument('--requests', type=int, help='override the total number of requests for --scale')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--no-search', action='store_true', help='skip rebuilding the search index')
+    parser.add_argument('--force', action='store_true', help='seed even if the database already has users')
+    args = parser.parse_args()
+
+    if os.path.basename(args.db) == 'users.db':
+        print("❌ Refusing to seed users.db; pass a separate --db file", file=sys.stderr)
+        return 1
+    users = args.users or SCALES[args.scale]['users']
+    requests = args.requests if args.requests is not None else SCALES[args.scale]['requests']
+    if users < len(PERSONAS) + 8:
+        print(f"❌ --users must be at least {len(PERSONAS) + 8}", file=sys.stderr)
+        return 1
+
+    portal = load_app(args.db)
+    with portal.app.app_context():
+        if portal.User.query.count() and not args.force:
+            print(f"❌ {args.db} already has users; use a new file or --force", file=sys.stderr)
+            return 1
+
+    print("=" * 80)
+    print(f"🌱 Seeding {args.db}: {users} users, {requests} requests (seed {args.seed})")
+    print("=" * 80)
+    started = time.perf_counter()
+    counts = seed(portal, users, requests, args.seed, rebuild_search=not args.no_search)
+    print(f"\n📊 Rows inserted in {time.perf_counter() - started:.1f}s:")
+    for table, count in sorted(counts.items()):
+        print(f"   {table:<24} {count:>10,}")
+    print(f"\n🔑 Persona logins (password '{SEED_PASSWORD}'):")
+    for key, (email, roles) in PERSONAS.items():
+        print(f"   {key:<12} {email:<28} {', '.join(roles)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -61,7 +61,8 @@ def setup_test_birthdays():
         emp_id, name, email = emp
         if i < len(test_dates):
             birthday = test_dates[i]
-            cursor.execute("UPDATE employee_info SET dob = ? WHERE id = ?", (birthday, emp_id))
+            # birth_date is the typed copy of dob that the alert query filters on
+            cursor.execute("UPDATE employee_info SET dob = ?, birth_date = ? WHERE id = ?", (birthday, birthday, emp_id))
             
             # Display which date this employee got
             if i == 0: